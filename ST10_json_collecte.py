@@ -2,6 +2,8 @@ import os
 import json
 import argparse
 from tqdm import tqdm
+from layer_dataset import DATASET_DIRNAME, read_dataset, iter_documents, save_merged
+from tar_shards import SHARDS_DIRNAME, ShardIndex
 
 def merge_json_files(input_folder, output_file, encoding='utf-8'):
     """
@@ -55,11 +57,60 @@ def merge_json_files(input_folder, output_file, encoding='utf-8'):
         print(f"错误: 无法保存合并后的文件 '{output_file}': {str(e)}")
         return False
 
+def merge_dataset(input_folder, output_file, encoding='utf-8'):
+    """
+    合并提取阶段写出的列式分片（<input_folder>/_dataset）
+
+    输出为 .npz/.parquet 时直接拼接各列；输出为 .json 时还原成与
+    merge_json_files 相同的列表结构，供旧的下游脚本使用。
+    """
+    docs, layers = read_dataset(os.path.join(input_folder, DATASET_DIRNAME))
+    if docs is None:
+        print(f"错误: 在文件夹 '{input_folder}' 中未找到数据集分片")
+        return False
+    
+    try:
+        if output_file.lower().endswith('.json'):
+            with open(output_file, 'w', encoding=encoding) as f:
+                json.dump(list(iter_documents(docs, layers)), f, ensure_ascii=False, indent=2)
+        else:
+            save_merged(output_file, docs, layers)
+        print(f"成功合并 {len(docs['id'])} 个文档（{len(layers['z'])} 个图层）到 '{output_file}'")
+        return True
+    except Exception as e:
+        print(f"错误: 无法保存合并后的文件 '{output_file}': {str(e)}")
+        return False
+
+def merge_shard_json_files(input_folder, output_file, encoding='utf-8'):
+    """合并tar分片中的 {id}_layers.json 成员（按索引直接读取，不解包）"""
+    index = ShardIndex(input_folder)
+    names = [n for n in index.names() if n.endswith('_layers.json')]
+    if not names:
+        print(f"错误: 在 '{input_folder}' 的分片中未找到JSON文件")
+        return False
+    
+    all_json_data = []
+    for name in tqdm(names, desc="读取分片中的JSON"):
+        try:
+            all_json_data.append(json.loads(index.read(name).decode(encoding)))
+        except Exception as e:
+            print(f"警告: 无法解析 '{name}': {str(e)}")
+    index.close()
+    
+    try:
+        with open(output_file, 'w', encoding=encoding) as f:
+            json.dump(all_json_data, f, ensure_ascii=False, indent=2)
+        print(f"成功合并 {len(all_json_data)} 个JSON文件到 '{output_file}'")
+        return True
+    except Exception as e:
+        print(f"错误: 无法保存合并后的文件 '{output_file}': {str(e)}")
+        return False
+
 def main():
     """主函数，处理命令行参数"""
     parser = argparse.ArgumentParser(description='合并多个JSON文件到一个文件中')
     parser.add_argument('-i', '--input',default='/storage/human_psd/psd_output/fp_v2_output', help='包含JSON文件的文件夹路径')
-    parser.add_argument('-o', '--output', default='/storage/human_psd/json/fp_v2.json', help='输出的合并后的JSON文件路径')
+    parser.add_argument('-o', '--output', default='/storage/human_psd/json/fp_v2.json', help='输出的合并后的文件路径（.json / .npz / .parquet）')
     parser.add_argument('-e', '--encoding', default='utf-8', help='文件编码，默认为utf-8')
     
     args = parser.parse_args()
@@ -69,8 +120,13 @@ def main():
     if output_dir and not os.path.exists(output_dir):
         os.makedirs(output_dir, exist_ok=True)
     
-    # 执行合并
-    merge_json_files(args.input, args.output, args.encoding)
+    # 执行合并：有列式分片时直接拼接，否则逐个读取JSON
+    if os.path.isdir(os.path.join(args.input, DATASET_DIRNAME)):
+        merge_dataset(args.input, args.output, args.encoding)
+    elif os.path.isdir(os.path.join(args.input, SHARDS_DIRNAME)):
+        merge_shard_json_files(args.input, args.output, args.encoding)
+    else:
+        merge_json_files(args.input, args.output, args.encoding)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
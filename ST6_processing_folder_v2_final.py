@@ -14,8 +14,15 @@ from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_compl
 import multiprocessing
 from functools import lru_cache
 import warnings
+from psd_manifest import PSDManifest, duplicate_file_ids, resolve_manifest_path
+from layer_render_cache import LayerRenderCache
+from image_codecs import get_codec
 warnings.filterwarnings('ignore')
 
+# 编码预设（见 image_codecs.CODEC_PRESETS）：default / fast / archive / webp / raw
+LAYER_CODEC = 'default'
+PREVIEW_CODEC = 'default'
+
 class OptimizedPSDLayerExtractor:
     def __init__(self, psd_path, output_folder):
         self.psd_path = psd_path
@@ -23,14 +30,17 @@ class OptimizedPSDLayerExtractor:
         self.psd = PSDImage.open(psd_path)
         self.file_id = os.path.splitext(os.path.basename(psd_path))[0]
         self.layers_info = []
+        self.preview_filename = None
         
         # 创建输出文件夹
         file_output_folder = os.path.join(output_folder, self.file_id)
         os.makedirs(file_output_folder, exist_ok=True)
         self.file_output_folder = file_output_folder
         
-        # 缓存composite结果
-        self._composite_cache = {}
+        # 缓存composite结果（字节上限LRU，导出后立即释放）
+        self.render_cache = LayerRenderCache()
+        self.layer_codec = get_codec(LAYER_CODEC)
+        self.preview_codec = get_codec(PREVIEW_CODEC)
         
     def determine_layer_type_fast(self, layer):
         """快速判断图层类型（优化版）"""
@@ -85,30 +95,25 @@ class OptimizedPSDLayerExtractor:
             
         return 2
     
-    def _get_layer_composite(self, layer):
-        """获取图层composite（带缓存）"""
-        layer_id = id(layer)
-        if layer_id not in self._composite_cache:
-            self._composite_cache[layer_id] = layer.composite()
-        return self._composite_cache[layer_id]
-    
     def export_layer_async(self, layer_data):
         """异步导出单个图层"""
         layer, layer_type, z_index = layer_data
         try:
-            filename = f"{self.file_id}_{layer_type}_{z_index}.png"
+            filename = f"{self.file_id}_{layer_type}_{z_index}.{self.layer_codec.extension}"
             filepath = os.path.join(self.file_output_folder, filename)
             
-            img = self._get_layer_composite(layer)
+            img = self.render_cache.get(layer)
             if img:
                 # 确保是RGBA模式
                 if img.mode != 'RGBA':
                     img = img.convert('RGBA')
-                img.save(filepath, 'PNG', optimize=True)
+                self.layer_codec.save(img, filepath)
                 return filename
         except Exception as e:
             print(f"导出图层 {layer.name} 时出错: {e}")
             return None
+        finally:
+            self.render_cache.release(layer)
     
     def collect_all_layers(self):
         """收集所有需要处理的图层信息"""
@@ -148,7 +153,7 @@ class OptimizedPSDLayerExtractor:
     def export_preview_optimized(self):
         """优化的预览图导出"""
         try:
-            preview_filename = f"{self.file_id}_preview.png"
+            preview_filename = f"{self.file_id}_preview.{self.preview_codec.extension}"
             preview_path = os.path.join(self.file_output_folder, preview_filename)
             
             # 直接使用PSD的composite方法
@@ -163,7 +168,7 @@ class OptimizedPSDLayerExtractor:
                 elif preview.mode != 'RGB':
                     preview = preview.convert('RGB')
                 
-                preview.save(preview_path, 'PNG', quality=85, optimize=True)
+                self.preview_codec.save(preview, preview_path)
                 return preview_filename
         except:
             return None
@@ -172,7 +177,7 @@ class OptimizedPSDLayerExtractor:
         """优化的提取流程"""
         try:
             # 1. 导出预览图
-            self.export_preview_optimized()
+            self.preview_filename = self.export_preview_optimized()
             
             # 2. 收集所有图层信息
             layers_to_export = self.collect_all_layers()
@@ -213,7 +218,7 @@ class OptimizedPSDLayerExtractor:
             self.save_json_optimized()
             
             # 清理缓存
-            self._composite_cache.clear()
+            self.render_cache.clear()
             
             return True
         except Exception as e:
@@ -233,7 +238,7 @@ class OptimizedPSDLayerExtractor:
             "id": self.file_id,
             "canvas_width": self.psd.width,
             "canvas_height": self.psd.height,
-            "preview_path": f"{self.file_id}_preview.png",
+            "preview_path": f"{self.file_id}_preview.{self.preview_codec.extension}",
             "z": [l["z"] for l in self.layers_info],
             "type": [l["type"] for l in self.layers_info],
             "left": [l["left"] for l in self.layers_info],
@@ -246,18 +251,42 @@ class OptimizedPSDLayerExtractor:
         
         with open(json_path, 'w', encoding='utf-8') as f:
             json.dump(list_format, f, ensure_ascii=False, indent=2)
+    
+    def output_files(self):
+        """本PSD生成的所有输出文件（相对输出根目录，供清单校验）"""
+        files = [f"{self.file_id}_layers.json"]
+        if self.preview_filename:
+            files.append(self.preview_filename)
+        files.extend(l["image_path"] for l in self.layers_info)
+        return [os.path.join(self.file_id, f) for f in files]
 
 
 def process_single_psd(args):
-    """处理单个PSD文件（用于多进程）"""
+    """处理单个PSD文件（用于多进程，已完成的文件根据清单跳过）"""
     psd_file, output_folder = args
+    manifest = PSDManifest(resolve_manifest_path(output_folder))
     try:
+        if manifest.is_complete(psd_file, output_folder):
+            return psd_file, True
+        
+        # 清理上次中断留下的半成品
+        file_id = os.path.splitext(os.path.basename(psd_file))[0]
+        manifest.clear_output_folder(psd_file, output_folder, file_id)
+        manifest.mark_running(psd_file)
+        
         extractor = OptimizedPSDLayerExtractor(psd_file, output_folder)
         success = extractor.extract_optimized()
+        if success:
+            manifest.mark_done(psd_file, len(extractor.layers_info), extractor.output_files())
+        else:
+            manifest.mark_failed(psd_file, "extraction failed")
         return psd_file, success
     except Exception as e:
         print(f"处理 {psd_file} 时出错: {e}")
+        manifest.mark_failed(psd_file, str(e))
         return psd_file, False
+    finally:
+        manifest.close()
 
 
 def get_all_psd_files(folder_path):
@@ -280,13 +309,30 @@ def main():
     
     # 获取所有PSD文件
     psd_files = get_all_psd_files(psd_folder)
+    
+    if not psd_files:
+        print(f"错误：在 {psd_folder} 中未找到PSD文件")
+        return
+    
+    # 输出文件夹按文件名命名，同名PSD会互相清理对方的输出
+    duplicates = duplicate_file_ids(psd_files)
+    if duplicates:
+        for file_id, paths in sorted(duplicates.items())[:20]:
+            print(f"  {file_id}: {', '.join(paths)}")
+        print(f"错误：{len(duplicates)} 个PSD文件名在多个文件夹中重复，请先重命名")
+        return
+    
+    # 根据清单跳过已完成的文件
+    manifest = PSDManifest(resolve_manifest_path(output_folder))
+    all_count = len(psd_files)
+    psd_files = manifest.pending(psd_files, output_folder)
+    manifest.close()
     total_files = len(psd_files)
     
+    print(f"找到 {all_count} 个PSD文件，已完成 {all_count - total_files} 个，待处理 {total_files} 个")
     if total_files == 0:
-        print(f"错误：在 {psd_folder} 中未找到PSD文件")
         return
-        
-    print(f"找到 {total_files} 个PSD文件，开始批量处理...")
+    print("开始批量处理...")
     
     # 确定进程数（CPU核心数的一半，但不超过8）
     num_processes = min(multiprocessing.cpu_count() // 2, 8, total_files)
@@ -3,23 +3,51 @@ import shutil
 import fnmatch
 from pathlib import Path
 from tqdm import tqdm
+from tar_shards import SHARDS_DIRNAME, ShardIndex
+from layer_phash import load_or_build_index, near_duplicates
 
-def copy_matching_png_files(source_folder, destination_folder):
+# 近似重复图片只复制簇代表（感知哈希汉明距离阈值，None表示全部复制）
+NEAR_DUPLICATE_RADIUS = 10
+
+def near_duplicate_filter(source_folder, pattern, radius):
+    """
+    返回需要跳过的近似重复图片（相对源文件夹的路径集合），radius为None时返回None（不过滤）
+
+    只跳过索引中判定为重复的图片，索引中没有的图片（如无法解码）照常复制。
+    """
+    if radius is None:
+        return None
+    index = load_or_build_index(source_folder, pattern, radius)
+    skip = near_duplicates(index)
+    print(f"感知哈希聚类: {len(index['name'])} 张图片, {len(index['name']) - len(skip)} 个簇, "
+          f"跳过 {len(skip)} 张近似重复图片")
+    return skip
+
+def copy_matching_png_files(source_folder, destination_folder, near_duplicate_radius=NEAR_DUPLICATE_RADIUS):
     """
     递归查找源文件夹中所有名称格式为 *_2_*.png 的文件，并复制到目标文件夹
     
     Args:
         source_folder (str): 源文件夹路径
         destination_folder (str): 目标文件夹路径
+        near_duplicate_radius (int): 近似重复的汉明距离阈值，每簇只复制面积最大的一张（None不去重）
     """
     
     # 确保目标文件夹存在
     Path(destination_folder).mkdir(parents=True, exist_ok=True)
     
+    # 提取阶段以tar分片输出时直接按索引读取，不遍历目录
+    if os.path.isdir(os.path.join(source_folder, SHARDS_DIRNAME)):
+        return copy_matching_from_shards(source_folder, destination_folder,
+                                         near_duplicate_radius=near_duplicate_radius)
+    
+    skip = near_duplicate_filter(source_folder, "*_2_*.png", near_duplicate_radius)
+    
     # 统计变量
     found_files = []
     copied_files = 0
     skipped_files = 0
+    near_duplicates = 0
     
     print(f"开始搜索文件夹: {source_folder}")
     print(f"目标文件夹: {destination_folder}")
@@ -36,6 +64,11 @@ def copy_matching_png_files(source_folder, destination_folder):
                 
                 found_files.append(source_file_path)
                 
+                relative_path = os.path.relpath(source_file_path, source_folder).replace(os.sep, '/')
+                if skip is not None and relative_path in skip:
+                    near_duplicates += 1
+                    continue
+                
                 try:
                     # 检查目标文件是否已存在
                     if os.path.exists(destination_file_path):
@@ -69,6 +102,7 @@ def copy_matching_png_files(source_folder, destination_folder):
     print(f"找到的文件数量: {len(found_files)}")
     print(f"成功复制: {copied_files}")
     print(f"复制失败: {skipped_files}")
+    print(f"近似重复跳过: {near_duplicates}")
     
     if found_files:
         print("\n找到的所有文件:")
@@ -77,6 +111,53 @@ def copy_matching_png_files(source_folder, destination_folder):
     else:
         print("\n未找到符合条件的文件。")
 
+def copy_matching_from_shards(source_folder, destination_folder, pattern="*_2_*.png",
+                              near_duplicate_radius=NEAR_DUPLICATE_RADIUS):
+    """
+    从tar分片中导出名称匹配的图层图片（按索引偏移直接读取，不解包分片）
+    
+    Args:
+        source_folder (str): 提取阶段的输出文件夹（包含 _shards）
+        destination_folder (str): 目标文件夹路径
+        pattern (str): 文件名匹配模式
+        near_duplicate_radius (int): 近似重复的汉明距离阈值（None不去重）
+    """
+    index = ShardIndex(source_folder)
+    names = [n for n in index.names() if fnmatch.fnmatch(os.path.basename(n), pattern)]
+    
+    print(f"分片数量: {len(index.shards)}, 成员数量: {len(index)}")
+    print(f"匹配 {pattern} 的文件: {len(names)}")
+    
+    skip = near_duplicate_filter(source_folder, pattern, near_duplicate_radius)
+    if skip is not None:
+        names = [n for n in names if n not in skip]
+    
+    copied_files = 0
+    skipped_files = 0
+    for name in tqdm(names, desc="导出图片"):
+        filename = os.path.basename(name)
+        destination_file_path = os.path.join(destination_folder, filename)
+        try:
+            # 目标文件已存在时生成新的文件名避免冲突
+            base_name, ext = os.path.splitext(filename)
+            counter = 1
+            while os.path.exists(destination_file_path):
+                destination_file_path = os.path.join(destination_folder, f"{base_name}_{counter}{ext}")
+                counter += 1
+            
+            with open(destination_file_path, 'wb') as f:
+                f.write(index.read(name))
+            copied_files += 1
+        except Exception:
+            skipped_files += 1
+    index.close()
+    
+    print("\n" + "=" * 50)
+    print("操作完成！")
+    print(f"找到的文件数量: {len(names)}")
+    print(f"成功导出: {copied_files}")
+    print(f"导出失败: {skipped_files}")
+
 def main():
     """主函数 - 设置源文件夹和目标文件夹路径"""
     
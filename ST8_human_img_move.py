@@ -2,17 +2,21 @@ import json
 import os
 import shutil
 from tqdm import tqdm
+from tar_shards import ShardIndex, member_key
 
-def copy_images_from_json(json_path, target_folder):
+def copy_images_from_json(json_path, target_folder, shard_folder=None):
     """
     从JSON文件读取图片路径列表，并复制到目标文件夹
     
     参数:
     json_path (str): JSON文件路径
     target_folder (str): 目标文件夹路径
+    shard_folder (str): 提取阶段的输出文件夹（tar分片模式），磁盘上不存在的
+                        图片按文件名到分片索引中查找并直接读取
     """
     # 确保目标文件夹存在
     os.makedirs(target_folder, exist_ok=True)
+    index = ShardIndex(shard_folder) if shard_folder else None
     
     try:
         # 读取JSON文件
@@ -33,6 +37,14 @@ def copy_images_from_json(json_path, target_folder):
         
         for path in tqdm(image_paths, desc="复制图片"):
             try:
+                # 磁盘上没有时从分片中读取
+                if not os.path.exists(path) and index is not None and member_key(path) in index:
+                    target_path = os.path.join(target_folder, os.path.basename(path))
+                    with open(target_path, 'wb') as f:
+                        f.write(index.read(member_key(path)))
+                    success_count += 1
+                    continue
+                
                 # 确保路径有效
                 if not os.path.exists(path):
                     print(f"警告: 文件不存在: {path}")
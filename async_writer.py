@@ -0,0 +1,79 @@
+import os
+import asyncio
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict
+import aiofiles
+import aiofiles.os
+
+
+class AsyncFileWriter:
+    """
+    asyncio写出阶段
+
+    编码线程把编码好的字节交给write(filepath, data)，立即拿到写入字节数的
+    Future，写入在后台事件循环中用aiofiles完成。open/write/replace各自在
+    线程池中执行，网络存储（NFS）上多个文件的打开、写入、关闭延迟相互重叠，
+    而不是在编码线程中逐个串行等待。
+
+    在途写入数由有界信号量限制，达到上限时write阻塞调用方，对编码线程形成
+    背压，内存中待写的数据量有上限。与write_file_atomic一样先写临时文件再
+    原子替换，不会留下半截文件。
+    """
+
+    def __init__(self, max_in_flight: int = 64):
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._stats = {"writes": 0, "errors": 0, "max_in_flight": 0}
+        self.loop = asyncio.new_event_loop()
+        # aiofiles把阻塞调用放进事件循环的默认线程池，线程数与在途上限一致
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix="async-write")
+        self.loop.set_default_executor(self._executor)
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-writer", daemon=True)
+        self._thread.start()
+
+    async def _write(self, filepath: str, data: bytes) -> int:
+        tmp_path = f"{filepath}.{os.getpid()}.{next(self._counter)}.tmp"
+        async with aiofiles.open(tmp_path, 'wb') as f:
+            await f.write(data)
+        await aiofiles.os.replace(tmp_path, filepath)
+        return len(data)
+
+    def write(self, filepath: str, data: bytes) -> Future:
+        """提交写入（在途写入已满时阻塞），返回写入字节数的Future"""
+        self._slots.acquire()
+        with self._lock:
+            self._in_flight += 1
+            if self._in_flight > self._stats["max_in_flight"]:
+                self._stats["max_in_flight"] = self._in_flight
+        future = asyncio.run_coroutine_threadsafe(self._write(filepath, data), self.loop)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._in_flight -= 1
+            if future.exception() is None:
+                self._stats["writes"] += 1
+            else:
+                self._stats["errors"] += 1
+        self._slots.release()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["in_flight"] = self._in_flight
+        return snapshot
+
+    def close(self):
+        """等待在途写入全部完成后停止事件循环"""
+        for _ in range(self.max_in_flight):
+            self._slots.acquire()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._executor.shutdown()
+        self.loop.close()
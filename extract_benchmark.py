@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import shutil
+import platform
+import argparse
+import resource
+import subprocess
+import tempfile
+import multiprocessing
+from dataclasses import asdict
+from typing import Callable, Dict, List, Optional, Tuple
+from psd_synth import CORPUS_PRESETS, CorpusSpec, generate_corpus
+
+
+def _ultra_runner(output_folder: str) -> Tuple[Callable, Callable]:
+    import processing_folder_v3 as v3
+    from image_encoder import ImageEncoderPool
+    from image_codecs import get_codec
+
+    saver = ImageEncoderPool(v3.ENCODER_WORKERS, v3.ENCODER_QUEUE_SIZE, get_codec(v3.LAYER_CODEC))
+
+    def run(psd_path):
+        extractor = v3.UltraOptimizedPSDExtractor(psd_path, output_folder, saver)
+        return extractor.extract_ultra_optimized(), len(extractor._layers_info)
+
+    return run, saver.stop
+
+
+def _optimized_runner(output_folder: str) -> Tuple[Callable, Callable]:
+    from ST6_processing_folder_v2_final import OptimizedPSDLayerExtractor
+
+    def run(psd_path):
+        extractor = OptimizedPSDLayerExtractor(psd_path, output_folder)
+        return extractor.extract_optimized(), len(extractor.layers_info)
+
+    return run, lambda: None
+
+
+def _basic_runner(output_folder: str) -> Tuple[Callable, Callable]:
+    from processing_folder import PSDLayerExtractor
+
+    def run(psd_path):
+        extractor = PSDLayerExtractor(psd_path, output_folder)
+        return extractor.extract(), len(extractor.layers_info)
+
+    return run, lambda: None
+
+
+# 参与对比的提取器：名称 -> 初始化函数（返回 (处理单个文件, 清理)）
+VARIANTS = {
+    "ultra": _ultra_runner,          # processing_folder_v3.UltraOptimizedPSDExtractor
+    "optimized": _optimized_runner,  # ST6_processing_folder_v2_final.OptimizedPSDLayerExtractor
+    "basic": _basic_runner,          # processing_folder.PSDLayerExtractor
+}
+
+
+def folder_bytes(folder: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(folder) for f in files)
+
+
+def peak_rss_mb() -> float:
+    """当前进程的峰值常驻内存（MB）"""
+    # VmHWM按地址空间统计；ru_maxrss在exec后会保留父进程的峰值
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Linux下ru_maxrss单位为KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_variant(variant: str, psd_files: List[str], output_folder: str, queue):
+    """子进程中串行处理全部文件（独立进程，峰值RSS互不影响）"""
+    run, close = VARIANTS[variant](output_folder)
+    ok = 0
+    layers = 0
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    try:
+        for psd_path in psd_files:
+            try:
+                success, layer_count = run(psd_path)
+            except Exception as e:
+                print(f"{variant} 处理 {psd_path} 出错: {e}")
+                success, layer_count = False, 0
+            ok += bool(success)
+            layers += layer_count
+    finally:
+        close()
+    wall = time.perf_counter() - wall0
+    cpu = time.process_time() - cpu0
+    queue.put({
+        "ok": ok,
+        "layers": layers,
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+
+
+def benchmark_variant(variant: str, psd_files: List[str], work_dir: str) -> Dict:
+    """运行一个提取器，返回吞吐、峰值内存和写出字节数"""
+    output_folder = tempfile.mkdtemp(prefix=f"{variant}_", dir=work_dir)
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=_run_variant, args=(variant, psd_files, output_folder, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    result["bytes_written"] = folder_bytes(output_folder)
+    shutil.rmtree(output_folder, ignore_errors=True)
+
+    result["variant"] = variant
+    result["files"] = len(psd_files)
+    result["files_per_second"] = len(psd_files) / max(result["wall_seconds"], 1e-9)
+    result["layers_per_second"] = result["layers"] / max(result["wall_seconds"], 1e-9)
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(corpus_dir: str, presets: List[str], variants: List[str],
+                  count: Optional[int] = None, seed: int = 0, work_dir: Optional[str] = None) -> Dict:
+    """生成（或复用）语料并依次运行各提取器"""
+    work_dir = work_dir or tempfile.mkdtemp(prefix="psd_bench_")
+    runs = []
+    for name in presets:
+        spec = CORPUS_PRESETS[name]
+        if count is not None:
+            spec = CorpusSpec(**{**asdict(spec), "count": count})
+        psd_files = generate_corpus(os.path.join(corpus_dir, name), spec, seed)
+        corpus_bytes = sum(os.path.getsize(p) for p in psd_files)
+
+        for variant in variants:
+            result = benchmark_variant(variant, psd_files, work_dir)
+            result["corpus"] = name
+            result["corpus_bytes"] = corpus_bytes
+            result["spec"] = asdict(spec)
+            runs.append(result)
+            print(f"[{name}] {variant:10s} {result['files_per_second']:7.2f} files/s "
+                  f"{result['layers_per_second']:8.1f} layers/s "
+                  f"peak {result['peak_rss_mb']:7.0f} MB "
+                  f"written {result['bytes_written'] / 1024 / 1024:7.1f} MB "
+                  f"ok {result['ok']}/{result['files']}")
+
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "host": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": multiprocessing.cpu_count(),
+        },
+        "seed": seed,
+        "runs": runs,
+    }
+
+
+def compare(results: Dict, baseline: Dict):
+    """与基线结果对比（按语料+提取器匹配，显示比值）"""
+    base = {(r["corpus"], r["variant"]): r for r in baseline["runs"]}
+    print(f"\n对比基线 {baseline.get('git_commit')} -> {results.get('git_commit')}")
+    for run in results["runs"]:
+        old = base.get((run["corpus"], run["variant"]))
+        if old is None:
+            continue
+        speed = run["files_per_second"] / max(old["files_per_second"], 1e-9)
+        memory = run["peak_rss_mb"] / max(old["peak_rss_mb"], 1e-9)
+        written = run["bytes_written"] / max(old["bytes_written"], 1)
+        print(f"[{run['corpus']}] {run['variant']:10s} 速度 x{speed:.2f}  峰值内存 x{memory:.2f}  写出 x{written:.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='在合成PSD语料上对比各提取器的吞吐和内存')
+    parser.add_argument('-c', '--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'psd_bench_corpus'),
+                        help='语料文件夹（已生成的文件会复用）')
+    parser.add_argument('-p', '--presets', nargs='+', default=['small', 'mixed_kinds', 'masked'],
+                        choices=list(CORPUS_PRESETS), help='语料预设')
+    parser.add_argument('-v', '--variants', nargs='+', default=list(VARIANTS),
+                        choices=list(VARIANTS), help='提取器')
+    parser.add_argument('-n', '--count', type=int, default=None, help='覆盖每个预设的文件数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('-o', '--output', default=None, help='结果JSON路径')
+    parser.add_argument('--compare', default=None, help='基线结果JSON（例如上一个提交的结果）')
+    args = parser.parse_args()
+
+    results = run_benchmark(args.corpus_dir, args.presets, args.variants, args.count, args.seed)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,7 @@ import os
 import shutil
 import argparse
 from pathlib import Path
+from psd_dedupe import dedupe_files, unique_target_name
 
 def find_psd_files(folder_path):
     """递归查找指定文件夹中的所有PSD文件"""
@@ -12,8 +13,13 @@ def find_psd_files(folder_path):
                 psd_files.append(os.path.join(root, file))
     return psd_files
 
-def merge_psd_files(source_folder1, source_folder2, target_folder, dry_run=False):
-    """合并两个源文件夹中的PSD文件到目标文件夹，自动处理重复文件"""
+def merge_psd_files(source_folder1, source_folder2, target_folder, dry_run=False, num_workers=8):
+    """
+    合并两个源文件夹中的PSD文件到目标文件夹，自动处理重复文件
+
+    按内容去重（内容相同的文件只保留一份，优先第一个文件夹中的），
+    同名但内容不同的文件改名后都保留。
+    """
     # 确保目标文件夹存在
     os.makedirs(target_folder, exist_ok=True)
     
@@ -26,24 +32,22 @@ def merge_psd_files(source_folder1, source_folder2, target_folder, dry_run=False
     psd_files2 = find_psd_files(source_folder2)
     print(f"找到 {len(psd_files2)} 个PSD文件")
     
-    # 合并文件列表并处理重复
-    merged_files = []
-    file_names = set()
+    # 按内容去重（第一个文件夹的文件在前，重复时保留）
+    result = dedupe_files(psd_files1 + psd_files2, num_workers=num_workers)
+    for path, error in result["errors"].items():
+        print(f"读取失败 {path}: {error}")
     
-    # 先添加第一个文件夹的所有文件
-    for file_path in psd_files1:
-        file_name = os.path.basename(file_path)
-        file_names.add(file_name)
+    # 同名不同内容的文件改名，也不覆盖目标文件夹中已有的文件
+    file_names = set(os.listdir(target_folder))
+    merged_files = []
+    renamed = 0
+    for file_path in result["unique"]:
+        file_name = unique_target_name(os.path.basename(file_path), file_names)
+        renamed += file_name != os.path.basename(file_path)
         merged_files.append((file_path, file_name))
     
-    # 添加第二个文件夹中不重复的文件
-    for file_path in psd_files2:
-        file_name = os.path.basename(file_path)
-        if file_name not in file_names:
-            file_names.add(file_name)
-            merged_files.append((file_path, file_name))
-    
-    print(f"合并后共有 {len(merged_files)} 个不重复的PSD文件")
+    print(f"合并后共有 {len(merged_files)} 个不重复的PSD文件"
+          f"（内容重复 {sum(len(d) for d in result['duplicates'].values())} 个，同名改名 {renamed} 个）")
     
     # 移动文件
     if not dry_run:
@@ -69,6 +73,7 @@ def main():
     parser.add_argument('--source2', default='/storage/human_psd/hzj的殖民地/llz',help='第二个源文件夹路径')
     parser.add_argument('--target', default='/storage/human_psd/psd_tao_llz',help='目标文件夹路径')
     parser.add_argument('--dry-run',action='store_true', help='干运行模式，不实际移动文件')
+    parser.add_argument('-j', '--workers', type=int, default=8, help='哈希线程数')
     
     args = parser.parse_args()
     
@@ -81,7 +86,7 @@ def main():
         print(f"错误：源文件夹 {args.source2} 不存在")
         return
     
-    merge_psd_files(args.source1, args.source2, args.target, args.dry_run)
+    merge_psd_files(args.source1, args.source2, args.target, args.dry_run, args.workers)
 
 if __name__ == "__main__":
     main()    
\ No newline at end of file
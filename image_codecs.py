@@ -0,0 +1,171 @@
+import io
+import os
+import json
+import time
+import random
+import struct
+import argparse
+from dataclasses import dataclass, field
+from typing import Dict, List
+from PIL import Image
+
+# 原始RGBA格式：8字节魔数 + 宽 + 高 + 通道数，随后是逐行像素数据
+RAW_MAGIC = b"PSDRAW\x00\x01"
+RAW_HEADER = struct.Struct("<8sIIB3x")
+RAW_MODES = {1: "L", 3: "RGB", 4: "RGBA"}
+
+
+def encode_raw(img) -> bytes:
+    """编码为无压缩的原始像素格式（带尺寸头，供中间流程快速读写）"""
+    if img.mode not in RAW_MODES.values():
+        img = img.convert('RGBA')
+    channels = len(img.getbands())
+    return RAW_HEADER.pack(RAW_MAGIC, img.width, img.height, channels) + img.tobytes()
+
+
+def decode_raw(data: bytes):
+    """解码原始像素格式"""
+    magic, width, height, channels = RAW_HEADER.unpack_from(data)
+    if magic != RAW_MAGIC:
+        raise ValueError("不是PSDRAW格式的数据")
+    return Image.frombuffer(RAW_MODES[channels], (width, height),
+                            bytes(data[RAW_HEADER.size:]), 'raw', RAW_MODES[channels], 0, 1)
+
+
+def open_image(path: str):
+    """打开输出图片（支持原始像素格式）"""
+    if path.endswith('.raw'):
+        with open(path, 'rb') as f:
+            return decode_raw(f.read())
+    return Image.open(path)
+
+
+@dataclass
+class ImageCodec:
+    """图片编码预设"""
+    name: str
+    format: str
+    extension: str
+    params: Dict = field(default_factory=dict)
+
+    def encode(self, img) -> bytes:
+        if self.format == 'RAW':
+            return encode_raw(img)
+        if self.format == 'JPEG' and img.mode not in ('RGB', 'L'):
+            # JPEG没有透明通道（只用于预览/缩略图）
+            img = img.convert('RGB')
+        buffer = io.BytesIO()
+        img.save(buffer, format=self.format, **self.params)
+        return buffer.getvalue()
+
+    def save(self, img, filepath: str) -> int:
+        """编码并直接写入文件（同步，供不使用编码池的脚本），返回写入字节数"""
+        data = self.encode(img)
+        with open(filepath, 'wb') as f:
+            f.write(data)
+        return len(data)
+
+
+CODEC_PRESETS = {
+    # v3原有设置
+    "default": ImageCodec("default", "PNG", "png", {"optimize": True, "compress_level": 6}),
+    # Pillow默认PNG参数（processing_folder.py / processing_single_v3.py 原有设置）
+    "png": ImageCodec("png", "PNG", "png"),
+    # 低压缩级别、不做optimize，编码最快
+    "fast": ImageCodec("fast", "PNG", "png", {"compress_level": 1}),
+    # 最大压缩，适合归档
+    "archive": ImageCodec("archive", "PNG", "png", {"optimize": True, "compress_level": 9}),
+    # 无损WebP
+    "webp": ImageCodec("webp", "WEBP", "webp", {"lossless": True, "quality": 80, "method": 4}),
+    # 无压缩原始像素，适合中间流程
+    "raw": ImageCodec("raw", "RAW", "raw"),
+    # 有损JPEG，编解码最快，用于预览缩略图
+    "jpeg": ImageCodec("jpeg", "JPEG", "jpg", {"quality": 85}),
+}
+
+
+def get_codec(name: str) -> ImageCodec:
+    """按名称获取编码预设"""
+    if name not in CODEC_PRESETS:
+        raise ValueError(f"未知的编码预设: {name}，可选: {', '.join(CODEC_PRESETS)}")
+    return CODEC_PRESETS[name]
+
+
+def _collect_sample_images(psd_path: str) -> List:
+    """合成样本PSD的所有可见图层和预览图"""
+    from psd_tools import PSDImage
+
+    psd = PSDImage.open(psd_path)
+    images = []
+    for layer in psd.descendants():
+        if layer.is_group() or not layer.is_visible() or not layer.bbox:
+            continue
+        try:
+            img = layer.composite()
+        except Exception:
+            continue
+        if img:
+            images.append(img.convert('RGBA') if img.mode != 'RGBA' else img)
+    preview = psd.composite()
+    if preview:
+        images.append(preview.convert('RGB'))
+    return images
+
+
+def benchmark_codecs(psd_folder: str, sample_size: int, presets: List[str], seed: int = 0) -> Dict:
+    """在样本PSD上比较各预设的编码耗时和输出大小"""
+    psd_files = [os.path.join(root, f)
+                 for root, _, files in os.walk(psd_folder)
+                 for f in files if f.lower().endswith('.psd')]
+    random.Random(seed).shuffle(psd_files)
+    psd_files = psd_files[:sample_size]
+
+    results = {name: {"seconds": 0.0, "bytes": 0, "images": 0, "raw_bytes": 0} for name in presets}
+    for psd_path in psd_files:
+        try:
+            images = _collect_sample_images(psd_path)
+        except Exception as e:
+            print(f"跳过 {psd_path}: {e}")
+            continue
+        for name in presets:
+            codec = get_codec(name)
+            for img in images:
+                t0 = time.perf_counter()
+                data = codec.encode(img)
+                results[name]["seconds"] += time.perf_counter() - t0
+                results[name]["bytes"] += len(data)
+                results[name]["images"] += 1
+                results[name]["raw_bytes"] += img.width * img.height * len(img.getbands())
+
+    return {"psd_files": len(psd_files), "presets": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较各图片编码预设的速度和输出大小')
+    parser.add_argument('-i', '--input', default='/storage/human_psd/psd_fp_v1', help='PSD文件夹路径')
+    parser.add_argument('-n', '--sample', type=int, default=20, help='抽样的PSD数量')
+    parser.add_argument('-p', '--presets', default=','.join(CODEC_PRESETS), help='要比较的预设，逗号分隔')
+    parser.add_argument('-o', '--output', default=None, help='结果JSON保存路径（可选）')
+    args = parser.parse_args()
+
+    presets = [p.strip() for p in args.presets.split(',') if p.strip()]
+    for name in presets:
+        get_codec(name)
+
+    report = benchmark_codecs(args.input, args.sample, presets)
+
+    print(f"样本PSD数量: {report['psd_files']}")
+    print(f"{'预设':<10}{'图片数':>8}{'编码秒数':>12}{'输出MB':>12}{'压缩比':>10}{'MB/s':>10}")
+    for name, r in report["presets"].items():
+        mb = r["bytes"] / 1024 / 1024
+        ratio = r["bytes"] / r["raw_bytes"] if r["raw_bytes"] else 0
+        speed = r["raw_bytes"] / 1024 / 1024 / r["seconds"] if r["seconds"] else 0
+        print(f"{name:<10}{r['images']:>8}{r['seconds']:>12.2f}{mb:>12.2f}{ratio:>10.3f}{speed:>10.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
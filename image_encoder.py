@@ -0,0 +1,170 @@
+import os
+import time
+import bisect
+import threading
+from queue import Queue
+from functools import partial
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional, Sequence, Union
+from image_codecs import ImageCodec, get_codec
+
+# 写入延迟直方图的桶上界（秒），最后还有一个+Inf桶
+WRITE_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def write_file_atomic(filepath: str, data: bytes) -> int:
+    """先写临时文件再原子替换，避免留下半截文件"""
+    tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, filepath)
+    return len(data)
+
+
+def latency_quantile(counts: Sequence[int], q: float) -> Optional[float]:
+    """由写入延迟直方图的桶计数估算分位数（桶内线性插值，落在+Inf桶时返回最后一个上界）"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    lower = 0.0
+    for upper, count in zip(WRITE_LATENCY_BUCKETS, counts):
+        if count and cumulative + count >= rank:
+            return lower + (upper - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = upper
+    return lower
+
+
+class ImageEncoderPool:
+    """
+    多线程图片编码池
+
+    N个编码线程阻塞地从有界队列取任务（zlib压缩时会释放GIL），队列满时
+    submit会阻塞，对生产者形成背压。每个文件返回一个Future，编码或写入
+    失败时异常通过Future交回调用方。同时统计队列深度、编码耗时和写入字节数。
+    编码结果交给write(filepath, data)写出，默认原子写文件，也可以换成tar分片等。
+    write返回Future时（AsyncFileWriter）编码线程不等待写入，写入完成时再
+    结束该文件的Future，写入耗时为提交到完成的延迟。
+    提交时可传入trace(stage, wall, cpu)回调，接收该文件的encode/write耗时。
+    """
+
+    def __init__(self, num_workers: int = 4, max_queue_size: int = 32,
+                 codec: Optional[ImageCodec] = None,
+                 write: Callable[[str, bytes], Union[int, Future]] = write_file_atomic):
+        self.codec = codec or get_codec('default')
+        self.write = write
+        self.queue = Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._stats = {
+            "files": 0,
+            "errors": 0,
+            "encode_seconds": 0.0,
+            "write_seconds": 0.0,
+            "bytes_written": 0,
+            "max_queue_depth": 0,
+            "write_latency_buckets": [0] * (len(WRITE_LATENCY_BUCKETS) + 1),
+        }
+        self.workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._worker, name=f"encoder-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def _worker(self):
+        """编码线程：阻塞取任务，收到None退出"""
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                img, filepath, codec, future, trace = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    t0, c0 = time.perf_counter(), time.thread_time()
+                    data = codec.encode(img)
+                    t1, c1 = time.perf_counter(), time.thread_time()
+                    if trace is not None:
+                        trace("encode", t1 - t0, c1 - c0)
+                    with self._lock:
+                        self._stats["encode_seconds"] += t1 - t0
+                    written = self.write(filepath, data)
+                except Exception as e:
+                    self._fail(future, e)
+                    continue
+                if isinstance(written, Future):
+                    written.add_done_callback(partial(self._write_done, future, trace, t1))
+                else:
+                    t2, c2 = time.perf_counter(), time.thread_time()
+                    self._complete(future, trace, written, t2 - t1, c2 - c1)
+            finally:
+                self.queue.task_done()
+
+    def _write_done(self, future: Future, trace, started: float, written: Future):
+        """异步写入完成（在写出线程中回调）"""
+        error = written.exception()
+        if error is not None:
+            self._fail(future, error)
+        else:
+            self._complete(future, trace, written.result(), time.perf_counter() - started, 0.0)
+
+    def _complete(self, future: Future, trace, nbytes: int, wall: float, cpu: float):
+        if trace is not None:
+            trace("write", wall, cpu)
+        with self._lock:
+            self._stats["files"] += 1
+            self._stats["write_seconds"] += wall
+            self._stats["bytes_written"] += nbytes
+            self._stats["write_latency_buckets"][bisect.bisect_left(WRITE_LATENCY_BUCKETS, wall)] += 1
+        future.set_result(nbytes)
+
+    def _fail(self, future: Future, error: BaseException):
+        with self._lock:
+            self._stats["errors"] += 1
+        future.set_exception(error)
+
+    def submit(self, img, filepath: str, codec: Optional[ImageCodec] = None,
+               trace: Optional[Callable[[str, float, float], None]] = None) -> Future:
+        """提交编码任务（队列满时阻塞），返回写入字节数的Future"""
+        future = Future()
+        self.queue.put((img, filepath, codec or self.codec, future, trace))
+        depth = self.queue.qsize()
+        with self._lock:
+            if depth > self._stats["max_queue_depth"]:
+                self._stats["max_queue_depth"] = depth
+        return future
+
+    def save(self, img, filepath: str, codec: Optional[ImageCodec] = None,
+             trace: Optional[Callable[[str, float, float], None]] = None) -> Future:
+        """兼容旧的 BatchImageSaver.save 接口"""
+        return self.submit(img, filepath, codec, trace)
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def reset_peak(self):
+        """把队列深度峰值重置为当前深度（按文件统计峰值时在文件开始前调用）"""
+        with self._lock:
+            self._stats["max_queue_depth"] = self.queue.qsize()
+
+    def stats(self) -> Dict:
+        """当前统计（含实时队列深度）"""
+        with self._lock:
+            snapshot = dict(self._stats)
+            snapshot["write_latency_buckets"] = list(self._stats["write_latency_buckets"])
+        snapshot["queue_depth"] = self.queue.qsize()
+        return snapshot
+
+    def wait_completion(self):
+        """等待队列中所有任务完成（异步写出时只保证已编码并提交写入）"""
+        self.queue.join()
+
+    def stop(self):
+        """停止所有编码线程（先处理完已提交的任务）"""
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
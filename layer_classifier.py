@@ -0,0 +1,102 @@
+import os
+import time
+import argparse
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+# 颜色数少于该值的大图层视为纯色背景
+MAX_BACKGROUND_COLORS = 10
+# 抽样阶段的目标像素数
+SAMPLE_PIXELS = 65536
+# 全量校验时每次处理的行数（限制临时内存）
+CHUNK_ROWS = 512
+
+
+def pack_pixels(arr: np.ndarray) -> np.ndarray:
+    """把 (..., C) 的uint8像素（C<=4）打包成uint32，每个颜色对应唯一整数"""
+    packed = arr[..., 0].astype(np.uint32)
+    for c in range(1, arr.shape[-1]):
+        packed |= arr[..., c].astype(np.uint32) << (8 * c)
+    return packed
+
+
+def has_fewer_colors(img_array: np.ndarray, max_colors: int = MAX_BACKGROUND_COLORS) -> bool:
+    """
+    判断图像的不同颜色数是否少于max_colors
+
+    结果与 len(np.unique(img_array.reshape(-1, C), axis=0)) < max_colors 完全一致：
+    先在跨步抽样上统计颜色，超过上限直接返回；否则逐块检查全图是否
+    只包含已知颜色，遇到新颜色就加入集合，一旦达到上限立即退出。
+    """
+    if img_array.dtype != np.uint8 or img_array.ndim != 3 or img_array.shape[2] > 4:
+        flat = img_array.reshape(-1, img_array.shape[-1])
+        return len(np.unique(flat, axis=0)) < max_colors
+
+    height, width = img_array.shape[:2]
+    step = max(1, int(np.sqrt(height * width / SAMPLE_PIXELS)))
+    colors = np.unique(pack_pixels(img_array[::step, ::step]))
+    if len(colors) >= max_colors:
+        return False
+
+    for y in range(0, height, CHUNK_ROWS):
+        packed = pack_pixels(img_array[y:y + CHUNK_ROWS])
+        unknown = ~np.isin(packed, colors)
+        if unknown.any():
+            colors = np.union1d(colors, np.unique(packed[unknown]))
+            if len(colors) >= max_colors:
+                return False
+    return True
+
+
+def count_colors_reference(img_array: np.ndarray) -> int:
+    """原实现：对全图像素做 np.unique（用于回归校验）"""
+    flat = img_array.reshape(-1, img_array.shape[2])
+    return len(np.unique(flat, axis=0))
+
+
+def verify(folder: str, max_colors: int = MAX_BACKGROUND_COLORS):
+    """在图层图片目录上对比新旧实现的结果和耗时"""
+    files = [os.path.join(root, f)
+             for root, _, names in os.walk(folder)
+             for f in names if f.lower().endswith('.png')]
+
+    mismatches = []
+    fast_seconds = 0.0
+    reference_seconds = 0.0
+    for path in tqdm(files, desc="校验图层"):
+        img_array = np.asarray(Image.open(path))
+        if img_array.ndim < 3 or img_array.shape[2] < 3:
+            continue
+
+        t0 = time.perf_counter()
+        fast = has_fewer_colors(img_array, max_colors)
+        t1 = time.perf_counter()
+        reference = count_colors_reference(img_array) < max_colors
+        t2 = time.perf_counter()
+
+        fast_seconds += t1 - t0
+        reference_seconds += t2 - t1
+        if fast != reference:
+            mismatches.append(path)
+
+    print(f"图片数量: {len(files)}")
+    print(f"np.unique 耗时: {reference_seconds:.2f}s")
+    print(f"抽样+提前退出 耗时: {fast_seconds:.2f}s")
+    print(f"结果不一致: {len(mismatches)}")
+    for path in mismatches:
+        print(f"  - {path}")
+    return not mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='校验纯色背景判断与原 np.unique 实现的一致性')
+    parser.add_argument('folder', help='图层PNG所在文件夹（递归）')
+    parser.add_argument('--max-colors', type=int, default=MAX_BACKGROUND_COLORS, help='颜色数上限')
+    args = parser.parse_args()
+
+    verify(args.folder, args.max_colors)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence
+import numpy as np
+
+# 数据集分片目录（放在输出文件夹根目录）
+DATASET_DIRNAME = "_dataset"
+
+# 每个文档一行
+DOC_COLUMNS = {
+    "id": str,
+    "canvas_width": np.int32,
+    "canvas_height": np.int32,
+    "preview_path": str,
+    "preview_thumbs": str,  # 预览金字塔 {尺寸: 文件名} 的JSON文本
+    "layer_count": np.int32,
+}
+# 每个图层一行，id列指向所属文档；列名与 {id}_layers.json 中的键一致
+LAYER_COLUMNS = {
+    "id": str,
+    "z": np.int32,
+    "type": np.int8,
+    "left": np.int32,
+    "top": np.int32,
+    "width": np.int32,
+    "height": np.int32,
+    "image_path": str,
+    "layer_names": str,
+    "dhash": np.uint64,  # 图层感知哈希（LAYER_PHASH关闭或早期分片为0）
+    "phash": np.uint64,
+}
+DOC_PREFIX = "doc."
+LAYER_PREFIX = "layer."
+JOURNAL_SUFFIX = ".jsonl"
+
+
+def _to_array(values: List, kind) -> np.ndarray:
+    if kind is str:
+        return np.array(values, dtype=str) if values else np.array([], dtype='<U1')
+    return np.array(values, dtype=kind)
+
+
+def _empty_columns():
+    return {name: [] for name in DOC_COLUMNS}, {name: [] for name in LAYER_COLUMNS}
+
+
+def _append_document(docs: Dict[str, List], layers: Dict[str, List], document: Dict):
+    """把一个文档（{id}_layers.json 的同结构字典）追加到按列累积的列表中"""
+    doc_id = document["id"]
+    count = len(document["z"])
+    docs["id"].append(doc_id)
+    docs["canvas_width"].append(document["canvas_width"])
+    docs["canvas_height"].append(document["canvas_height"])
+    docs["preview_path"].append(document.get("preview_path") or "")
+    docs["preview_thumbs"].append(json.dumps(document.get("preview_thumbs") or {}, separators=(',', ':')))
+    docs["layer_count"].append(count)
+    layers["id"].extend([doc_id] * count)
+    for name in LAYER_COLUMNS:
+        if name != "id":
+            layers[name].extend(document.get(name) or [0] * count)
+
+
+def _columns_to_arrays(docs: Dict[str, List], layers: Dict[str, List]):
+    return ({name: _to_array(docs[name], kind) for name, kind in DOC_COLUMNS.items()},
+            {name: _to_array(layers[name], kind) for name, kind in LAYER_COLUMNS.items()})
+
+
+def read_journal(journal_path: str) -> List[Dict]:
+    """读取日志中的文档（进程写到一半被终止时最后一行不完整，跳过）"""
+    documents = []
+    with open(journal_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                documents.append(json.loads(line))
+            except ValueError:
+                continue
+    return documents
+
+
+def _write_shard(folder: str, name: str, format: str, docs: Dict[str, np.ndarray],
+                 layers: Dict[str, np.ndarray]):
+    """写一个分片（先写临时文件再改名）"""
+    if format == 'npz':
+        arrays = {DOC_PREFIX + k: v for k, v in docs.items()}
+        arrays.update({LAYER_PREFIX + k: v for k, v in layers.items()})
+        path = os.path.join(folder, f"{name}.npz")
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        return
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    # 图层表最后写，它存在即表示整个分片完整
+    for suffix, table in ((".docs.parquet", docs), (".layers.parquet", layers)):
+        path = os.path.join(folder, f"{name}{suffix}")
+        tmp_path = f"{path}.tmp"
+        pq.write_table(pa.table(table), tmp_path)
+        os.replace(tmp_path, path)
+
+
+class LayerDatasetWriter:
+    """
+    图层元数据的列式分片写入器（替代每个PSD一个 {id}_layers.json）
+
+    每个进程一个写入器，文档先在内存中按列累积，满 docs_per_shard 个后写成
+    一个分片：npz（文档表和图层表的各列，键名加 doc./layer. 前缀）或parquet
+    （需要pyarrow，文档表和图层表各一个文件）。分片名包含创建时间、主机名和
+    进程号，按文件名排序即写入顺序，同一id出现多次时读取方保留最后一次。
+
+    每个文档在append返回前先追加到分片同名的日志 {分片名}.jsonl 并fsync，
+    append返回该日志的相对路径，记入清单的输出文件列表：工作进程在分片写出前
+    被回收或终止时，已完成的文档仍在日志中，读取方对没有对应分片的日志直接
+    读取（或用 compact_journals 补写分片）。分片写出后日志清空，只保留空文件
+    作为清单的输出标记。
+    """
+
+    def __init__(self, output_folder: str, docs_per_shard: int = 500, format: str = 'npz'):
+        if format not in ('npz', 'parquet'):
+            raise ValueError(f"Unknown dataset format: {format}")
+        self.output_folder = output_folder
+        self.folder = os.path.join(output_folder, DATASET_DIRNAME)
+        self.docs_per_shard = docs_per_shard
+        self.format = format
+        self._lock = threading.Lock()
+        self._shard_name = None
+        self._journal = None
+        self._docs, self._layers = _empty_columns()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def _new_shard_name(self) -> str:
+        return f"part-{time.time_ns()}-{socket.gethostname()}-{os.getpid()}"
+
+    def append(self, document: Dict) -> str:
+        """添加一个文档（{id}_layers.json 的同结构字典），落盘到日志后返回日志相对输出文件夹的路径"""
+        line = json.dumps(document, ensure_ascii=False, separators=(',', ':'), default=int) + "\n"
+        with self._lock:
+            if self._shard_name is None:
+                self._shard_name = self._new_shard_name()
+                self._journal = open(os.path.join(self.folder, self._shard_name + JOURNAL_SUFFIX),
+                                     'a', encoding='utf-8')
+            journal_path = os.path.join(DATASET_DIRNAME, self._shard_name + JOURNAL_SUFFIX)
+            self._journal.write(line)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+            _append_document(self._docs, self._layers, document)
+            if len(self._docs["id"]) >= self.docs_per_shard:
+                self._flush_locked()
+            return journal_path
+
+    def _flush_locked(self):
+        if not self._docs["id"]:
+            return
+        docs, layers = _columns_to_arrays(self._docs, self._layers)
+        _write_shard(self.folder, self._shard_name, self.format, docs, layers)
+        # 分片已完整写出，日志内容不再需要
+        self._journal.truncate(0)
+        self._journal.close()
+        self._journal = None
+        self._docs, self._layers = _empty_columns()
+        self._shard_name = None
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked()
+
+    def close(self):
+        self.flush()
+
+
+def _shard_base(filename: str) -> Optional[str]:
+    for suffix in (".npz", ".layers.parquet", JOURNAL_SUFFIX):
+        if filename.endswith(suffix) and not filename.endswith(".tmp.npz"):
+            return filename[:-len(suffix)]
+    return None
+
+
+def list_shards(dataset_folder: str) -> List[str]:
+    """
+    按写入顺序列出分片（npz文件或parquet分片的图层表）
+
+    没有对应分片的非空日志（写入进程在分片写出前退出）也作为分片返回。
+    """
+    if not os.path.isdir(dataset_folder):
+        return []
+    shards, journals = {}, {}
+    for f in os.listdir(dataset_folder):
+        base = _shard_base(f)
+        if base is None or f.endswith('.docs.parquet'):
+            continue
+        if f.endswith(JOURNAL_SUFFIX):
+            journals[base] = f
+        else:
+            shards[base] = f
+    for base, f in journals.items():
+        if base not in shards and os.path.getsize(os.path.join(dataset_folder, f)) > 0:
+            shards[base] = f
+    return [os.path.join(dataset_folder, shards[base]) for base in sorted(shards)]
+
+
+def compact_journals(dataset_folder: str, min_age_seconds: float = 3600, format: str = 'npz') -> List[str]:
+    """
+    把没有对应分片的日志补写成分片，返回写出的分片路径
+
+    只处理超过min_age_seconds未修改的日志（写入进程已退出），正在写入的日志不动。
+    """
+    written = []
+    now = time.time()
+    for path in list_shards(dataset_folder):
+        if not path.endswith(JOURNAL_SUFFIX) or now - os.path.getmtime(path) < min_age_seconds:
+            continue
+        docs, layers = _empty_columns()
+        for document in read_journal(path):
+            _append_document(docs, layers, document)
+        if docs["id"]:
+            name = os.path.basename(path)[:-len(JOURNAL_SUFFIX)]
+            _write_shard(dataset_folder, name, format, *_columns_to_arrays(docs, layers))
+            written.append(os.path.join(dataset_folder, f"{name}.npz" if format == 'npz' else f"{name}.layers.parquet"))
+        # 与写入器一致：保留空日志作为清单的输出标记
+        with open(path, 'r+') as f:
+            f.truncate(0)
+    return written
+
+
+def read_shard(shard_path: str, doc_columns: Optional[Sequence[str]] = None,
+               layer_columns: Optional[Sequence[str]] = None):
+    """读取一个分片，返回 (文档表, 图层表)，只加载需要的列（文档表总是包含id和layer_count）"""
+    doc_columns = list(dict.fromkeys(["id", "layer_count"] + list(doc_columns or DOC_COLUMNS)))
+    layer_columns = list(layer_columns or LAYER_COLUMNS)
+    if shard_path.endswith(JOURNAL_SUFFIX):
+        docs, layers = _empty_columns()
+        for document in read_journal(shard_path):
+            _append_document(docs, layers, document)
+        docs, layers = _columns_to_arrays(docs, layers)
+        docs = {name: docs[name] for name in doc_columns}
+        layers = {name: layers[name] for name in layer_columns}
+    elif shard_path.endswith('.npz'):
+        with np.load(shard_path) as data:
+            docs = {name: data[DOC_PREFIX + name] for name in doc_columns if DOC_PREFIX + name in data}
+            layers = {name: data[LAYER_PREFIX + name] for name in layer_columns if LAYER_PREFIX + name in data}
+    else:
+        import pyarrow.parquet as pq
+        docs_path = shard_path[:-len('.layers.parquet')] + '.docs.parquet'
+        available = set(pq.read_schema(docs_path).names)
+        docs_table = pq.read_table(docs_path, columns=[c for c in doc_columns if c in available])
+        available = set(pq.read_schema(shard_path).names)
+        layers_table = pq.read_table(shard_path, columns=[c for c in layer_columns if c in available])
+        docs = {name: docs_table.column(name).to_numpy(zero_copy_only=False) for name in docs_table.column_names}
+        layers = {name: layers_table.column(name).to_numpy(zero_copy_only=False)
+                  for name in layers_table.column_names}
+
+    # 早期分片没有的列补空值，保证各分片可以拼接
+    for table, columns, schema in ((docs, doc_columns, DOC_COLUMNS), (layers, layer_columns, LAYER_COLUMNS)):
+        rows = len(docs["id"]) if table is docs else int(docs["layer_count"].sum())
+        for name in columns:
+            if name not in table:
+                kind = schema[name]
+                table[name] = np.full(rows, "" if kind is str else 0, dtype=str if kind is str else kind)
+    return docs, layers
+
+
+def read_dataset(dataset_folder: str, doc_columns: Optional[Sequence[str]] = None,
+                 layer_columns: Optional[Sequence[str]] = None):
+    """
+    读取并拼接所有分片，返回 (文档表, 图层表)
+
+    同一id在多个分片中出现时（重新处理过的PSD）只保留最后写入的一份。
+    文档表附带layer_offset列，图层表中第i个文档的图层为
+    [layer_offset[i], layer_offset[i] + layer_count[i])。
+    """
+    shards = [read_shard(p, doc_columns, layer_columns) for p in list_shards(dataset_folder)]
+    if not shards:
+        return None, None
+
+    docs = {name: np.concatenate([s[0][name] for s in shards]) for name in shards[0][0]}
+    layers = {name: np.concatenate([s[1][name] for s in shards]) for name in shards[0][1]}
+
+    # 保留每个id最后一次出现
+    ids = docs["id"]
+    _, last_from_end = np.unique(ids[::-1], return_index=True)
+    keep_docs = np.zeros(len(ids), dtype=bool)
+    keep_docs[len(ids) - 1 - last_from_end] = True
+    if not keep_docs.all():
+        keep_layers = np.repeat(keep_docs, docs["layer_count"])
+        docs = {name: col[keep_docs] for name, col in docs.items()}
+        layers = {name: col[keep_layers] for name, col in layers.items()}
+
+    counts = docs["layer_count"].astype(np.int64)
+    docs["layer_offset"] = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+    return docs, layers
+
+
+def iter_documents(docs: Dict[str, np.ndarray], layers: Dict[str, np.ndarray]) -> Iterator[Dict]:
+    """把列式数据还原为 {id}_layers.json 同结构的字典"""
+    layer_names = [name for name in LAYER_COLUMNS if name != "id" and name in layers]
+    for i in range(len(docs["id"])):
+        start = int(docs["layer_offset"][i])
+        end = start + int(docs["layer_count"][i])
+        document = {"id": str(docs["id"][i])}
+        for name in ("canvas_width", "canvas_height", "preview_path"):
+            if name in docs:
+                value = docs[name][i]
+                document[name] = value.item() if hasattr(value, 'item') else value
+        if "preview_thumbs" in docs:
+            document["preview_thumbs"] = json.loads(str(docs["preview_thumbs"][i]) or "{}")
+        for name in layer_names:
+            document[name] = layers[name][start:end].tolist()
+        yield document
+
+
+def select_preview(document: Dict, min_long_side: int) -> Optional[str]:
+    """
+    返回长边不小于min_long_side的最小预览文件名（相对PSD输出文件夹）
+
+    没有足够大的缩略图时返回原尺寸预览，只在确实需要时才解码整张预览图。
+    """
+    thumbs = document.get("preview_thumbs") or {}
+    for size in sorted(thumbs, key=int):
+        if int(size) >= min_long_side:
+            return thumbs[size]
+    return document.get("preview_path")
+
+
+def save_merged(output_file: str, docs: Dict[str, np.ndarray], layers: Dict[str, np.ndarray]):
+    """把拼接后的数据集保存为单个npz（或parquet：文档表和图层表各一个文件）"""
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+    if output_file.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        base = output_file[:-len('.parquet')]
+        pq.write_table(pa.table(docs), f"{base}.docs.parquet")
+        pq.write_table(pa.table(layers), f"{base}.layers.parquet")
+        return
+    arrays = {DOC_PREFIX + k: v for k, v in docs.items()}
+    arrays.update({LAYER_PREFIX + k: v for k, v in layers.items()})
+    np.savez(output_file, **arrays)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='把写入进程异常退出后留下的数据集日志补写成分片')
+    parser.add_argument('output_folder', help='输出文件夹（包含 _dataset）')
+    parser.add_argument('--min-age', type=float, default=3600, help='只处理超过该秒数未修改的日志')
+    parser.add_argument('--format', choices=('npz', 'parquet'), default='npz', help='分片格式')
+    args = parser.parse_args()
+
+    written = compact_journals(os.path.join(args.output_folder, DATASET_DIRNAME), args.min_age, args.format)
+    print(f"写出 {len(written)} 个分片")
+    for path in written:
+        print(f"  {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,436 @@
+import os
+import json
+import fnmatch
+import hashlib
+import argparse
+import itertools
+from multiprocessing import Pool
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+from PIL import Image
+from image_codecs import open_image
+
+# 感知哈希索引文件（放在输出文件夹根目录）
+INDEX_FILENAME = "_phash_index.npz"
+IMAGE_EXTENSIONS = ('.png', '.webp', '.jpg', '.raw')
+HASH_GRID = 8  # 8x8 = 64位哈希
+DCT_SIZE = 32  # pHash在32x32灰度图上做DCT
+DEFAULT_RADIUS = 10  # 汉明距离不超过该值视为近似重复（无关图像一般在25以上）
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m.astype(np.float32)
+
+
+def _pool_matrix(n: int, groups: int) -> np.ndarray:
+    """把n列按区域平均缩成groups列的矩阵 (n, groups)"""
+    m = np.zeros((n, groups), dtype=np.float32)
+    for g, cols in enumerate(np.array_split(np.arange(n), groups)):
+        m[cols, g] = 1.0 / len(cols)
+    return m
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+_DHASH_ROWS = _pool_matrix(DCT_SIZE, HASH_GRID)
+_DHASH_COLS = _pool_matrix(DCT_SIZE, HASH_GRID + 1)
+
+
+def _pack_bits(bits: np.ndarray) -> np.ndarray:
+    """(N, 64) bool -> (N,) uint64，第一位为最高位"""
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def gray_thumbnail(img) -> np.ndarray:
+    """
+    哈希用的32x32灰度缩略图
+
+    透明图层先裁到不透明区域（同一素材在不同模板中的透明边距不影响哈希），
+    缩小后再以白色为底去掉透明通道，只在小图上做颜色转换。
+    """
+    if img.mode in ('RGBA', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+        bbox = img.getchannel('A').getbbox()
+        if bbox:
+            img = img.crop(bbox)
+        small = img.resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR, reducing_gap=2.0)
+        flat = Image.new('RGB', small.size, (255, 255, 255))
+        flat.paste(small, mask=small.getchannel('A'))
+        small = flat
+    else:
+        small = img.resize((DCT_SIZE, DCT_SIZE), Image.BILINEAR, reducing_gap=2.0)
+    return np.asarray(small.convert('L'), dtype=np.float32)
+
+
+def dhash_batch(grays: np.ndarray) -> np.ndarray:
+    """差值哈希：(N, 32, 32) -> (N,) uint64，缩到8x9后比较水平相邻像素"""
+    n = grays.shape[0]
+    # 区域平均缩到 8行 x 9列
+    small = np.einsum('ri,nij,jc->nrc', _DHASH_ROWS.T, grays, _DHASH_COLS)
+    bits = small[:, :, 1:] > small[:, :, :-1]
+    return _pack_bits(bits.reshape(n, -1))
+
+
+def phash_batch(grays: np.ndarray) -> np.ndarray:
+    """DCT哈希：(N, 32, 32) -> (N,) uint64，取左上8x8低频系数与其中位数（不含直流分量）比较"""
+    n = grays.shape[0]
+    coeffs = np.einsum('ij,njk,lk->nil', _DCT, grays, _DCT)[:, :HASH_GRID, :HASH_GRID].reshape(n, -1)
+    median = np.median(coeffs[:, 1:], axis=1, keepdims=True)
+    return _pack_bits(coeffs > median)
+
+
+def image_hashes(img) -> Tuple[int, int]:
+    """单张图像的 (dHash, pHash)"""
+    gray = gray_thumbnail(img)[None]
+    return int(dhash_batch(gray)[0]), int(phash_batch(gray)[0])
+
+
+def hamming(hashes: np.ndarray, h) -> np.ndarray:
+    """hashes中每个值与h的汉明距离"""
+    return np.bitwise_count(np.bitwise_xor(hashes, np.uint64(h))).astype(np.int32)
+
+
+class MultiIndexHash:
+    """
+    多索引哈希（MIH）：64位哈希分成m段，每段各建一个有序表
+
+    汉明距离不超过r的两个哈希至少有一段的距离不超过 r // m（鸽巢原理），
+    查询时在每段表里用searchsorted查出与该段距离不超过 r // m 的所有桶，
+    合并候选后再用完整汉明距离校验，不需要两两比较。
+    """
+
+    def __init__(self, hashes: np.ndarray, chunks: int = 4):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.chunks = chunks
+        self.chunk_bits = 64 // chunks
+        self.mask = (1 << self.chunk_bits) - 1
+        self._tables = []
+        for j in range(chunks):
+            values = ((self.hashes >> np.uint64(j * self.chunk_bits)) & np.uint64(self.mask)).astype(np.int64)
+            order = np.argsort(values, kind='stable')
+            self._tables.append((values[order], order))
+        self._flip_masks = {}
+
+    def _flips(self, radius: int) -> np.ndarray:
+        """段内距离不超过radius的所有翻转掩码"""
+        if radius not in self._flip_masks:
+            masks = [0]
+            for r in range(1, radius + 1):
+                for bits in itertools.combinations(range(self.chunk_bits), r):
+                    masks.append(sum(1 << b for b in bits))
+            self._flip_masks[radius] = np.array(masks, dtype=np.int64)
+        return self._flip_masks[radius]
+
+    def query(self, h, radius: int) -> Tuple[np.ndarray, np.ndarray]:
+        """返回与h距离不超过radius的 (行号, 距离)"""
+        flips = self._flips(radius // self.chunks)
+        h = int(h)
+        candidates = []
+        for j, (values, order) in enumerate(self._tables):
+            keys = ((h >> (j * self.chunk_bits)) & self.mask) ^ flips
+            lo = np.searchsorted(values, keys, 'left')
+            hi = np.searchsorted(values, keys, 'right')
+            for a, b in zip(lo[hi > lo], hi[hi > lo]):
+                candidates.append(order[a:b])
+        if not candidates:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int32)
+        ids = np.unique(np.concatenate(candidates))
+        distances = hamming(self.hashes[ids], h)
+        keep = distances <= radius
+        return ids[keep], distances[keep]
+
+
+def cluster_hashes(hashes: np.ndarray, radius: int = DEFAULT_RADIUS,
+                   priority: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    近似重复聚类，返回每行所属簇的代表行号
+
+    按priority从高到低（默认按行号）依次处理：尚未归簇的图像成为代表，
+    与它距离不超过radius且尚未归簇的图像归入该簇。以代表为中心聚类，
+    不会像单链接那样沿着相似链把差别很大的图像连成一簇。
+    """
+    index = MultiIndexHash(hashes)
+    order = np.argsort(-priority, kind='stable') if priority is not None else np.arange(len(hashes))
+    cluster = np.full(len(hashes), -1, dtype=np.int64)
+    for i in order:
+        if cluster[i] >= 0:
+            continue
+        ids, _ = index.query(hashes[i], radius)
+        ids = ids[cluster[ids] < 0]
+        cluster[ids] = i
+        cluster[i] = i
+    return cluster
+
+
+def _member_name(file_id: str, image_path: str) -> str:
+    """图层图片相对输出文件夹的路径（与tar分片成员名一致）"""
+    return os.path.normpath(os.path.join(file_id, image_path)).replace(os.sep, '/')
+
+
+def _metadata_records(output_folder: str) -> List[Dict]:
+    """从提取阶段的元数据（数据集分片或 {id}_layers.json）读取图层记录和已计算的哈希"""
+    from layer_dataset import DATASET_DIRNAME, read_dataset
+    from tar_shards import SHARDS_DIRNAME, ShardIndex
+
+    records = []
+
+    def add(file_id, document):
+        count = len(document.get("image_path", []))
+        dhashes = document.get("dhash") or [0] * count
+        phashes = document.get("phash") or [0] * count
+        for i in range(count):
+            records.append({
+                "name": _member_name(file_id, document["image_path"][i]),
+                "width": int(document["width"][i]),
+                "height": int(document["height"][i]),
+                "dhash": int(dhashes[i]),
+                "phash": int(phashes[i]),
+            })
+
+    dataset_folder = os.path.join(output_folder, DATASET_DIRNAME)
+    if os.path.isdir(dataset_folder):
+        docs, layers = read_dataset(dataset_folder, ["id"], ["id", "image_path", "width", "height",
+                                                              "dhash", "phash"])
+        if docs is not None:
+            for i in range(len(layers["id"])):
+                records.append({
+                    "name": _member_name(str(layers["id"][i]), str(layers["image_path"][i])),
+                    "width": int(layers["width"][i]),
+                    "height": int(layers["height"][i]),
+                    "dhash": int(layers["dhash"][i]),
+                    "phash": int(layers["phash"][i]),
+                })
+            return records
+
+    if os.path.isdir(os.path.join(output_folder, SHARDS_DIRNAME)):
+        index = ShardIndex(output_folder)
+        for name in index.names():
+            if name.endswith('_layers.json'):
+                document = json.loads(index.read(name))
+                add(document["id"], document)
+        index.close()
+        return records
+
+    for root, _, files in os.walk(output_folder):
+        for f in files:
+            if f.endswith('_layers.json'):
+                with open(os.path.join(root, f), 'r', encoding='utf-8') as fp:
+                    document = json.load(fp)
+                add(os.path.relpath(root, output_folder), document)
+    return records
+
+
+_reader = None
+
+
+def _init_reader(folder: str, use_shards: bool):
+    global _reader
+    if use_shards:
+        from tar_shards import ShardIndex
+        _reader = ShardIndex(folder)
+    else:
+        _reader = folder
+
+
+def _hash_member(name: str) -> Tuple[str, int, int, int, int]:
+    """在工作进程中解码图片并计算哈希，返回 (名称, 宽, 高, dHash, pHash)，失败时宽高为0"""
+    try:
+        if isinstance(_reader, str):
+            img = open_image(os.path.join(_reader, name))
+        else:
+            img = _reader.open_image(name)
+        img.draft('RGB', (DCT_SIZE * 4, DCT_SIZE * 4))  # 只对JPEG生效：按1/2~1/8比例解码
+        width, height = img.size
+        dhash, phash = image_hashes(img)
+        return name, width, height, dhash, phash
+    except Exception:
+        return name, 0, 0, 0, 0
+
+
+def list_records(folder: str, pattern: Optional[str] = None) -> List[Dict]:
+    """
+    列出要建索引的图片记录（名称、宽高、已有哈希、文件大小和修改时间）
+
+    提取输出文件夹从元数据读取（提取时已计算的哈希一并带上），普通图片文件夹
+    遍历目录。tar分片的成员不可变，修改时间记为0、大小取成员大小。
+    元数据中有记录但文件不存在的图片不包含在内。
+    """
+    from tar_shards import SHARDS_DIRNAME, ShardIndex
+
+    use_shards = os.path.isdir(os.path.join(folder, SHARDS_DIRNAME))
+    records = _metadata_records(folder)
+    shard_index = ShardIndex(folder) if use_shards else None
+    try:
+        if not records:
+            # 普通图片文件夹
+            if use_shards:
+                names = [n for n in shard_index.names() if n.lower().endswith(IMAGE_EXTENSIONS)]
+            else:
+                names = [os.path.relpath(os.path.join(root, f), folder).replace(os.sep, '/')
+                         for root, _, files in os.walk(folder)
+                         for f in files if f.lower().endswith(IMAGE_EXTENSIONS)]
+            records = [{"name": n, "width": 0, "height": 0, "dhash": 0, "phash": 0} for n in names]
+
+        if pattern:
+            records = [r for r in records if fnmatch.fnmatch(os.path.basename(r["name"]), pattern)]
+
+        result = []
+        for r in records:
+            try:
+                if shard_index is not None:
+                    r.update(size=shard_index.locate(r["name"])[2], mtime_ns=0)
+                else:
+                    st = os.stat(os.path.join(folder, r["name"]))
+                    r.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+            except (OSError, KeyError):
+                continue
+            result.append(r)
+        return result
+    finally:
+        if shard_index is not None:
+            shard_index.close()
+
+
+def records_fingerprint(records: List[Dict]) -> str:
+    """图片集合的指纹（名称、大小、修改时间），图片增删或被覆盖时改变"""
+    h = hashlib.blake2b(digest_size=16)
+    for r in sorted(records, key=lambda r: r["name"]):
+        h.update(f"{r['name']}\t{r['size']}\t{r['mtime_ns']}\n".encode('utf-8'))
+    return h.hexdigest()
+
+
+def build_index(folder: str, pattern: Optional[str] = None, radius: int = DEFAULT_RADIUS,
+                method: str = 'phash', num_workers: int = 8,
+                previous: Optional[Dict[str, np.ndarray]] = None,
+                records: Optional[List[Dict]] = None) -> Dict[str, np.ndarray]:
+    """
+    为输出文件夹（或任意图片文件夹）的图层图片建立感知哈希索引并聚类
+
+    提取时已计算哈希（LAYER_PHASH）的图层直接从元数据读取，其余图片
+    （或没有元数据的普通图片文件夹）在多进程中解码计算；previous为旧索引时，
+    名称、大小和修改时间都没变的图片沿用旧哈希，只计算新增或改变的图片。
+    pattern按文件名过滤（如 "*_2_*.png"）。簇代表取簇内面积最大的图像。
+    """
+    from tar_shards import SHARDS_DIRNAME
+
+    use_shards = os.path.isdir(os.path.join(folder, SHARDS_DIRNAME))
+    if records is None:
+        records = list_records(folder, pattern)
+
+    if previous is not None and "size" in previous:
+        old = {name: i for i, name in enumerate(previous["name"].tolist())}
+        for r in records:
+            i = old.get(r["name"])
+            if (i is not None and r["dhash"] == 0 and r["phash"] == 0
+                    and int(previous["size"][i]) == r["size"] and int(previous["mtime_ns"][i]) == r["mtime_ns"]):
+                r.update(width=int(previous["width"][i]), height=int(previous["height"][i]),
+                         dhash=int(previous["dhash"][i]), phash=int(previous["phash"][i]))
+
+    missing = [r["name"] for r in records if r["dhash"] == 0 and r["phash"] == 0]
+    if missing:
+        from tqdm import tqdm
+        by_name = {r["name"]: r for r in records}
+        failed = set()
+        with Pool(num_workers, initializer=_init_reader, initargs=(folder, use_shards)) as pool:
+            for name, width, height, dhash, phash in tqdm(pool.imap(_hash_member, missing, chunksize=16),
+                                                          total=len(missing), desc="计算感知哈希"):
+                if not width:
+                    failed.add(name)
+                    continue
+                by_name[name].update(width=width, height=height, dhash=dhash, phash=phash)
+        if failed:
+            # 无法解码的图片不参与聚类（哈希为0会被聚成一簇）
+            print(f"跳过无法解码的图片: {len(failed)}")
+            records = [r for r in records if r["name"] not in failed]
+
+    columns = {
+        "name": np.array([r["name"] for r in records], dtype=str),
+        "width": np.array([r["width"] for r in records], dtype=np.int32),
+        "height": np.array([r["height"] for r in records], dtype=np.int32),
+        "dhash": np.array([r["dhash"] for r in records], dtype=np.uint64),
+        "phash": np.array([r["phash"] for r in records], dtype=np.uint64),
+        "size": np.array([r["size"] for r in records], dtype=np.int64),
+        "mtime_ns": np.array([r["mtime_ns"] for r in records], dtype=np.int64),
+    }
+    area = columns["width"].astype(np.int64) * columns["height"].astype(np.int64)
+    columns["cluster"] = (cluster_hashes(columns[method], radius, area) if records
+                          else np.array([], dtype=np.int64))
+    return columns
+
+
+def save_index(path: str, columns: Dict[str, np.ndarray]):
+    tmp_path = f"{path}.tmp.npz"
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+def load_index(path: str) -> Dict[str, np.ndarray]:
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
+
+
+def representatives(columns: Dict[str, np.ndarray]) -> Set[str]:
+    """每个簇的代表图片名称"""
+    is_rep = columns["cluster"] == np.arange(len(columns["cluster"]))
+    return set(columns["name"][is_rep].tolist())
+
+
+def near_duplicates(columns: Dict[str, np.ndarray]) -> Set[str]:
+    """
+    可以跳过的近似重复图片名称（各簇中代表以外的图片）
+
+    过滤时应排除这个集合，而不是只保留代表：索引里没有的图片（无法解码等）不应被当作重复丢弃。
+    """
+    is_rep = columns["cluster"] == np.arange(len(columns["cluster"]))
+    return set(columns["name"][~is_rep].tolist())
+
+
+def load_or_build_index(folder: str, pattern: Optional[str] = None, radius: int = DEFAULT_RADIUS,
+                        num_workers: int = 8) -> Dict[str, np.ndarray]:
+    """
+    读取文件夹下已有的索引
+
+    参数不同或图片集合的指纹变了（新增、删除或覆盖了图片）时更新并保存：
+    指纹变化时沿用未变图片的哈希，只为新图片计算哈希后重新聚类。
+    """
+    path = os.path.join(folder, INDEX_FILENAME)
+    records = list_records(folder, pattern)
+    fingerprint = records_fingerprint(records)
+    previous = None
+    if os.path.exists(path):
+        previous = load_index(path)
+        if (str(previous.get("pattern", "")) == (pattern or "") and int(previous.get("radius", -1)) == radius
+                and str(previous.get("fingerprint", "")) == fingerprint):
+            return previous
+    columns = build_index(folder, pattern, radius, num_workers=num_workers, previous=previous, records=records)
+    columns["pattern"] = np.array(pattern or "")
+    columns["radius"] = np.array(radius)
+    columns["fingerprint"] = np.array(fingerprint)
+    save_index(path, columns)
+    return columns
+
+
+def main():
+    parser = argparse.ArgumentParser(description='为图层图片建立感知哈希索引，聚类近似重复图片')
+    parser.add_argument('folder', help='提取输出文件夹或图片文件夹')
+    parser.add_argument('-p', '--pattern', default=None, help='文件名过滤，如 "*_2_*.png"')
+    parser.add_argument('-r', '--radius', type=int, default=DEFAULT_RADIUS, help='近似重复的最大汉明距离')
+    parser.add_argument('-j', '--workers', type=int, default=8, help='解码进程数')
+    args = parser.parse_args()
+
+    columns = load_or_build_index(args.folder, args.pattern, args.radius, args.workers)
+    total = len(columns["name"])
+    reps = representatives(columns)
+    sizes = np.bincount(columns["cluster"]) if total else np.array([])
+    print(f"图片: {total}，簇: {len(reps)}，可跳过的近似重复: {total - len(reps)}")
+    for rep in np.argsort(-sizes)[:5] if total else []:
+        if sizes[rep] > 1:
+            print(f"  {sizes[rep]:5d} × {columns['name'][rep]}")
+    print(f"索引已保存: {os.path.join(args.folder, INDEX_FILENAME)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+# 默认缓存上限（字节）
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+def image_nbytes(img) -> int:
+    """估算PIL图像占用的字节数"""
+    if img is None:
+        return 0
+    return img.width * img.height * len(img.getbands())
+
+
+class LayerRenderCache:
+    """
+    图层合成结果缓存（按字节数限制的LRU）
+
+    类型判断和导出共用同一份 layer.composite() 结果，每个图层最多合成一次；
+    导出编码完成后调用 release 立即释放，超过上限时淘汰最久未用的图像，
+    使峰值内存不随图层数增长。单张超过上限的图像（大面积图层）同样缓存，
+    此时淘汰其他所有图像，只保留它直到 release。
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES,
+                 render: Optional[Callable] = None):
+        self.max_bytes = max_bytes
+        self.render = render or (lambda layer: layer.composite())
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, layer):
+        """获取图层图像（未缓存时合成一次）"""
+        key = id(layer)
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        img = self.render(layer)
+        nbytes = image_nbytes(img)
+        if img is None:
+            return img
+
+        with self._lock:
+            if key not in self._items:
+                # 保存图层引用，保证缓存期间id不会被复用
+                self._items[key] = (layer, img, nbytes)
+                self._bytes += nbytes
+            while self._bytes > self.max_bytes and len(self._items) > 1:
+                _, (_, _, evicted) = self._items.popitem(last=False)
+                self._bytes -= evicted
+        return img
+
+    def release(self, layer):
+        """图层已编码写出，释放其图像"""
+        with self._lock:
+            entry = self._items.pop(id(layer), None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    @property
+    def cached_bytes(self) -> int:
+        return self._bytes
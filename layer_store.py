@@ -0,0 +1,125 @@
+import os
+import hashlib
+import threading
+from concurrent.futures import Future
+from typing import Dict, Optional, Set
+
+# 共享图层文件存放在输出根目录下
+BLOB_DIRNAME = "_blobs"
+
+
+class LayerBlobStore:
+    """
+    内容寻址的图层图片存储（跨PSD去重）
+
+    以合成后RGBA像素的哈希作为文件名，相同内容的图层只编码、写入一次，
+    各PSD的 {id}_layers.json 通过相对路径引用共享文件。
+    多进程同时写同一内容时依赖保存器的原子替换，结果一致。
+
+    本进程内写入未完成时，后续相同内容的图层拿到同一个写入Future，
+    写入失败时一起失败；失败的哈希从登记中移除，下次遇到重新写入，
+    不会留下指向不存在文件的引用。写出的文件随文档一起回滚时（如tar分片
+    截断到上一个提交点），用 abort_document 移除本文档登记的哈希。
+    """
+
+    def __init__(self, output_folder: str, ext: str = "png"):
+        self.root = os.path.join(output_folder, BLOB_DIRNAME)
+        self.ext = ext
+        self._known: Dict[str, Optional[Future]] = {}  # 哈希 -> 未完成的写入（None为已写入）
+        self._document: Set[str] = set()  # 上次commit_document之后本进程写入的哈希
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def hash_image(img) -> str:
+        """计算图像内容哈希（包含模式和尺寸）"""
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f"{img.mode}:{img.size[0]}x{img.size[1]}:".encode())
+        h.update(img.tobytes())
+        return h.hexdigest()
+
+    def blob_path(self, digest: str) -> str:
+        """按哈希前两位分桶，避免单目录文件过多"""
+        return os.path.join(self.root, digest[:2], f"{digest}.{self.ext}")
+
+    def reserve(self, digest: str):
+        """
+        登记一个哈希，返回 (是否需要写入, 写入Future)
+
+        需要写入时返回一个占位Future，调用方写入完成后用 publish 传递结果；
+        本进程正在写入同一内容时返回该写入的Future；已写入或磁盘上已存在
+        （其他进程、上次运行）时Future为None。
+        """
+        with self._lock:
+            if digest in self._known:
+                return False, self._known[digest]
+            pending = Future()
+            self._known[digest] = pending
+            self._document.add(digest)
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            self._settle(digest, None)
+            pending.set_result(0)
+            return False, None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return True, pending
+
+    def _settle(self, digest: str, error: Optional[BaseException]):
+        with self._lock:
+            if error is None:
+                self._known[digest] = None
+            else:
+                self._known.pop(digest, None)
+
+    def commit_document(self):
+        """当前文档的输出已提交，之后登记的哈希不再随文档回滚"""
+        with self._lock:
+            self._document.clear()
+
+    def abort_document(self):
+        """当前文档写出的文件被丢弃：移除它们的登记，后续相同内容的图层重新写入"""
+        with self._lock:
+            for digest in self._document:
+                self._known.pop(digest, None)
+            self._document.clear()
+
+    def publish(self, digest: str, pending: Future, future: Future):
+        """写入完成后登记结果（失败时移除哈希）并传给等待同一内容的图层"""
+        def done(f):
+            error = f.exception()
+            self._settle(digest, error)
+            if error is None:
+                pending.set_result(f.result())
+            else:
+                pending.set_exception(error)
+        future.add_done_callback(done)
+
+    def put(self, img, saver, trace=None):
+        """
+        存入图像（仅新内容交给保存器编码）
+
+        返回 (共享文件路径, 写入Future)，内容已写入时Future为None。
+        """
+        digest = self.hash_image(img)
+        path = self.blob_path(digest)
+        write, pending = self.reserve(digest)
+        if write:
+            try:
+                future = saver.save(img, path, trace=trace)
+            except BaseException as e:
+                self._settle(digest, e)
+                pending.set_exception(e)
+                raise
+            self.publish(digest, pending, future)
+        return path, pending
+
+
+def relative_blob_path(blob_path: str, file_output_folder: str) -> str:
+    """共享文件相对于单个PSD输出文件夹的路径（写入JSON的image_path）"""
+    return os.path.relpath(blob_path, file_output_folder)
+
+
+def resolve_image_path(file_output_folder: str, image_path: str) -> Optional[str]:
+    """将JSON中的image_path解析为实际文件路径（兼容普通模式和去重模式）"""
+    if not image_path:
+        return None
+    return os.path.normpath(os.path.join(file_output_folder, image_path))
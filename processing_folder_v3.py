@@ -2,32 +2,106 @@ import os
 import json
 from PIL import Image
 import numpy as np
-from psd_tools import PSDImage
 from psd_tools.api.layers import PixelLayer, ShapeLayer, TypeLayer, AdjustmentLayer
+from psd_tools.constants import BlendMode, ColorMode
 try:
     from psd_tools.api.layers import Group
 except ImportError:
     from psd_tools.api.layers import GroupLayer as Group
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, Future
 import multiprocessing
-from functools import lru_cache
-import asyncio
-import aiofiles
-from typing import List, Dict, Tuple, Optional
+from functools import partial
+from typing import List, Dict, Optional
 import warnings
-from dataclasses import dataclass
-from queue import Queue
 import threading
+from collections import Counter
+from dataclasses import dataclass
 import psutil
 import gc
+from psd_manifest import PSDManifest, STATUS_TIMEOUT, STATUS_CRASHED, duplicate_file_ids, resolve_manifest_path
+from layer_store import LayerBlobStore, relative_blob_path, resolve_image_path
+from layer_compositor import RegionCompositor
+from image_encoder import ImageEncoderPool, write_file_atomic, latency_quantile, WRITE_LATENCY_BUCKETS
+from async_writer import AsyncFileWriter
+from image_codecs import get_codec
+from psd_scheduler import MemoryBudgetScheduler, estimate_peak_mb
+from psd_worker_pool import PSDWorkerPool, EXIT_CANCELLED
+from psd_index import INDEX_FILENAME, load_headers
+from psd_mmap import open_psd
+from layer_dataset import LayerDatasetWriter
+from tar_shards import TarShardWriter, SHARDS_DIRNAME, recover_orphan_shards
+from psd_trace import PSDTrace, TraceWriter
+from psd_metrics import RunMetrics, MetricsExporter
+from psd_lease import LeaseBoard, LeaseScheduler
+from layer_phash import image_hashes
 
 warnings.filterwarnings('ignore')
 
 # 配置参数
 MAX_WORKERS = min(multiprocessing.cpu_count(), 16)
 THREAD_WORKERS = 8
-CHUNK_SIZE = 10  # 每批处理的PSD文件数
+ENCODER_WORKERS = 4  # 每个进程的PNG编码线程数
+ENCODER_QUEUE_SIZE = 32  # 编码队列上限（满时图层导出线程阻塞）
+# files模式下编码结果交给asyncio写出阶段（aiofiles），多个文件的写入并发进行，
+# 网络存储上的打开/写入/关闭延迟相互重叠；ASYNC_WRITE_IN_FLIGHT为每个进程同时在途的写入数上限
+ASYNC_WRITES = True
+ASYNC_WRITE_IN_FLIGHT = 64
+# 编码预设（见 image_codecs.CODEC_PRESETS）：default / fast / archive / webp / raw
+LAYER_CODEC = 'default'
+PREVIEW_CODEC = 'default'
 MEMORY_LIMIT_MB = 4096  # 内存限制
+PSD_TIMEOUT_SECONDS = 900  # 单个PSD的墙钟时限，超时kill工作进程并记为timeout（None不限制）
+MAX_FILES_PER_WORKER = 200  # 工作进程处理多少个文件后重启
+MAX_RSS_GROWTH_MB = 2048  # 工作进程内存比处理完第一个文件时增长超过该值后重启
+# psd_index.py 生成的预扫描索引（默认 <psd_folder>/_psd_index.npz），存在时内存估算直接读索引，不再打开PSD
+PSD_INDEX_PATH = None
+SKIP_BAD_FILES = True  # 跳过清单中记录为timeout/crashed的文件（设为False重试）
+# 断点续跑清单（SQLite）路径，需在本机磁盘上；None = ~/.cache/psd_processing/ 下按输出文件夹区分的默认路径
+# （输出文件夹里旧版本的 _manifest.sqlite 首次运行时自动迁移过来）
+MANIFEST_PATH = None
+# 所有工作进程的预估峰值内存总和上限（默认物理内存的80%）
+MEMORY_BUDGET_MB = int(psutil.virtual_memory().total / 1024 / 1024 * 0.8)
+# 最大的待处理文件放不下时，最多被小文件越过多少次，之后为它预留预算（防止大文件饿死）
+MAX_HEAD_BYPASS = 8
+MMAP_PSD = True  # 内存映射打开PSD，图层通道数据按需读取和解码（隐藏/跳过的图层不读不解压）
+# 图层元数据输出：json = 每个PSD一个 {id}_layers.json；dataset = 追加到 _dataset 下的列式分片；both = 两者都写
+# （dataset模式下每个文档先追加到分片日志并fsync，工作进程被回收或超时终止时已完成的文档不丢失）
+METADATA_SINK = 'dataset'
+DATASET_FORMAT = 'npz'  # npz / parquet（需要pyarrow）
+DATASET_SHARD_DOCS = 500  # 每个分片的文档数
+# 输出方式：files = 每个PSD一个文件夹、每个图层一个文件；tar = 预览/图层/JSON流式写入 _shards 下的滚动tar分片
+OUTPUT_MODE = 'files'
+TAR_SHARD_BYTES = 1024 * 1024 * 1024  # 单个tar分片大小上限
+DEDUP_LAYERS = False  # 图层内容寻址去重（相同图层只写一次，JSON引用 _blobs 下的共享文件；不支持tar输出）
+# 预览生成方式：
+#   embedded  = 读取PSD内嵌的合并图像（保存时勾选“最大兼容”），缺失或无效时重新合成
+#   composite = 始终用图层重新合成
+#   auto      = 同embedded，但顶层图层被隐藏（remove_top_layer处理过，内嵌图像已过期）时重新合成
+#   layers    = 用导出时的图层合成结果按z序叠加，无法复现（混合模式/剪贴/效果/调整图层）时按auto处理
+PREVIEW_STRATEGY = 'auto'
+# 预览金字塔：由内存中的预览逐级缩小，长边为这些尺寸的缩略图（不小于画布长边的尺寸跳过），
+# 记入JSON的preview_thumbs（{尺寸: 文件名}）；设为()关闭
+PREVIEW_SIZES = (256, 512, 1024)
+PREVIEW_THUMB_CODEC = 'jpeg'
+# 导出时由内存中的图层图像计算感知哈希（dHash/pHash，记入JSON和数据集的dhash/phash），
+# layer_phash.py 建索引聚类近似重复图片时不再解码图片
+LAYER_PHASH = True
+# 分阶段耗时追踪：每个工作进程写 _trace/trace-*.jsonl（打开/分类/合成/编码/写入，按PSD和图层），
+# 用 python psd_trace.py <output_folder> 汇总
+TRACE_STAGES = True
+# 运行指标（主进程汇总）：Prometheus文本文件（默认 <output_folder>/_metrics.prom，定期原子重写）
+# 和本地HTTP端点 http://127.0.0.1:METRICS_PORT/metrics；设为None关闭
+METRICS_TEXTFILE = ''
+METRICS_PORT = 9108
+METRICS_INTERVAL = 15  # 文本文件刷新间隔（秒）
+# 多节点模式：多台机器挂载同一存储、使用相同的psd_folder和output_folder同时运行，
+# 通过 <output_folder>/_leases 下的租约文件认领PSD（心跳续约，节点宕机后租约过期由其他节点回收），
+# 不需要额外的队列服务。清单在各节点本地（见MANIFEST_PATH），指标文件按节点区分；
+# 心跳发现租约已被其他节点回收时，立即终止本节点对该文件的处理
+DISTRIBUTED = False
+NODE_ID = None  # 默认主机名；同一台机器上运行多个实例时需各自指定
+LEASE_TTL_SECONDS = 600  # 租约超过该时间未续约视为节点失联（需远大于心跳间隔，各节点时钟需同步）
+LEASE_HEARTBEAT_SECONDS = 30
 
 @dataclass
 class LayerInfo:
@@ -38,6 +112,13 @@ class LayerInfo:
     bounds: tuple
     name: str
 
+def is_clipped(layer) -> bool:
+    """图层是否参与剪贴蒙版（兼容新旧psd_tools属性名）"""
+    clipping = getattr(layer, 'clipping', None)
+    if clipping is None:
+        clipping = getattr(layer, 'clipping_layer', False)
+    return bool(clipping) or layer.has_clip_layers()
+
 class MemoryMonitor:
     """内存监控器"""
     @staticmethod
@@ -55,61 +136,68 @@ class MemoryMonitor:
             return False
         return True
 
-class BatchImageSaver:
-    """批量图片保存器"""
-    def __init__(self, max_queue_size=100):
-        self.queue = Queue(maxsize=max_queue_size)
-        self.worker_thread = threading.Thread(target=self._worker)
-        self.worker_thread.daemon = True
-        self.worker_thread.start()
-        self.stop_event = threading.Event()
-    
-    def _worker(self):
-        """后台保存线程"""
-        while not self.stop_event.is_set() or not self.queue.empty():
-            try:
-                if not self.queue.empty():
-                    img, filepath = self.queue.get(timeout=1)
-                    img.save(filepath, 'PNG', optimize=True, compress_level=6)
-                    self.queue.task_done()
-            except:
-                pass
-    
-    def save(self, img, filepath):
-        """添加到保存队列"""
-        self.queue.put((img, filepath))
-    
-    def wait_completion(self):
-        """等待所有保存完成"""
-        self.queue.join()
-    
-    def stop(self):
-        """停止保存器"""
-        self.stop_event.set()
-        self.worker_thread.join()
-
 class UltraOptimizedPSDExtractor:
-    def __init__(self, psd_path: str, output_folder: str, saver: BatchImageSaver):
+    def __init__(self, psd_path: str, output_folder: str, saver: ImageEncoderPool,
+                 store: Optional[LayerBlobStore] = None,
+                 dataset: Optional[LayerDatasetWriter] = None,
+                 shards: Optional[TarShardWriter] = None):
         self.psd_path = psd_path
         self.output_folder = output_folder
         self.file_id = os.path.splitext(os.path.basename(psd_path))[0]
         self.saver = saver
+        self.store = store
+        self.dataset = dataset
+        self.shards = shards
+        self._tar_shard = None
+        self._json_filename = None
+        self._dataset_shard = None
+        self.layer_codec = get_codec(LAYER_CODEC)
+        self.preview_codec = get_codec(PREVIEW_CODEC)
+        self.thumb_codec = get_codec(PREVIEW_THUMB_CODEC)
         
         # 延迟加载PSD
         self._psd = None
+        self._psd_handle = None
         self._layers_info = []
+        self._preview_filename = None
+        self._preview_thumbs = {}  # 长边尺寸 -> 缩略图文件名
+        self._layer_hashes = {}  # z -> (dHash, pHash)
+        
+        # layers预览模式下暂存导出的图层图像（按z索引）
+        self._layer_images = None
+        self._render_failed = False
+        
+        # 提交给编码池的写入任务（键为z索引、'preview'或'preview_{尺寸}'）
+        self._pending_writes = {}
+        
+        # 图层渲染路径计数：raw=直接由通道数据构建，composite=psd_tools合成
+        self.render_paths = Counter()
+        self._render_lock = threading.Lock()
+        
+        # 分阶段耗时
+        self.trace = PSDTrace(psd_path)
         
         # 输出文件夹
         self.file_output_folder = os.path.join(output_folder, self.file_id)
-        os.makedirs(self.file_output_folder, exist_ok=True)
+        if shards is None:
+            with self.trace.stage('mkdir'):
+                os.makedirs(self.file_output_folder, exist_ok=True)
     
     @property
     def psd(self):
         """延迟加载PSD"""
         if self._psd is None:
-            self._psd = PSDImage.open(self.psd_path)
+            with self.trace.stage('open'):
+                self._psd, self._psd_handle = open_psd(self.psd_path, MMAP_PSD)
         return self._psd
     
+    def release_psd(self):
+        """释放PSD对象和内存映射"""
+        self._psd = None
+        if self._psd_handle is not None:
+            self._psd_handle.close()
+            self._psd_handle = None
+    
     def determine_layer_type_ultra_fast(self, layer, bounds=None) -> Optional[int]:
         """超快速图层类型判断"""
         if not layer.is_visible():
@@ -151,6 +239,29 @@ class UltraOptimizedPSDExtractor:
         
         return isinstance(layer, Group) and None or 2
     
+    def can_blend_layers(self) -> bool:
+        """判断预览能否由各图层合成结果直接按正常模式叠加得到"""
+        def check(container):
+            for layer in container:
+                if not layer.is_visible():
+                    continue
+                if layer.has_effects() or is_clipped(layer):
+                    return False
+                if isinstance(layer, Group):
+                    # 组本身的不透明度/蒙版/非穿透模式会影响组内合成结果
+                    if layer.blend_mode not in (BlendMode.PASS_THROUGH, BlendMode.NORMAL):
+                        return False
+                    if layer.opacity != 255 or layer.mask or layer.has_vector_mask():
+                        return False
+                    if not check(layer):
+                        return False
+                    continue
+                if isinstance(layer, AdjustmentLayer) or layer.blend_mode != BlendMode.NORMAL:
+                    return False
+            return True
+        
+        return check(self.psd)
+    
     def process_layers_batch(self) -> List[LayerInfo]:
         """批量处理图层收集"""
         all_layers = []
@@ -178,54 +289,213 @@ class UltraOptimizedPSDExtractor:
         collect_layers(self.psd)
         return all_layers
     
+    def is_plain_pixel_layer(self, layer) -> bool:
+        """普通像素图层：正常混合、不透明度100%、无效果/蒙版/剪贴，8位RGB文档"""
+        if not isinstance(layer, PixelLayer) or layer.kind != 'pixel':
+            return False
+        if self.psd.color_mode != ColorMode.RGB or self.psd.depth != 8:
+            return False
+        if layer.blend_mode != BlendMode.NORMAL or layer.opacity != 255:
+            return False
+        if getattr(layer, 'fill_opacity', 255) != 255:
+            return False
+        return not (layer.has_effects() or layer.has_mask() or layer.has_vector_mask() or is_clipped(layer))
+    
+    def render_raw_channels(self, layer) -> Optional[Image.Image]:
+        """直接解码图层通道数据构建RGBA图像（无透明通道时alpha为255）"""
+        width, height = layer.width, layer.height
+        if width == 0 or height == 0:
+            return None
+        index = {info.id: i for i, info in enumerate(layer._record.channel_info)}
+        if not all(c in index for c in (0, 1, 2)):
+            return None
+        
+        rgba = np.empty((height, width, 4), dtype=np.uint8)
+        for c, channel_id in enumerate((0, 1, 2, -1)):
+            if channel_id not in index:
+                rgba[..., c] = 255
+                continue
+            channel = layer._channels[index[channel_id]]
+            data = channel.get_data(width, height, self.psd.depth, self.psd.version)
+            rgba[..., c] = np.frombuffer(data, dtype=np.uint8, count=width * height).reshape(height, width)
+        return Image.fromarray(rgba, 'RGBA')
+    
+    def render_layer(self, layer, z: Optional[int] = None) -> Optional[Image.Image]:
+        """渲染图层：普通像素图层走通道直读，其余走psd_tools合成"""
+        img = None
+        path = 'composite'
+        if self.is_plain_pixel_layer(layer):
+            try:
+                with self.trace.stage('layer_raw', z):
+                    img = self.render_raw_channels(layer)
+                path = 'raw'
+            except Exception:
+                img = None
+        if img is None:
+            with self.trace.stage('layer_composite', z):
+                img = layer.composite()
+            path = 'composite'
+        with self._render_lock:
+            self.render_paths[path] += 1
+        return img
+    
     def export_layer_ultra_fast(self, layer_info: LayerInfo) -> Optional[str]:
         """超快速图层导出"""
         try:
-            filename = f"{self.file_id}_{layer_info.type}_{layer_info.z}.png"
+            filename = f"{self.file_id}_{layer_info.type}_{layer_info.z}.{self.layer_codec.extension}"
             filepath = os.path.join(self.file_output_folder, filename)
             
             # 获取图层图像
-            img = layer_info.layer.composite()
+            z = layer_info.z
+            img = self.render_layer(layer_info.layer, z)
             if img:
                 if img.mode != 'RGBA':
-                    img = img.convert('RGBA')
+                    with self.trace.stage('convert', z):
+                        img = img.convert('RGBA')
+                
+                if self._layer_images is not None:
+                    self._layer_images[layer_info.z] = img
+                
+                if LAYER_PHASH:
+                    with self.trace.stage('phash', z):
+                        self._layer_hashes[z] = image_hashes(img)
                 
-                # 使用批量保存器
-                self.saver.save(img, filepath)
+                # 去重模式：相同内容只编码一次，返回共享文件的相对路径
+                trace = partial(self._trace_write, z)
+                if self.store is not None:
+                    blob_path, future = self.store.put(img, self.saver, trace)
+                    if future is not None:
+                        self._pending_writes[layer_info.z] = future
+                    return relative_blob_path(blob_path, self.file_output_folder)
+                
+                # 交给编码池（队列满时阻塞）
+                self._pending_writes[layer_info.z] = self.saver.save(img, filepath, self.layer_codec, trace)
                 return filename
         except:
+            self._render_failed = True
             return None
     
-    def generate_preview_fast(self) -> Optional[str]:
-        """快速预览生成"""
+    def _trace_write(self, z, stage: str, wall: float, cpu: float):
+        """编码线程回调：记录一个文件的encode/write耗时"""
+        self.trace.add(stage, wall, cpu, None if z == 'preview' else z)
+    
+    def _save_preview(self, preview) -> str:
+        """保存预览图（RGBA以白色为底转RGB）"""
+        preview_filename = f"{self.file_id}_preview.{self.preview_codec.extension}"
+        preview_path = os.path.join(self.file_output_folder, preview_filename)
+        
+        if preview.mode != 'RGB':
+            if preview.mode == 'RGBA':
+                bg = Image.new('RGB', preview.size, (255, 255, 255))
+                bg.paste(preview, mask=preview.split()[3])
+                preview = bg
+            else:
+                preview = preview.convert('RGB')
+        
+        self._pending_writes['preview'] = self.saver.save(preview, preview_path, self.preview_codec,
+                                                          partial(self._trace_write, 'preview'))
+        self._save_preview_pyramid(preview)
+        return preview_filename
+    
+    def _save_preview_pyramid(self, preview):
+        """从大到小逐级缩小生成缩略图（每级由上一级缩小，不重复解码或缩放整张预览）"""
+        self._preview_thumbs = {}
+        long_side = max(preview.size)
+        img = preview
+        for size in sorted(PREVIEW_SIZES, reverse=True):
+            if size >= long_side:
+                continue
+            with self.trace.stage('preview_pyramid'):
+                target = (max(1, round(preview.width * size / long_side)),
+                          max(1, round(preview.height * size / long_side)))
+                img = img.resize(target, Image.LANCZOS, reducing_gap=2.0)
+            filename = f"{self.file_id}_preview_{size}.{self.thumb_codec.extension}"
+            filepath = os.path.join(self.file_output_folder, filename)
+            self._pending_writes[f'preview_{size}'] = self.saver.save(img, filepath, self.thumb_codec,
+                                                                     partial(self._trace_write, 'preview'))
+            self._preview_thumbs[size] = filename
+    
+    def generate_preview_from_layers(self, layers: List[LayerInfo]) -> Optional[str]:
+        """由导出时得到的图层图像按z序（自底向上）叠加生成预览，只处理各图层bbox区域"""
         try:
-            preview_filename = f"{self.file_id}_preview.png"
-            preview_path = os.path.join(self.file_output_folder, preview_filename)
-            
-            preview = self.psd.composite()
+            with self.trace.stage('preview_blend'):
+                compositor = RegionCompositor(self.psd.width, self.psd.height)
+                # z=0 为最上层，需从最大的z开始向上叠加
+                for layer_info in sorted(layers, key=lambda l: l.z, reverse=True):
+                    img = self._layer_images.get(layer_info.z)
+                    if img is not None:
+                        compositor.blend(img, layer_info.bounds[0], layer_info.bounds[1])
+                preview = compositor.to_rgb()
+            return self._save_preview(preview)
+        except:
+            return None
+    
+    def load_embedded_preview(self):
+        """读取PSD内嵌的合并图像，缺失或无效时返回None"""
+        if not self.psd.has_preview():
+            return None
+        preview = self.psd.topil()
+        if preview is None or preview.size != (self.psd.width, self.psd.height):
+            return None
+        # 未开启最大兼容时内嵌数据为纯色占位图
+        if all(lo == hi for lo, hi in preview.getextrema()):
+            return None
+        return preview
+    
+    def top_layer_hidden(self) -> bool:
+        """最上层图层是否被隐藏（隐藏后保存的PSD内嵌图像仍包含该图层）"""
+        layers = list(self.psd)
+        return bool(layers) and not layers[-1].visible
+    
+    def generate_preview_fast(self, strategy: str = PREVIEW_STRATEGY) -> Optional[str]:
+        """快速预览生成（优先使用内嵌合并图像，必要时重新合成）"""
+        try:
+            preview = None
+            if strategy == 'embedded' or (strategy in ('auto', 'layers') and not self.top_layer_hidden()):
+                with self.trace.stage('preview_embedded'):
+                    preview = self.load_embedded_preview()
+            if preview is None:
+                with self.trace.stage('preview_composite'):
+                    preview = self.psd.composite(ignore_preview=True)
             if preview:
-                if preview.mode != 'RGB':
-                    if preview.mode == 'RGBA':
-                        bg = Image.new('RGB', preview.size, (255, 255, 255))
-                        bg.paste(preview, mask=preview.split()[3])
-                        preview = bg
-                    else:
-                        preview = preview.convert('RGB')
-                
-                # 降低质量以加快保存速度
-                preview.save(preview_path, 'PNG', quality=80, optimize=True)
-                return preview_filename
+                return self._save_preview(preview)
         except:
             return None
     
+    def wait_writes(self):
+        """等待本PSD的所有图片写入完成，写入失败的图层从结果中剔除"""
+        failed = set()
+        for key, future in self._pending_writes.items():
+            error = future.exception()
+            if error is None:
+                continue
+            print(f"Error writing {self.file_id} [{key}]: {error}")
+            if key == 'preview':
+                self._preview_filename = None
+            elif isinstance(key, str):
+                self._preview_thumbs.pop(int(key.split('_')[1]), None)
+            else:
+                failed.add(key)
+        if failed:
+            self._layers_info = [l for l in self._layers_info if l["z"] not in failed]
+        self._pending_writes = {}
+    
     def extract_ultra_optimized(self) -> bool:
         """超优化提取流程"""
         try:
-            # 1. 快速生成预览
-            preview = self.generate_preview_fast()
+            # 0. 打开PSD（单独计入open阶段，不混入后续阶段）
+            self.psd
+            
+            # 1. 快速生成预览（layers模式在图层导出后再叠加生成）
+            blend_preview = PREVIEW_STRATEGY == 'layers' and self.can_blend_layers()
+            if blend_preview:
+                self._layer_images = {}
+            else:
+                self._preview_filename = self.generate_preview_fast()
             
             # 2. 批量收集图层
-            layers = self.process_layers_batch()
+            with self.trace.stage('classify'):
+                layers = self.process_layers_batch()
             
             # 3. 使用线程池处理图层导出
             with ThreadPoolExecutor(max_workers=THREAD_WORKERS) as executor:
@@ -239,6 +509,7 @@ class UltraOptimizedPSDExtractor:
                     filename = future.result()
                     if filename:
                         bounds = layer_info.bounds
+                        dhash, phash = self._layer_hashes.get(layer_info.z, (0, 0))
                         self._layers_info.append({
                             "z": layer_info.z,
                             "type": layer_info.type,
@@ -247,21 +518,51 @@ class UltraOptimizedPSDExtractor:
                             "width": bounds[2] - bounds[0],
                             "height": bounds[3] - bounds[1],
                             "image_path": filename,
-                            "layer_name": layer_info.name
+                            "layer_name": layer_info.name,
+                            "dhash": dhash,
+                            "phash": phash,
                         })
             
-            # 4. 保存JSON
-            self.save_json_fast()
+            # 4. layers模式：由图层结果叠加预览，导出有失败时回退完整合成
+            if blend_preview:
+                if not self._render_failed:
+                    self._preview_filename = self.generate_preview_from_layers(layers)
+                if self._preview_filename is None:
+                    self._preview_filename = self.generate_preview_fast()
+                self._layer_images = None
+            
+            # 5. 等待图片写入完成后再保存JSON
+            with self.trace.stage('wait_writes'):
+                self.wait_writes()
+            with self.trace.stage('metadata'):
+                self.save_json_fast()
+            if self.shards is not None:
+                self._tar_shard = self.shards.end_document()
+            if self.store is not None:
+                self.store.commit_document()
             
-            # 5. 清理内存
-            del self._psd
+            # 6. 清理内存
+            self.release_psd()
             gc.collect()
             
             return True
         except Exception as e:
             print(f"Error processing {self.psd_path}: {e}")
+            if self.shards is not None:
+                self.discard_tar_members()
+            self.release_psd()
             return False
     
+    def discard_tar_members(self):
+        """tar模式下处理失败：等本PSD的写入结束后，把已写入分片的成员截断掉"""
+        for future in self._pending_writes.values():
+            future.exception()
+        self._pending_writes = {}
+        self.shards.abort_document()
+        if self.store is not None:
+            # 写进分片的共享图层随之截断，不能再被后续PSD引用
+            self.store.abort_document()
+    
     def save_json_fast(self):
         """快速JSON保存"""
         self._layers_info.sort(key=lambda x: x['z'])
@@ -270,7 +571,8 @@ class UltraOptimizedPSDExtractor:
             "id": self.file_id,
             "canvas_width": self.psd.width,
             "canvas_height": self.psd.height,
-            "preview_path": f"{self.file_id}_preview.png",
+            "preview_path": f"{self.file_id}_preview.{self.preview_codec.extension}",
+            "preview_thumbs": {str(size): name for size, name in sorted(self._preview_thumbs.items())},
             "z": [l["z"] for l in self._layers_info],
             "type": [l["type"] for l in self._layers_info],
             "left": [l["left"] for l in self._layers_info],
@@ -280,41 +582,149 @@ class UltraOptimizedPSDExtractor:
             "image_path": [l["image_path"] for l in self._layers_info],
             "layer_names": [l["layer_name"] for l in self._layers_info]
         }
+        if LAYER_PHASH:
+            json_data["dhash"] = [l["dhash"] for l in self._layers_info]
+            json_data["phash"] = [l["phash"] for l in self._layers_info]
+        
+        if self.dataset is not None:
+            self._dataset_shard = self.dataset.append(json_data)
+        if self.dataset is None or METADATA_SINK == 'both':
+            self._json_filename = f"{self.file_id}_layers.json"
+            json_path = os.path.join(self.file_output_folder, self._json_filename)
+            data = json.dumps(json_data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            # 与图片走同一个写出方式（原子写文件 / 异步写出 / tar分片）
+            written = self.saver.write(json_path, data)
+            if isinstance(written, Future):
+                written.result()
+    
+    def output_files(self) -> List[str]:
+        """本PSD生成的所有输出文件（相对输出根目录，供清单校验）"""
+        if self.shards is not None:
+            # tar模式下输出都在分片中，分片关闭（改名为.tar）后才算完成
+            outputs = [self._tar_shard] if self._tar_shard else []
+            if self._dataset_shard:
+                outputs.append(self._dataset_shard)
+            return outputs
         
-        json_path = os.path.join(self.file_output_folder, f"{self.file_id}_layers.json")
-        with open(json_path, 'w', encoding='utf-8') as f:
-            json.dump(json_data, f, ensure_ascii=False, separators=(',', ':'))
+        files = [self._json_filename] if self._json_filename else []
+        if self._preview_filename:
+            files.append(self._preview_filename)
+        files.extend(self._preview_thumbs.values())
+        files.extend(l["image_path"] for l in self._layers_info)
+        outputs = [os.path.relpath(resolve_image_path(self.file_output_folder, f), self.output_folder)
+                   for f in files]
+        if self._dataset_shard:
+            # 数据集日志（文档在append返回前已fsync，进程随后被终止也不会丢失）
+            outputs.append(self._dataset_shard)
+        return outputs
 
-def process_psd_chunk(chunk_data: Tuple[List[str], str]) -> List[Tuple[str, bool]]:
-    """处理一批PSD文件"""
-    psd_files, output_folder = chunk_data
-    results = []
+def process_single_file(psd_file: str, output_folder: str, manifest: PSDManifest,
+                        saver: ImageEncoderPool, store: Optional[LayerBlobStore],
+                        dataset: Optional[LayerDatasetWriter] = None,
+                        shards: Optional[TarShardWriter] = None,
+                        tracer: Optional[TraceWriter] = None) -> Dict:
+    """处理单个PSD（已完成的根据清单跳过），返回结果和本文件的编码统计"""
+    result = {"success": False, "skipped": False, "bytes_written": 0, "encode_errors": 0,
+              "render_raw": 0, "render_composite": 0, "layers": 0, "pid": os.getpid(),
+              "encode_queue_peak": 0, "write_seconds": 0.0, "write_latency_buckets": []}
     
-    # 为每个进程创建独立的保存器
-    saver = BatchImageSaver()
+    # 其他进程或上次运行已完成
+    if manifest.is_complete(psd_file, output_folder):
+        result.update(success=True, skipped=True)
+        return result
     
+    # 检查内存
+    if not MemoryMonitor.check_memory():
+        gc.collect()
+    
+    saver.reset_peak()
+    before = saver.stats()
+    extractor = None
     try:
-        for psd_file in psd_files:
-            # 检查内存
-            if not MemoryMonitor.check_memory():
-                gc.collect()
-            
-            try:
-                extractor = UltraOptimizedPSDExtractor(psd_file, output_folder, saver)
-                success = extractor.extract_ultra_optimized()
-                results.append((psd_file, success))
-            except Exception as e:
-                print(f"Error with {psd_file}: {e}")
-                results.append((psd_file, False))
-        
-        # 等待所有图片保存完成
-        saver.wait_completion()
-        saver.stop()
+        # 清理上次中断留下的半成品
+        file_id = os.path.splitext(os.path.basename(psd_file))[0]
+        manifest.clear_output_folder(psd_file, output_folder, file_id)
+        manifest.mark_running(psd_file)
         
+        extractor = UltraOptimizedPSDExtractor(psd_file, output_folder, saver, store, dataset, shards)
+        success = extractor.extract_ultra_optimized()
+        result["render_raw"] = extractor.render_paths["raw"]
+        result["render_composite"] = extractor.render_paths["composite"]
+        if success:
+            result["layers"] = len(extractor._layers_info)
+            manifest.mark_done(psd_file, len(extractor._layers_info), extractor.output_files())
+        else:
+            manifest.mark_failed(psd_file, "extraction failed")
+        result["success"] = success
     except Exception as e:
-        print(f"Chunk processing error: {e}")
+        print(f"Error with {psd_file}: {e}")
+        manifest.mark_failed(psd_file, str(e))
     
-    return results
+    after = saver.stats()
+    result["bytes_written"] = after["bytes_written"] - before["bytes_written"]
+    result["encode_errors"] = after["errors"] - before["errors"]
+    result["encode_queue_peak"] = after["max_queue_depth"]
+    result["write_seconds"] = after["write_seconds"] - before["write_seconds"]
+    result["write_latency_buckets"] = [a - b for a, b in zip(after["write_latency_buckets"],
+                                                             before["write_latency_buckets"])]
+    
+    if tracer is not None and extractor is not None:
+        tracer.write(extractor.trace.record(
+            success=result["success"],
+            layer_count=len(extractor._layers_info),
+            bytes_written=result["bytes_written"],
+            render_raw=result["render_raw"],
+            render_composite=result["render_composite"],
+        ))
+    return result
+
+def manifest_path(output_folder: str) -> str:
+    """清单路径（本地磁盘；多节点模式下各节点各自一份，不放在共享存储上）"""
+    return resolve_manifest_path(output_folder, MANIFEST_PATH)
+
+def check_config():
+    """检查互不兼容的配置"""
+    if DEDUP_LAYERS and OUTPUT_MODE == 'tar':
+        # 共享图层写在各进程的tar分片里，无法按路径判断是否已存在，去重只在单个进程内有效
+        raise ValueError("DEDUP_LAYERS is not supported with OUTPUT_MODE = 'tar'")
+
+def init_worker(output_folder: str) -> Dict:
+    """工作进程初始化：每个进程一个编码池、去重存储和清单连接，跨文件复用"""
+    check_config()
+    shards = TarShardWriter(output_folder, TAR_SHARD_BYTES) if OUTPUT_MODE == 'tar' else None
+    writer = AsyncFileWriter(ASYNC_WRITE_IN_FLIGHT) if ASYNC_WRITES and shards is None else None
+    if shards is not None:
+        write = shards.write_file
+    else:
+        write = writer.write if writer is not None else write_file_atomic
+    return {
+        "output_folder": output_folder,
+        "manifest": PSDManifest(manifest_path(output_folder)),
+        "shards": shards,
+        "writer": writer,
+        "saver": ImageEncoderPool(ENCODER_WORKERS, ENCODER_QUEUE_SIZE, get_codec(LAYER_CODEC), write=write),
+        "store": LayerBlobStore(output_folder, get_codec(LAYER_CODEC).extension) if DEDUP_LAYERS else None,
+        "dataset": (LayerDatasetWriter(output_folder, DATASET_SHARD_DOCS, DATASET_FORMAT)
+                    if METADATA_SINK != 'json' else None),
+        "tracer": TraceWriter(output_folder) if TRACE_STAGES else None,
+    }
+
+def handle_worker_file(state: Dict, psd_file: str) -> Dict:
+    return process_single_file(psd_file, state["output_folder"], state["manifest"],
+                               state["saver"], state["store"], state["dataset"], state["shards"],
+                               state["tracer"])
+
+def close_worker(state: Dict):
+    state["saver"].stop()
+    if state["writer"] is not None:
+        state["writer"].close()
+    if state["shards"] is not None:
+        state["shards"].close()
+    if state["dataset"] is not None:
+        state["dataset"].close()
+    if state["tracer"] is not None:
+        state["tracer"].close()
+    state["manifest"].close()
 
 def get_all_psd_files(folder_path: str) -> List[str]:
     """获取所有PSD文件"""
@@ -327,51 +737,169 @@ def main():
     psd_folder = r"/storage/human_psd/psd_fp_v1"
     output_folder = r"/storage/human_psd/fp_v1_output_v2"
     
+    check_config()
     os.makedirs(output_folder, exist_ok=True)
     
     # 获取所有PSD文件
     psd_files = get_all_psd_files(psd_folder)
-    total_files = len(psd_files)
     
-    if total_files == 0:
+    if not psd_files:
         print(f"No PSD files found in {psd_folder}")
         return
     
-    print(f"Found {total_files} PSD files")
+    # 输出文件夹按文件名命名，同名PSD会互相清理对方的输出
+    duplicates = duplicate_file_ids(psd_files)
+    if duplicates:
+        for file_id, paths in sorted(duplicates.items())[:20]:
+            print(f"  {file_id}: {', '.join(paths)}")
+        raise ValueError(f"{len(duplicates)} PSD file names occur in more than one folder; rename them first")
+    
+    # tar模式：先完成上次被终止的进程遗留的分片，其中已提交的文档不必重做
+    shards_folder = os.path.join(output_folder, SHARDS_DIRNAME)
+    if OUTPUT_MODE == 'tar' and os.path.isdir(shards_folder):
+        recovered = recover_orphan_shards(shards_folder)
+        if recovered:
+            print(f"Recovered {len(recovered)} unfinished tar shards")
+    
+    # 根据清单跳过已完成的文件
+    manifest = PSDManifest(manifest_path(output_folder))
+    all_count = len(psd_files)
+    skip_statuses = (STATUS_TIMEOUT, STATUS_CRASHED) if SKIP_BAD_FILES else ()
+    psd_files = manifest.pending(psd_files, output_folder, skip_statuses)
+    total_files = len(psd_files)
+    
+    print(f"Found {all_count} PSD files, {all_count - total_files} already done or skipped, {total_files} to process")
+    if total_files == 0:
+        manifest.close()
+        return
     print(f"Memory usage: {MemoryMonitor.get_memory_usage():.1f} MB")
     
-    # 分块处理
-    chunks = [psd_files[i:i + CHUNK_SIZE] for i in range(0, total_files, CHUNK_SIZE)]
-    chunk_tasks = [(chunk, output_folder) for chunk in chunks]
+    # 根据文件大小和文件头估算峰值内存，大文件优先
+    index_path = PSD_INDEX_PATH or os.path.join(psd_folder, INDEX_FILENAME)
+    headers = load_headers(index_path) if os.path.exists(index_path) else {}
+    estimates = [estimate_peak_mb(p, THREAD_WORKERS, headers.get(p)) for p in psd_files]
+    leases = None
+    if DISTRIBUTED:
+        # 本节点清单之外，其他节点完成的文件在认领时根据完成标记跳过
+        leases = LeaseBoard(output_folder, manifest, NODE_ID, LEASE_TTL_SECONDS,
+                            LEASE_HEARTBEAT_SECONDS, skip_statuses).start()
+        scheduler = LeaseScheduler(MEMORY_BUDGET_MB, leases, max_bypass=MAX_HEAD_BYPASS)
+        print(f"Distributed mode: node {leases.node_id}, lease ttl {LEASE_TTL_SECONDS}s")
+    else:
+        scheduler = MemoryBudgetScheduler(MEMORY_BUDGET_MB, MAX_HEAD_BYPASS)
+    scheduler.add_tasks(psd_files, estimates)
     
     # 动态调整进程数
-    num_processes = min(MAX_WORKERS, len(chunks))
-    print(f"Using {num_processes} processes with chunk size {CHUNK_SIZE}")
+    num_processes = min(MAX_WORKERS, total_files)
+    print(f"Using {num_processes} processes, per-file timeout {PSD_TIMEOUT_SECONDS}s, "
+          f"memory budget {MEMORY_BUDGET_MB} MB (largest file ~{max(estimates):.0f} MB)")
     
     # 进度跟踪
     from tqdm import tqdm
-    completed = 0
+    totals = Counter()
+    latency_buckets = [0] * (len(WRITE_LATENCY_BUCKETS) + 1)
+    bad_files = []
+    
+    # 运行指标（ETA按PSD字节数估算）
+    file_sizes = {p: os.path.getsize(p) for p in psd_files}
+    metrics = RunMetrics(total_files, sum(file_sizes.values()))
+    textfile = METRICS_TEXTFILE
+    if textfile == '':
+        textfile = os.path.join(output_folder, f'_metrics-{leases.node_id}.prom' if leases else '_metrics.prom')
+    exporter = MetricsExporter(metrics, textfile, METRICS_PORT, interval=METRICS_INTERVAL).start()
     
-    with ProcessPoolExecutor(max_workers=num_processes) as executor:
-        futures = {executor.submit(process_psd_chunk, task): task 
-                  for task in chunk_tasks}
+    with tqdm(total=total_files, desc="Processing PSD files") as pbar:
+        def on_result(psd_file, result):
+            totals["completed"] += 1
+            totals["success"] += bool(result.get("success"))
+            totals["skipped"] += bool(result.get("skipped"))
+            for key in ("bytes_written", "encode_errors", "render_raw", "render_composite"):
+                totals[key] += result.get(key, 0)
+            for i, count in enumerate(result.get("write_latency_buckets", [])):
+                latency_buckets[i] += count
+            if result.get("error"):
+                print(f"\nWorker error with {psd_file}: {result['error']}")
+            metrics.file_done(result, file_sizes.get(psd_file, 0))
+            if leases is not None:
+                if leases.is_lost(psd_file):
+                    # 处理期间租约被其他节点回收，以新持有者的输出为准，本节点不记为完成
+                    manifest.mark_failed(psd_file, "lease lost")
+                leases.finish(psd_file, manifest.get(psd_file))
+            pbar.update(1)
+            
+            # 显示工作进程内存总量和编码写入量
+            worker_rss = sum(w["rss_bytes"] for w in metrics.workers())
+            pbar.set_postfix(workers_rss=f"{worker_rss / 1024 / 1024:.0f}MB",
+                             written=f"{totals['bytes_written'] / 1024 / 1024:.0f}MB",
+                             encode_errors=totals["encode_errors"],
+                             bad=len(bad_files))
+        
+        def on_failure(psd_file, reason, message):
+            # 工作进程已被kill，由主进程记录
+            totals["completed"] += 1
+            if reason == EXIT_CANCELLED:
+                # 租约丢失：文件由其他节点接手，本地记为普通失败（可重试），不写完成标记
+                manifest.mark_failed(psd_file, message)
+                leases.release(psd_file)
+                metrics.file_failed(reason, file_sizes.get(psd_file, 0))
+                pbar.update(1)
+                return
+            manifest.mark_failed(psd_file, message, status=reason)
+            if leases is not None:
+                leases.finish(psd_file, manifest.get(psd_file))
+            bad_files.append((psd_file, reason))
+            metrics.file_failed(reason, file_sizes.get(psd_file, 0))
+            pbar.update(1)
         
-        with tqdm(total=total_files, desc="Processing PSD files") as pbar:
-            for future in as_completed(futures):
-                try:
-                    results = future.result()
-                    completed += len(results)
-                    pbar.update(len(results))
-                    
-                    # 显示内存使用
-                    mem_usage = MemoryMonitor.get_memory_usage()
-                    pbar.set_postfix(memory=f"{mem_usage:.1f}MB")
-                    
-                except Exception as e:
-                    print(f"\nChunk error: {e}")
-    
-    print(f"\nCompleted! Processed {completed}/{total_files} files")
+        def on_skip(psd_file):
+            # 其他节点已完成的文件：同样计入完成数、指标和ETA
+            totals["completed"] += 1
+            totals["skipped"] += 1
+            metrics.file_skipped(file_sizes.get(psd_file, 0))
+            pbar.update(1)
+        
+        pool = PSDWorkerPool(
+            partial(init_worker, output_folder), handle_worker_file, close_worker,
+            num_workers=num_processes,
+            timeout=PSD_TIMEOUT_SECONDS,
+            max_files_per_worker=MAX_FILES_PER_WORKER,
+            max_rss_growth_mb=MAX_RSS_GROWTH_MB,
+        )
+        if leases is not None:
+            scheduler.on_skip = on_skip
+            # 租约丢失时kill正在处理该文件的进程，不再继续写输出
+            leases.on_lost = lambda psd_file: pool.cancel(psd_file, "lease lost")
+        metrics.pool = pool
+        try:
+            pool.run(scheduler, on_result, on_failure)
+        finally:
+            exporter.stop()
+            if leases is not None:
+                leases.stop()
+    manifest.close()
+    
+    completed = totals["completed"]
+    render_raw = totals["render_raw"]
+    render_composite = totals["render_composite"]
+    pool_stats = pool.stats()
+    print(f"Workers: spawned={pool_stats['spawned']}, retired={pool_stats['retired']}, "
+          f"timeout={pool_stats['timeout']}, crashed={pool_stats['crashed']}, cancelled={pool_stats['cancelled']}")
+    for psd_file, reason in bad_files:
+        print(f"  [{reason}] {psd_file}")
+    if leases is not None:
+        lease_stats = leases.stats()
+        print(f"Leases: claimed={lease_stats['claimed']}, reclaimed={lease_stats['reclaimed']}, "
+              f"finished_elsewhere={lease_stats['finished_elsewhere']}, lost={lease_stats['lost']}")
+    
+    print(f"\nCompleted! Processed {completed}/{total_files} files ({totals['success']} succeeded, "
+          f"{totals['skipped']} skipped as already done)")
+    print(f"Layer render paths: raw={render_raw}, composite={render_composite}")
+    if sum(latency_buckets):
+        p50, p90, p99 = (latency_quantile(latency_buckets, q) * 1000 for q in (0.5, 0.9, 0.99))
+        print(f"Write latency ({sum(latency_buckets)} files): p50={p50:.1f}ms p90={p90:.1f}ms p99={p99:.1f}ms")
     print(f"Final memory usage: {MemoryMonitor.get_memory_usage():.1f} MB")
+    if TRACE_STAGES:
+        print(f"Stage timings: python psd_trace.py {output_folder}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,6 +3,10 @@ import json
 from PIL import Image
 import numpy as np
 from psd_tools import PSDImage
+from layer_classifier import has_fewer_colors, MAX_BACKGROUND_COLORS
+from layer_render_cache import LayerRenderCache
+from layer_compositor import RegionCompositor
+from image_codecs import get_codec
 from psd_tools.api.layers import PixelLayer, ShapeLayer, TypeLayer, AdjustmentLayer
 try:
     from psd_tools.api.layers import Group
@@ -11,6 +15,10 @@ except ImportError:
     from psd_tools.api.layers import GroupLayer as Group
 import io
 
+# 编码预设（见 image_codecs.CODEC_PRESETS）：png / default / fast / archive / webp / raw
+LAYER_CODEC = 'png'
+PREVIEW_CODEC = 'png'
+
 class PSDLayerExtractor:
     def __init__(self, psd_path, output_folder):
         self.psd_path = psd_path
@@ -19,6 +27,11 @@ class PSDLayerExtractor:
         self.file_id = os.path.splitext(os.path.basename(psd_path))[0]
         self.layers_info = []
         
+        # 类型判断和导出共用的图层合成缓存（每个图层只合成一次）
+        self.render_cache = LayerRenderCache()
+        self.layer_codec = get_codec(LAYER_CODEC)
+        self.preview_codec = get_codec(PREVIEW_CODEC)
+        
         # 创建输出文件夹
         os.makedirs(output_folder, exist_ok=True)
         
@@ -58,32 +71,27 @@ class PSDLayerExtractor:
             if layer.mask or 'mask' in layer.name.lower() or '蒙版' in layer.name.lower():
                 return 4  # maskElement
                 
-            # 检查图层内容
+            # 检查图层内容（只有大面积图层才需要合成并分析颜色）
             try:
-                img = layer.composite()
-                if img:
-                    # 分析图像内容
-                    img_array = np.array(img)
+                # 计算图层面积
+                bounds = layer.bbox
+                if bounds:
+                    layer_area = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+                    canvas_area = self.psd.width * self.psd.height
                     
-                    # 如果是大面积纯色，可能是背景
-                    if len(img_array.shape) >= 3 and img_array.shape[2] >= 3:  # 有RGB通道
-                        # 计算图层面积
-                        bounds = layer.bbox
-                        if bounds:
-                            layer_area = (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
-                            canvas_area = self.psd.width * self.psd.height
+                    # 如果图层覆盖超过70%的画布
+                    if layer_area > canvas_area * 0.7:
+                        img = self.render_cache.get(layer)
+                        if img:
+                            img_array = np.asarray(img)
                             
-                            # 如果图层覆盖超过70%的画布
-                            if layer_area > canvas_area * 0.7:
-                                # 分析颜色多样性
-                                flat_array = img_array.reshape(-1, img_array.shape[2])
-                                unique_colors = np.unique(flat_array, axis=0)
-                                
-                                # 如果颜色数少于10，认为是背景
-                                if len(unique_colors) < 10:
+                            # 如果是大面积纯色，可能是背景
+                            if len(img_array.shape) >= 3 and img_array.shape[2] >= 3:  # 有RGB通道
+                                # 分析颜色多样性（抽样+提前退出），颜色数少于10认为是背景
+                                if has_fewer_colors(img_array, MAX_BACKGROUND_COLORS):
                                     return 3  # coloredBackground
-                    
-                    return 2  # imageElement
+                
+                return 2  # imageElement
             except Exception as e:
                 print(f"分析图层 {layer.name} 时出错: {e}")
                 return 2  # 默认为图像元素
@@ -103,27 +111,27 @@ class PSDLayerExtractor:
             
             if layer_type == 0:  # svgElement
                 # 尝试导出为SVG（目前先导出为PNG）
-                filename = f"{self.file_id}_{type_str}_{z_index}.png"
+                filename = f"{self.file_id}_{type_str}_{z_index}.{self.layer_codec.extension}"
                 filepath = os.path.join(self.output_folder, filename)
                 
-                img = layer.composite()
+                img = self.render_cache.get(layer)
                 if img:
                     # 确保是RGBA模式
                     if img.mode != 'RGBA':
                         img = img.convert('RGBA')
-                    img.save(filepath, 'PNG')
+                    self.layer_codec.save(img, filepath)
                     return filename
             else:
                 # 导出为PNG
-                filename = f"{self.file_id}_{type_str}_{z_index}.png"
+                filename = f"{self.file_id}_{type_str}_{z_index}.{self.layer_codec.extension}"
                 filepath = os.path.join(self.output_folder, filename)
                 
-                img = layer.composite()
+                img = self.render_cache.get(layer)
                 if img:
                     # 确保是RGBA模式以保留透明度
                     if img.mode != 'RGBA':
                         img = img.convert('RGBA')
-                    img.save(filepath, 'PNG')
+                    self.layer_codec.save(img, filepath)
                     return filename
                     
         except Exception as e:
@@ -163,8 +171,9 @@ class PSDLayerExtractor:
             width = right - left
             height = bottom - top
             
-            # 导出图层图片
+            # 导出图层图片（写出后立即释放缓存的图像）
             image_filename = self.export_layer_as_image(layer, layer_type, z_index)
+            self.render_cache.release(layer)
             
             # 构建图层信息
             layer_info = {
@@ -187,7 +196,7 @@ class PSDLayerExtractor:
     def export_preview(self):
         """导出PSD预览图（只包含可见图层）"""
         try:
-            preview_filename = f"{self.file_id}_preview.png"
+            preview_filename = f"{self.file_id}_preview.{self.preview_codec.extension}"
             preview_path = os.path.join(self.output_folder, preview_filename)
             
             # 方法1：直接使用PSD的composite方法（最可靠）
@@ -205,7 +214,7 @@ class PSDLayerExtractor:
                 elif preview.mode != 'RGB':
                     preview = preview.convert('RGB')
                 
-                preview.save(preview_path, 'PNG', quality=10)
+                self.preview_codec.save(preview, preview_path)
                 print(f"预览图已保存: {preview_filename} (尺寸: {preview.size})")
                 return preview_filename
             else:
@@ -228,11 +237,11 @@ class PSDLayerExtractor:
     
     def _manual_composite_preview(self):
         """手动合成预览图（备用方案）"""
-        preview_filename = f"{self.file_id}_preview.png"
+        preview_filename = f"{self.file_id}_preview.{self.preview_codec.extension}"
         preview_path = os.path.join(self.output_folder, preview_filename)
         
-        # 创建画布
-        canvas = Image.new('RGBA', (self.psd.width, self.psd.height), (255, 255, 255, 0))
+        # 预分配画布，每个图层只在自身bbox区域内合成
+        canvas = RegionCompositor(self.psd.width, self.psd.height, (255, 255, 255, 0))
         
         # 获取所有图层并反转（底层在前）
         all_layers = []
@@ -248,23 +257,15 @@ class PSDLayerExtractor:
                 
             try:
                 # 获取图层图像
-                layer_image = layer.composite()
+                layer_image = self.render_cache.get(layer)
                 if layer_image:
                     visible_count += 1
                     bounds = layer.bbox
                     if bounds:
                         left, top = int(bounds[0]), int(bounds[1])
                         
-                        # 确保图像是RGBA模式
-                        if layer_image.mode != 'RGBA':
-                            layer_image = layer_image.convert('RGBA')
-                        
-                        # 创建临时画布并粘贴图层
-                        temp = Image.new('RGBA', canvas.size, (0, 0, 0, 0))
-                        temp.paste(layer_image, (left, top))
-                        
-                        # 合成到主画布
-                        canvas = Image.alpha_composite(canvas, temp)
+                        # 合成到主画布（结果与整张画布 alpha_composite 相同）
+                        canvas.blend(layer_image, left, top)
                         print(f"  已合成图层: {layer.name}")
                         
             except Exception as e:
@@ -272,11 +273,10 @@ class PSDLayerExtractor:
         
         print(f"共合成了 {visible_count} 个可见图层")
         
-        # 转换为RGB
-        final = Image.new('RGB', canvas.size, (255, 255, 255))
-        final.paste(canvas, mask=canvas.split()[3])
+        # 转换为RGB（白底）
+        final = canvas.to_rgb((255, 255, 255))
         
-        final.save(preview_path, 'PNG', quality=10)
+        self.preview_codec.save(final, preview_path)
         print(f"手动合成预览图已保存: {preview_filename}")
         return preview_filename
     
@@ -318,7 +318,7 @@ class PSDLayerExtractor:
             "id": self.file_id,
             "canvas_width": self.psd.width,
             "canvas_height": self.psd.height,
-            "preview_path": f"{self.file_id}_preview.png",
+            "preview_path": f"{self.file_id}_preview.{self.preview_codec.extension}",
             "z": [],
             "type": [],
             "left": [],
@@ -0,0 +1,173 @@
+import os
+import json
+import hashlib
+import argparse
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+from tqdm import tqdm
+
+# 快速指纹读取的首尾块大小（首块包含文件头、色彩模式段和图像资源段的开头）
+BLOCK_SIZE = 64 * 1024
+READ_CHUNK = 1024 * 1024
+DEFAULT_WORKERS = 8
+
+
+def find_psd_files(folder: str) -> List[str]:
+    """递归查找PSD文件（按路径排序，结果可复现）"""
+    return sorted(os.path.join(root, f)
+                  for root, _, files in os.walk(folder)
+                  for f in files if f.lower().endswith('.psd'))
+
+
+def quick_hash(path: str, size: int, block: int = BLOCK_SIZE) -> bytes:
+    """文件头+首块+尾块的哈希（同尺寸文件的初筛，只读两个块）"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        h.update(f.read(block))
+        if size > block:
+            f.seek(max(block, size - block))
+            h.update(f.read(block))
+    return h.digest()
+
+
+def full_hash(path: str) -> bytes:
+    """全文件哈希（hashlib在大块数据上释放GIL，多线程可并行）"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.digest()
+
+
+def _quick_key(item: Tuple[int, str]):
+    size, path = item
+    return size, quick_hash(path, size)
+
+
+def _full_key(item: Tuple[int, str]):
+    size, path = item
+    return size, full_hash(path)
+
+
+def _regroup(groups: Iterable[List[Tuple[int, str]]], key, executor, errors: Dict[str, str],
+             desc: Optional[str] = None) -> List[List[Tuple[int, str]]]:
+    """按key细分每组（并行计算key），返回仍有多个成员的组；读取失败的文件记入errors并剔除"""
+    def compute(item):
+        try:
+            return key(item)
+        except OSError as e:
+            errors[item[1]] = str(e)
+            return None
+
+    items = [item for group in groups for item in group]
+    keys = executor.map(compute, items)
+    if desc:
+        keys = tqdm(keys, total=len(items), desc=desc)
+
+    regrouped = defaultdict(list)
+    for item, k in zip(items, keys):
+        if k is not None:
+            regrouped[k].append(item)
+    return [group for group in regrouped.values() if len(group) > 1]
+
+
+def dedupe_files(paths: Sequence[str], known: Sequence[str] = (),
+                 num_workers: int = DEFAULT_WORKERS, progress: bool = True) -> Dict:
+    """
+    按内容去重PSD文件
+
+    1. 按文件大小分组，大小唯一的文件直接判定为唯一（不读内容）
+    2. 同大小的文件计算首尾块快速指纹再分组
+    3. 指纹相同的候选计算全文件哈希确认
+
+    每组重复文件中保留顺序最靠前的一个为规范文件（known在前，其余按paths
+    顺序）。known为已处理过的文件（例如上一批的源文件夹），不会出现在结果
+    的unique中，与其内容相同的文件判定为重复。
+
+    返回 {"unique": [...], "duplicates": {规范文件: [重复文件...]}, "errors": {...},
+    "files": 输入文件数, "duplicate_bytes": 重复文件总大小}。
+    """
+    known_set = set(known)
+    ordered = list(dict.fromkeys(list(known) + list(paths)))
+    order = {path: i for i, path in enumerate(ordered)}
+
+    errors = {}
+    by_size = defaultdict(list)
+    for path in ordered:
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            errors[path] = str(e)
+            continue
+        by_size[size].append((size, path))
+    candidates = [group for group in by_size.values() if len(group) > 1]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        candidates = _regroup(candidates, _quick_key, executor, errors, "快速指纹" if progress else None)
+        groups = _regroup(candidates, _full_key, executor, errors, "全文件哈希" if progress else None)
+
+    duplicates = {}
+    duplicate_set = set()
+    duplicate_bytes = 0
+    for group in groups:
+        group.sort(key=lambda item: order[item[1]])
+        canonical = group[0][1]
+        dups = [path for _, path in group[1:]]
+        duplicates[canonical] = dups
+        duplicate_set.update(dups)
+        duplicate_bytes += group[0][0] * sum(1 for path in dups if path not in known_set)
+
+    unique = [path for path in dict.fromkeys(paths)
+              if path not in duplicate_set and path not in known_set and path not in errors]
+    return {
+        "unique": unique,
+        "duplicates": duplicates,
+        "errors": errors,
+        "files": len(set(paths)),
+        "duplicate_bytes": duplicate_bytes,
+    }
+
+
+def unique_target_name(file_name: str, used_names: set) -> str:
+    """同名但内容不同的文件改名为 {stem}_{n}.psd，避免互相覆盖"""
+    if file_name not in used_names:
+        used_names.add(file_name)
+        return file_name
+    stem, ext = os.path.splitext(file_name)
+    n = 2
+    while f"{stem}_{n}{ext}" in used_names:
+        n += 1
+    name = f"{stem}_{n}{ext}"
+    used_names.add(name)
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(description='按内容去重PSD文件，输出规范的唯一文件列表')
+    parser.add_argument('folders', nargs='+', help='源文件夹（按优先级排列，重复时保留靠前文件夹中的文件）')
+    parser.add_argument('-k', '--known', nargs='*', default=[],
+                        help='已处理过的文件夹，与其中文件内容相同的文件视为重复')
+    parser.add_argument('-o', '--output', default='unique_psd_files.json', help='结果JSON路径')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS, help='哈希线程数')
+    args = parser.parse_args()
+
+    paths = [p for folder in args.folders for p in find_psd_files(folder)]
+    known = [p for folder in args.known for p in find_psd_files(folder)]
+    print(f"找到 {len(paths)} 个PSD文件" + (f"，已处理 {len(known)} 个" if known else ""))
+
+    result = dedupe_files(paths, known, args.workers)
+    duplicate_count = result['files'] - len(result['unique']) - len(result['errors'])
+    print(f"唯一文件: {len(result['unique'])}，重复: {duplicate_count}"
+          f"（{result['duplicate_bytes'] / 1024 / 1024 / 1024:.2f} GB），读取失败: {len(result['errors'])}")
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+from typing import Dict, Optional
+
+PSD_SIGNATURE = b"8BPS"
+
+# 颜色模式编号（PSD规范）
+COLOR_MODES = {
+    0: "bitmap",
+    1: "grayscale",
+    2: "indexed",
+    3: "rgb",
+    4: "cmyk",
+    7: "multichannel",
+    8: "duotone",
+    9: "lab",
+}
+
+
+def read_psd_header(path: str) -> Optional[Dict]:
+    """
+    只读取PSD/PSB文件头和图层记录（不解码任何像素）
+
+    与 psd_index 使用同一套解析（scan_psd），图层数的定义一致：非组图层数，
+    不含组记录和组结束分隔符；16/32位文件的图层记录在 Lr16/Lr32 块中同样能读到。
+    解析失败返回None。
+    """
+    from psd_index import scan_psd, header_from_row
+
+    row = scan_psd(path)
+    if row["error"]:
+        return None
+    return header_from_row(row)
@@ -0,0 +1,375 @@
+import os
+import io
+import time
+import struct
+import argparse
+import multiprocessing
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+from tqdm import tqdm
+from psd_header import PSD_SIGNATURE, COLOR_MODES
+
+# 默认索引文件名（放在PSD文件夹根目录）
+INDEX_FILENAME = "_psd_index.npz"
+
+# PSB中长度字段为8字节的附加信息块
+BIG_KEYS = {
+    b'Alph', b'FELS', b'FEid', b'FMsk', b'FXid', b'LMsk', b'Layr', b'Lr16', b'Lr32',
+    b'Mt16', b'Mt32', b'Mtrn', b'PxSD', b'artd', b'cinf', b'extd', b'extn',
+    b'lnk2', b'lnk3', b'lnkE', b'pths',
+}
+SECTION_KEYS = (b'lsct', b'lsdk')
+TEXT_KEYS = (b'TySh',)
+SMART_OBJECT_KEYS = (b'SoLd', b'SoLE', b'PlLd', b'plLd')
+FILL_KEYS = (b'SoCo', b'GdFl', b'PtFl')
+VECTOR_KEYS = (b'vmsk', b'vsms', b'vscg')
+ADJUSTMENT_KEYS = (
+    b'CgEd', b'blnc', b'blwh', b'clrL', b'curv', b'expA', b'grdm', b'hue2',
+    b'levl', b'mixr', b'nvrt', b'phfl', b'post', b'selc', b'thrs', b'vibA',
+)
+
+# 图像资源ID
+RESOURCE_VERSION_INFO = 1057
+RESOURCE_THUMBNAIL = 1036
+
+# 索引列及类型（字符串列单独处理）
+COLUMNS = {
+    "path": str,
+    "file_size": np.int64,
+    "mtime_ns": np.int64,
+    "version": np.int8,
+    "width": np.int32,
+    "height": np.int32,
+    "channels": np.int16,
+    "depth": np.int16,
+    "color_mode": str,
+    "layer_count": np.int32,
+    "group_count": np.int32,
+    "max_group_depth": np.int16,
+    "hidden_count": np.int32,
+    "text_count": np.int32,
+    "shape_count": np.int32,
+    "smart_object_count": np.int32,
+    "adjustment_count": np.int32,
+    "mask_count": np.int32,
+    "layer_data_bytes": np.int64,
+    "has_merged_image": np.bool_,
+    "merged_compression": np.int8,
+    "has_thumbnail": np.bool_,
+    "error": str,
+}
+
+
+def _read(f, fmt: str):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError("unexpected end of file")
+    return struct.unpack(fmt, data)
+
+
+def _read_image_resources(data: bytes) -> Dict[int, bytes]:
+    """解析图像资源段，只保留需要的资源"""
+    resources = {}
+    pos = 0
+    while pos + 12 <= len(data):
+        if data[pos:pos + 4] != b'8BIM':
+            break
+        (resource_id,) = struct.unpack_from(">H", data, pos + 4)
+        name_length = data[pos + 6]
+        pos += 6 + ((name_length + 2) & ~1)  # Pascal字符串（含长度字节）补齐到偶数
+        (size,) = struct.unpack_from(">I", data, pos)
+        pos += 4
+        if resource_id in (RESOURCE_VERSION_INFO, RESOURCE_THUMBNAIL):
+            resources[resource_id] = data[pos:pos + size]
+        pos += (size + 1) & ~1
+    return resources
+
+
+def _iter_tagged_blocks(data: bytes, version: int, padding: int = 1):
+    """遍历附加图层信息块，产生 (key, 数据起点, 数据终点)"""
+    pos = 0
+    while pos + 12 <= len(data):
+        if data[pos:pos + 4] not in (b'8BIM', b'8B64'):
+            break
+        key = data[pos + 4:pos + 8]
+        if version == 2 and key in BIG_KEYS:
+            (length,) = struct.unpack_from(">Q", data, pos + 8)
+            pos += 16
+        else:
+            (length,) = struct.unpack_from(">I", data, pos + 8)
+            pos += 12
+        yield key, pos, pos + length
+        pos += length
+        if padding > 1 and pos % padding:
+            pos += padding - pos % padding
+
+
+def _scan_layer_records(f, version: int, row: Dict):
+    """
+    逐条解析图层记录（不读取通道图像数据）
+
+    文件中图层按从下到上的顺序排列，组以“分隔符记录(类型3)……组记录(类型1/2)”
+    的形式出现，据此计算组数和最大嵌套深度。
+    """
+    (count,) = _read(f, ">h")
+    count = abs(count)
+    channel_length_fmt = ">Q" if version == 2 else ">I"
+    channel_entry = 2 + struct.calcsize(channel_length_fmt)
+
+    depth = 0
+    for _ in range(count):
+        _read(f, ">4i")
+        (num_channels,) = _read(f, ">H")
+        channel_data = f.read(num_channels * channel_entry)
+        for i in range(num_channels):
+            (length,) = struct.unpack_from(channel_length_fmt, channel_data, i * channel_entry + 2)
+            row["layer_data_bytes"] += length
+        _signature, _blend, _opacity, _clipping, flags = _read(f, ">4s4sBBBx")
+        (extra_length,) = _read(f, ">I")
+        extra = f.read(extra_length)
+
+        (mask_length,) = struct.unpack_from(">I", extra, 0)
+        pos = 4 + mask_length
+        (ranges_length,) = struct.unpack_from(">I", extra, pos)
+        pos += 4 + ranges_length
+        name_length = extra[pos]
+        pos += (name_length + 1 + 3) & ~3  # Pascal字符串补齐到4字节
+
+        keys = {}
+        for key, start, end in _iter_tagged_blocks(extra[pos:], version):
+            keys[key] = (start + pos, end + pos)
+
+        section = next((keys[k] for k in SECTION_KEYS if k in keys), None)
+        section_type = 0
+        if section is not None and section[1] - section[0] >= 4:
+            (section_type,) = struct.unpack_from(">I", extra, section[0])
+
+        if section_type == 3:
+            # 组的结束分隔符（位于组内容下方）
+            depth += 1
+            row["max_group_depth"] = max(row["max_group_depth"], depth)
+            continue
+        if section_type in (1, 2):
+            depth = max(0, depth - 1)
+            row["group_count"] += 1
+        else:
+            row["layer_count"] += 1
+            if any(k in keys for k in TEXT_KEYS):
+                row["text_count"] += 1
+            elif any(k in keys for k in SMART_OBJECT_KEYS):
+                row["smart_object_count"] += 1
+            elif any(k in keys for k in VECTOR_KEYS) and (
+                    b'vscg' in keys or any(k in keys for k in FILL_KEYS)):
+                row["shape_count"] += 1
+            elif any(k in keys for k in ADJUSTMENT_KEYS + FILL_KEYS):
+                row["adjustment_count"] += 1
+
+        if flags & 0x02:
+            row["hidden_count"] += 1
+        if mask_length:
+            row["mask_count"] += 1
+
+
+def _scan_layer_info(f, version: int, row: Dict, end: int):
+    """读取图层信息（长度 + 图层记录），记录之后的通道图像数据直接跳过"""
+    length_fmt = ">Q" if version == 2 else ">I"
+    (length,) = _read(f, length_fmt)
+    start = f.tell()
+    if length:
+        _scan_layer_records(f, version, row)
+    f.seek(min(start + length, end))
+    return length
+
+
+def empty_row(path: str) -> Dict:
+    row = {name: (0 if kind is not str else "") for name, kind in COLUMNS.items()}
+    row.update(path=path, has_merged_image=False, has_thumbnail=False)
+    return row
+
+
+def scan_psd(path: str) -> Dict:
+    """
+    只解析文件头、图像资源和图层记录，生成一行索引
+
+    所有像素数据（图层通道数据和合并图像）都通过seek跳过，不做解压。
+    解析失败时error列记录原因，其余列保留已读到的部分。
+    """
+    row = empty_row(path)
+    try:
+        st = os.stat(path)
+        row["file_size"] = st.st_size
+        row["mtime_ns"] = st.st_mtime_ns
+        with open(path, 'rb', buffering=64 * 1024) as f:
+            signature, version, channels, height, width, depth, color_mode = _read(f, ">4sH6xHIIHH")
+            if signature != PSD_SIGNATURE or version not in (1, 2):
+                raise ValueError("not a PSD/PSB file")
+            row.update(version=version, channels=channels, height=height, width=width,
+                       depth=depth, color_mode=COLOR_MODES.get(color_mode, str(color_mode)))
+
+            # 颜色模式数据
+            (length,) = _read(f, ">I")
+            f.seek(length, io.SEEK_CUR)
+
+            # 图像资源：是否有真实的合并图像（“最大兼容”），是否有缩略图
+            (length,) = _read(f, ">I")
+            resources = _read_image_resources(f.read(length))
+            version_info = resources.get(RESOURCE_VERSION_INFO)
+            row["has_merged_image"] = bool(version_info[4]) if version_info and len(version_info) > 4 else True
+            row["has_thumbnail"] = RESOURCE_THUMBNAIL in resources
+
+            # 图层与蒙版信息段
+            length_fmt = ">Q" if version == 2 else ">I"
+            (section_length,) = _read(f, length_fmt)
+            section_start = f.tell()
+            section_end = section_start + section_length
+            if section_length:
+                layer_info_length = _scan_layer_info(f, version, row, section_end)
+                (global_mask_length,) = _read(f, ">I")
+                f.seek(global_mask_length, io.SEEK_CUR)
+
+                # 16/32位文件的图层信息在 Lr16/Lr32 附加信息块中
+                if not layer_info_length and f.tell() < section_end:
+                    tail = f.read(section_end - f.tell())
+                    for key, start, end in _iter_tagged_blocks(tail, version, padding=4):
+                        if key in (b'Layr', b'Lr16', b'Lr32'):
+                            _scan_layer_records(io.BytesIO(tail[start:end]), version, row)
+                            break
+            f.seek(section_end)
+
+            # 合并图像只读取压缩方式
+            data = f.read(2)
+            if len(data) == 2:
+                (row["merged_compression"],) = struct.unpack(">H", data)
+    except (OSError, EOFError, ValueError, struct.error, IndexError) as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+    return row
+
+
+def rows_to_columns(rows: List[Dict]) -> Dict[str, np.ndarray]:
+    columns = {}
+    for name, kind in COLUMNS.items():
+        values = [row[name] for row in rows]
+        columns[name] = np.array(values, dtype=str if kind is str else kind)
+    return columns
+
+
+def save_index(index_path: str, columns: Dict[str, np.ndarray]):
+    """保存为列式索引（.npz 每列一个数组；.parquet 需要pyarrow）"""
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    if index_path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.table(columns), index_path)
+        return
+    tmp_path = f"{index_path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, index_path)
+
+
+def load_index(index_path: str, columns: Optional[Sequence[str]] = None) -> Dict[str, np.ndarray]:
+    """读取索引（只加载需要的列）"""
+    if index_path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(index_path, columns=list(columns) if columns else None)
+        return {name: table.column(name).to_numpy() for name in table.column_names}
+    with np.load(index_path) as data:
+        names = columns or data.files
+        return {name: data[name] for name in names}
+
+
+def header_from_row(row) -> Dict:
+    """
+    一行索引转换为 read_psd_header 格式的字典
+
+    layer_count 为非组图层数（与psd_tools中 descendants() 去掉组后的数量一致），
+    组记录和组结束分隔符都不计入，group_count 单独给出。
+    """
+    return {
+        "version": int(row["version"]),
+        "channels": int(row["channels"]),
+        "height": int(row["height"]),
+        "width": int(row["width"]),
+        "depth": int(row["depth"]),
+        "color_mode": str(row["color_mode"]),
+        "layer_count": int(row["layer_count"]),
+        "group_count": int(row["group_count"]),
+    }
+
+
+def load_headers(index_path: str, check_stale: bool = True) -> Dict[str, Dict]:
+    """
+    按路径返回 read_psd_header 格式的字典（供 estimate_peak_mb 等直接使用）
+
+    解析失败的文件不包含在内；check_stale时大小或修改时间与索引不一致
+    （建索引后被修改、替换或删除）的文件也不包含，调用方改为直接读文件头。
+    """
+    names = ["path", "file_size", "mtime_ns", "version", "channels", "height", "width", "depth",
+             "color_mode", "layer_count", "group_count", "error"]
+    data = load_index(index_path, names)
+    headers = {}
+    for i, path in enumerate(data["path"]):
+        if data["error"][i]:
+            continue
+        path = str(path)
+        if check_stale:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size != data["file_size"][i] or st.st_mtime_ns != data["mtime_ns"][i]:
+                continue
+        headers[path] = header_from_row({name: column[i] for name, column in data.items()})
+    return headers
+
+
+def build_index(psd_files: List[str], num_workers: int = 1) -> Dict[str, np.ndarray]:
+    """扫描所有PSD，返回列式索引"""
+    if num_workers > 1:
+        with multiprocessing.Pool(num_workers) as pool:
+            rows = list(tqdm(pool.imap(scan_psd, psd_files, chunksize=64),
+                             total=len(psd_files), desc="扫描PSD"))
+    else:
+        rows = [scan_psd(p) for p in tqdm(psd_files, desc="扫描PSD")]
+    return rows_to_columns(rows)
+
+
+def print_summary(columns: Dict[str, np.ndarray], seconds: float):
+    total = len(columns["path"])
+    errors = int(np.count_nonzero(columns["error"] != ""))
+    print(f"文件数: {total}, 解析失败: {errors}, 耗时: {seconds:.2f}s "
+          f"({total / max(seconds, 1e-9):.0f} 个/秒)")
+    if total == errors:
+        return
+    ok = columns["error"] == ""
+    modes, counts = np.unique(columns["color_mode"][ok], return_counts=True)
+    print("颜色模式: " + ", ".join(f"{m}={c}" for m, c in zip(modes, counts)))
+    depths, counts = np.unique(columns["depth"][ok], return_counts=True)
+    print("位深: " + ", ".join(f"{d}={c}" for d, c in zip(depths, counts)))
+    print(f"图层数: 中位数 {np.median(columns['layer_count'][ok]):.0f}, 最大 {columns['layer_count'][ok].max()}")
+    print(f"最大组嵌套深度: {columns['max_group_depth'][ok].max()}")
+    print(f"无真实合并图像: {int(np.count_nonzero(~columns['has_merged_image'][ok]))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='只解析文件头和图层记录，生成PSD列式索引')
+    parser.add_argument('folder', help='PSD文件夹（递归）')
+    parser.add_argument('-o', '--output', default=None, help=f'索引路径（默认 <folder>/{INDEX_FILENAME}，.parquet 需要pyarrow）')
+    parser.add_argument('-j', '--workers', type=int, default=multiprocessing.cpu_count(), help='进程数')
+    args = parser.parse_args()
+
+    psd_files = sorted(os.path.join(root, f)
+                       for root, _, names in os.walk(args.folder)
+                       for f in names if f.lower().endswith(('.psd', '.psb')))
+    output = args.output or os.path.join(args.folder, INDEX_FILENAME)
+
+    t0 = time.perf_counter()
+    columns = build_index(psd_files, args.workers)
+    seconds = time.perf_counter() - t0
+    save_index(output, columns)
+    print_summary(columns, seconds)
+    print(f"索引已保存: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import os
+import json
+import time
+import socket
+import hashlib
+import threading
+from typing import Callable, Dict, Optional, Sequence
+import psutil
+from psd_manifest import PSDManifest, STATUS_DONE, STATUS_FAILED
+from psd_scheduler import MemoryBudgetScheduler, DEFAULT_MAX_BYPASS
+
+# 租约目录（放在共享的输出文件夹根目录）
+LEASE_DIRNAME = "_leases"
+DEFAULT_TTL_SECONDS = 600
+DEFAULT_HEARTBEAT_SECONDS = 30
+
+# claim() 的结果
+LEASE_CLAIMED = "claimed"  # 本节点取得租约
+LEASE_HELD = "held"  # 其他节点持有未过期的租约
+LEASE_FINISHED = "finished"  # 已有节点处理完（或记录为坏文件）
+
+
+def default_node_id() -> str:
+    return socket.gethostname()
+
+
+class LeaseBoard:
+    """
+    共享存储上基于租约文件的多节点任务认领
+
+    每个PSD对应 _leases/xx/{路径哈希}.lease，用 O_CREAT|O_EXCL 原子创建，
+    创建成功的节点取得租约。持有期间心跳线程定期更新租约文件的修改时间；
+    修改时间超过ttl未更新（节点宕机、断网）的租约可被其他节点回收：先把
+    租约文件改名（只有一个节点能成功），确认期间持有者没有续约后删除并重新创建。
+    本机上进程已退出的同名节点遗留的租约立即回收（节点重启后不必等待过期）。
+
+    处理结束后写 {路径哈希}.done 标记（内容为本节点清单中的记录），其他节点
+    据此跳过：本次运行期间写的标记直接信任（同一批运行中各节点的输出在标记
+    写出前已落盘）；之前运行的done标记按清单规则校验文件未变化且输出齐全，
+    其他失败状态下次运行重试；skip_statuses中的状态（超时、崩溃）始终视为
+    坏文件跳过（文件被修改或替换后重新处理）。
+
+    心跳时发现租约已被其他节点回收（本节点曾失联超过ttl）时调用on_lost(psd_path)，
+    调用方应立即终止该文件的处理：此后该文件归新的持有者，finish不再写标记。
+    清单（SQLite）只在本机的进程间共享，放在本地磁盘上，节点间的协调只通过租约文件。
+
+    依赖各节点时钟同步（NTP），ttl应远大于心跳间隔。
+    """
+
+    def __init__(self, output_folder: str, manifest: PSDManifest, node_id: Optional[str] = None,
+                 ttl: float = DEFAULT_TTL_SECONDS, heartbeat: float = DEFAULT_HEARTBEAT_SECONDS,
+                 skip_statuses: Sequence[str] = (), on_lost: Optional[Callable[[str], None]] = None):
+        self.output_folder = output_folder
+        self.root = os.path.join(output_folder, LEASE_DIRNAME)
+        self.manifest = manifest
+        self.node_id = node_id or default_node_id()
+        self.host = socket.gethostname()
+        self.ttl = ttl
+        self.heartbeat = heartbeat
+        self.skip_statuses = set(skip_statuses)
+        self.on_lost = on_lost
+        self.started_at = time.time()
+        self.held = {}  # PSD路径 -> 租约文件路径
+        self.lost = set()  # 心跳时发现已被其他节点回收的租约（重新认领前finish不写标记）
+        self.counters = {"claimed": 0, "reclaimed": 0, "held_elsewhere": 0, "finished_elsewhere": 0, "lost": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _paths(self, psd_path: str):
+        digest = hashlib.blake2b(os.path.abspath(psd_path).encode('utf-8'), digest_size=16).hexdigest()
+        base = os.path.join(self.root, digest[:2], digest)
+        return f"{base}.lease", f"{base}.done"
+
+    @staticmethod
+    def _read_json(path: str) -> Optional[Dict]:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _is_finished(self, psd_path: str, marker: Optional[Dict]) -> bool:
+        if marker is None:
+            return False
+        status = marker.get("status")
+        if status in self.skip_statuses:
+            return self.manifest.is_unchanged(psd_path, marker)
+        if marker.get("finished_at", 0) >= self.started_at:
+            return True
+        return status == STATUS_DONE and self.manifest.is_complete(psd_path, self.output_folder, marker)
+
+    def _is_own_orphan(self, lease: Optional[Dict]) -> bool:
+        """本机同名节点遗留的租约（持有进程已退出）"""
+        return (lease is not None and lease.get("node") == self.node_id
+                and lease.get("host") == self.host and lease.get("pid") != os.getpid()
+                and not psutil.pid_exists(lease.get("pid", 0)))
+
+    def _create(self, psd_path: str, lease_path: str) -> bool:
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({"node": self.node_id, "host": self.host, "pid": os.getpid(),
+                       "path": psd_path, "claimed_at": time.time()}, f, ensure_ascii=False)
+        with self._lock:
+            self.held[psd_path] = lease_path
+            self.lost.discard(psd_path)
+        return True
+
+    def _reclaim(self, lease_path: str, force: bool) -> bool:
+        """回收过期租约，返回租约文件是否已被移除"""
+        tomb_path = f"{lease_path}.{self.node_id}.{os.getpid()}.stale"
+        try:
+            os.rename(lease_path, tomb_path)
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+        try:
+            # 判断过期后、改名前持有者恰好续约：放回原处
+            if not force and time.time() - os.stat(tomb_path).st_mtime < self.ttl:
+                try:
+                    os.link(tomb_path, lease_path)
+                except FileExistsError:
+                    pass
+                return False
+            return True
+        finally:
+            try:
+                os.unlink(tomb_path)
+            except OSError:
+                pass
+
+    def claim(self, psd_path: str) -> str:
+        """尝试认领一个PSD，返回 LEASE_CLAIMED / LEASE_HELD / LEASE_FINISHED"""
+        lease_path, done_path = self._paths(psd_path)
+        if self._is_finished(psd_path, self._read_json(done_path)):
+            self.counters["finished_elsewhere"] += 1
+            return LEASE_FINISHED
+        os.makedirs(os.path.dirname(lease_path), exist_ok=True)
+        if self._create(psd_path, lease_path):
+            self.counters["claimed"] += 1
+            return LEASE_CLAIMED
+
+        try:
+            age = time.time() - os.stat(lease_path).st_mtime
+        except FileNotFoundError:
+            age = None
+        orphan = self._is_own_orphan(self._read_json(lease_path))
+        if (age is None or age > self.ttl or orphan) and self._reclaim(lease_path, orphan):
+            # 被回收的节点可能在租约过期前已经写完标记
+            if self._is_finished(psd_path, self._read_json(done_path)):
+                self.counters["finished_elsewhere"] += 1
+                return LEASE_FINISHED
+            if self._create(psd_path, lease_path):
+                self.counters["reclaimed"] += 1
+                return LEASE_CLAIMED
+        self.counters["held_elsewhere"] += 1
+        return LEASE_HELD
+
+    def _owns(self, lease_path: str) -> bool:
+        lease = self._read_json(lease_path)
+        return lease is not None and lease.get("node") == self.node_id and lease.get("pid") == os.getpid()
+
+    def is_lost(self, psd_path: str) -> bool:
+        with self._lock:
+            return psd_path in self.lost
+
+    def finish(self, psd_path: str, record: Optional[Dict]) -> bool:
+        """
+        写完成标记并释放租约（record为本节点清单中该PSD的记录）
+
+        租约已丢失时只释放、不写标记（文件已由其他节点接手），返回False。
+        """
+        if self.is_lost(psd_path):
+            self.release(psd_path)
+            return False
+        lease_path, done_path = self._paths(psd_path)
+        marker = dict(record or {"status": STATUS_FAILED})
+        marker.update(node=self.node_id, finished_at=time.time())
+        tmp_path = f"{done_path}.{self.node_id}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(marker, f, ensure_ascii=False)
+        os.replace(tmp_path, done_path)
+        self.release(psd_path)
+        return True
+
+    def release(self, psd_path: str):
+        """释放租约（不写标记，其他节点可以立即认领）"""
+        with self._lock:
+            lease_path = self.held.pop(psd_path, None)
+        if lease_path is not None and self._owns(lease_path):
+            try:
+                os.unlink(lease_path)
+            except FileNotFoundError:
+                pass
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                held = list(self.held.items())
+            for psd_path, lease_path in held:
+                try:
+                    if not self._owns(lease_path):
+                        raise FileNotFoundError(lease_path)
+                    os.utime(lease_path)
+                except OSError:
+                    with self._lock:
+                        newly_lost = psd_path in self.held and psd_path not in self.lost
+                        if newly_lost:
+                            self.lost.add(psd_path)
+                            self.counters["lost"] += 1
+                    if newly_lost:
+                        print(f"\nLease lost (reclaimed by another node?), aborting: {psd_path}")
+                        if self.on_lost is not None:
+                            self.on_lost(psd_path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """停止心跳并释放仍持有的租约（中断时其他节点不必等待过期）"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            held = list(self.held)
+        for psd_path in held:
+            self.release(psd_path)
+
+    def stats(self) -> Dict:
+        return dict(self.counters)
+
+
+class LeaseScheduler(MemoryBudgetScheduler):
+    """
+    多节点模式的调度器：内存预算准入后再认领租约
+
+    其他节点已完成的任务直接丢弃（调用on_skip）；其他节点正在处理的任务
+    暂存，本节点队列清空后每隔recheck秒重新检查一次，持有者完成则丢弃，
+    租约过期（节点宕机）则回收处理。所有任务都有结果后才结束。
+    """
+
+    def __init__(self, budget_mb: float, leases: LeaseBoard, recheck_seconds: float = 30.0,
+                 on_skip: Optional[Callable[[str], None]] = None, max_bypass: int = DEFAULT_MAX_BYPASS):
+        super().__init__(budget_mb, max_bypass)
+        self.leases = leases
+        self.recheck_seconds = recheck_seconds
+        self.on_skip = on_skip
+        self.deferred = []  # [(estimate_mb, task)]，其他节点持有租约
+        self._next_recheck = 0.0
+
+    def __len__(self):
+        return len(self.pending) + len(self.deferred)
+
+    def pop_admissible(self, running_count: int):
+        while True:
+            admitted = super().pop_admissible(running_count)
+            if admitted is None:
+                break
+            task, estimate = admitted
+            state = self.leases.claim(task)
+            if state == LEASE_CLAIMED:
+                return admitted
+            self.finish(estimate)
+            if state == LEASE_HELD:
+                self.deferred.append((estimate, task))
+            elif self.on_skip is not None:
+                self.on_skip(task)
+
+        if self.deferred and not self.pending:
+            now = time.monotonic()
+            if now >= self._next_recheck:
+                self._next_recheck = now + self.recheck_seconds
+                deferred, self.deferred = self.deferred, []
+                self.add_tasks([task for _, task in deferred], [estimate for estimate, _ in deferred])
+                return self.pop_admissible(running_count)
+            if running_count == 0:
+                # 只剩其他节点正在处理的任务，等待下次检查
+                time.sleep(min(self.recheck_seconds, max(0.0, self._next_recheck - now), 5.0))
+        return None
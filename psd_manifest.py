@@ -0,0 +1,295 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+from typing import Dict, List, Optional, Sequence
+
+# 旧版本放在输出文件夹根目录的清单文件名（首次打开时迁移到本机）
+MANIFEST_FILENAME = "_manifest.sqlite"
+# 清单默认放在本机磁盘：输出文件夹通常在NFS上，SQLite的WAL和文件锁在网络文件系统上不可用
+MANIFEST_DIR = os.path.join(os.path.expanduser("~"), ".cache", "psd_processing")
+
+# 处理状态
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_TIMEOUT = "timeout"  # 超过单文件时限，工作进程被终止
+STATUS_CRASHED = "crashed"  # 工作进程异常退出（段错误、OOM被杀等）
+
+HASH_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def content_hash(path: str, block_size: int = HASH_BLOCK_SIZE) -> str:
+    """计算文件内容哈希（blake2b，分块读取）"""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def default_manifest_path(output_folder: str) -> str:
+    """本机上某个输出文件夹对应的清单路径（按输出文件夹绝对路径区分）"""
+    folder = os.path.abspath(output_folder)
+    key = hashlib.blake2b(folder.encode('utf-8'), digest_size=8).hexdigest()
+    name = os.path.basename(folder.rstrip(os.sep)) or "output"
+    return os.path.join(MANIFEST_DIR, f"{name}-{key}.sqlite")
+
+
+def resolve_manifest_path(output_folder: str, configured: Optional[str] = None) -> str:
+    """
+    清单路径：指定了就用指定的，否则用本机默认路径
+
+    本机还没有清单而输出文件夹里有旧版本的 _manifest.sqlite 时，先用SQLite
+    备份接口复制一份过来，断点续跑的记录不会丢失。
+    """
+    path = configured or default_manifest_path(output_folder)
+    legacy = os.path.join(output_folder, MANIFEST_FILENAME)
+    if not os.path.exists(path) and os.path.exists(legacy) and os.path.abspath(legacy) != os.path.abspath(path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        src = sqlite3.connect(legacy)
+        dst = sqlite3.connect(path)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    return path
+
+
+def file_stat(path: str):
+    """获取文件大小和修改时间（纳秒）"""
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns
+
+
+class PSDManifest:
+    """
+    PSD处理清单（SQLite，多进程共享）
+
+    每个PSD记录路径、大小、修改时间、处理状态、图层数和输出文件列表。
+    数据库应放在本机磁盘上（见 resolve_manifest_path），不要放在NFS上。
+    只有状态为done且输出文件齐全的PSD才会被跳过，running状态（进程崩溃遗留）
+    或输出不完整的PSD会被清理后重新处理。
+    """
+
+    def __init__(self, db_path: str, timeout: float = 60.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """每个进程使用独立连接（sqlite连接不能跨fork共享）"""
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, timeout=self.timeout)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS psd_files (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime_ns INTEGER,
+                    content_hash TEXT,
+                    status TEXT,
+                    layer_count INTEGER,
+                    outputs TEXT,
+                    error TEXT,
+                    updated_at REAL
+                )
+            """)
+            self._conn.commit()
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, psd_path: str) -> Optional[Dict]:
+        """读取单个PSD的记录"""
+        row = self.conn.execute(
+            "SELECT path, size, mtime_ns, content_hash, status, layer_count, outputs, error "
+            "FROM psd_files WHERE path = ?", (psd_path,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            "path": row[0],
+            "size": row[1],
+            "mtime_ns": row[2],
+            "content_hash": row[3],
+            "status": row[4],
+            "layer_count": row[5],
+            "outputs": json.loads(row[6]) if row[6] else [],
+            "error": row[7],
+        }
+
+    def load_all(self) -> Dict[str, Dict]:
+        """一次性读取全部记录（主进程批量过滤用）"""
+        rows = self.conn.execute(
+            "SELECT path, size, mtime_ns, content_hash, status, layer_count, outputs FROM psd_files"
+        ).fetchall()
+        return {
+            row[0]: {
+                "path": row[0],
+                "size": row[1],
+                "mtime_ns": row[2],
+                "content_hash": row[3],
+                "status": row[4],
+                "layer_count": row[5],
+                "outputs": json.loads(row[6]) if row[6] else [],
+            }
+            for row in rows
+        }
+
+    def _upsert(self, psd_path: str, **fields):
+        fields["updated_at"] = time.time()
+        columns = ["path"] + list(fields)
+        placeholders = ", ".join("?" for _ in columns)
+        updates = ", ".join(f"{c} = excluded.{c}" for c in fields)
+        self.conn.execute(
+            f"INSERT INTO psd_files ({', '.join(columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(path) DO UPDATE SET {updates}",
+            [psd_path] + list(fields.values())
+        )
+        self.conn.commit()
+
+    def mark_running(self, psd_path: str):
+        """开始处理前标记（崩溃后该状态会保留，下次运行重新处理）"""
+        size, mtime_ns = file_stat(psd_path)
+        self._upsert(psd_path, size=size, mtime_ns=mtime_ns, status=STATUS_RUNNING, error=None)
+
+    def mark_done(self, psd_path: str, layer_count: int, outputs: List[str]):
+        """所有输出写完后标记完成，outputs为相对输出文件夹的路径"""
+        size, mtime_ns = file_stat(psd_path)
+        self._upsert(
+            psd_path,
+            size=size,
+            mtime_ns=mtime_ns,
+            content_hash=None,
+            status=STATUS_DONE,
+            layer_count=layer_count,
+            outputs=json.dumps(outputs, ensure_ascii=False),
+            error=None,
+        )
+
+    def mark_failed(self, psd_path: str, error: str, status: str = STATUS_FAILED):
+        """记录失败（异常、超时、崩溃等）"""
+        self._upsert(psd_path, status=status, error=error[:2000])
+
+    @staticmethod
+    def is_unchanged(psd_path: str, record: Optional[Dict]) -> bool:
+        """文件的大小和修改时间与记录一致（记录后未被修改或替换）"""
+        if not record or record.get("size") is None:
+            return False
+        try:
+            return file_stat(psd_path) == (record["size"], record["mtime_ns"])
+        except OSError:
+            return False
+
+    def is_complete(self, psd_path: str, output_folder: str, record: Optional[Dict] = None) -> bool:
+        """
+        判断PSD是否已完整处理
+
+        大小和修改时间一致时直接信任记录。不一致时只有旧版本记录里存有内容
+        哈希才计算当前文件的哈希比对（完成时不再为每个PSD整读一遍算哈希），
+        否则视为未完成重新处理。最后检查记录的输出文件是否都存在。
+        """
+        if record is None:
+            record = self.get(psd_path)
+        if not record or record["status"] != STATUS_DONE:
+            return False
+
+        try:
+            size, mtime_ns = file_stat(psd_path)
+        except OSError:
+            return False
+
+        if size != record["size"]:
+            return False
+        if mtime_ns != record["mtime_ns"]:
+            if not record["content_hash"] or content_hash(psd_path) != record["content_hash"]:
+                return False
+
+        return all(os.path.exists(os.path.join(output_folder, p)) for p in record["outputs"])
+
+    def pending(self, psd_files: List[str], output_folder: str,
+                skip_statuses: Sequence[str] = ()) -> List[str]:
+        """
+        过滤出需要（重新）处理的PSD文件
+
+        skip_statuses中的状态（如超时、崩溃）视为已知坏文件，同样跳过；
+        文件在记录后被修改或替换时重新处理。
+        """
+        records = self.load_all()
+        result = []
+        for p in psd_files:
+            record = records.get(p)
+            if record and record["status"] in skip_statuses and self.is_unchanged(p, record):
+                continue
+            if not self.is_complete(p, output_folder, record):
+                result.append(p)
+        return result
+
+    def output_owner(self, rel_folder: str, psd_path: str) -> Optional[str]:
+        """记录为已完成、且输出在rel_folder（相对输出文件夹）下的其他PSD，没有时返回None"""
+        prefix = rel_folder.rstrip('/') + '/'
+        rows = self.conn.execute(
+            "SELECT path, outputs FROM psd_files WHERE status = ? AND path != ? AND outputs LIKE ?",
+            (STATUS_DONE, psd_path, f'%{json.dumps(prefix, ensure_ascii=False)[:-1]}%')
+        ).fetchall()
+        for path, outputs in rows:
+            if any(o.startswith(prefix) for o in json.loads(outputs or "[]")):
+                return path
+        return None
+
+    def clear_output_folder(self, psd_path: str, output_folder: str, file_id: str):
+        """
+        清理该PSD上次未完成的输出文件夹
+
+        文件夹是另一个已完成PSD的输出（同名PSD）时不删除，抛出ValueError。
+        """
+        file_output_folder = os.path.join(output_folder, file_id)
+        if not os.path.isdir(file_output_folder):
+            return
+        owner = self.output_owner(file_id, psd_path)
+        if owner is not None:
+            raise ValueError(f"output folder {file_id} belongs to {owner}")
+        clear_partial_output(file_output_folder)
+
+    def failures(self, statuses: Sequence[str] = (STATUS_FAILED, STATUS_TIMEOUT, STATUS_CRASHED)) -> List[Dict]:
+        """列出失败/超时/崩溃的PSD及错误信息"""
+        placeholders = ", ".join("?" for _ in statuses)
+        rows = self.conn.execute(
+            f"SELECT path, status, error FROM psd_files WHERE status IN ({placeholders}) ORDER BY path",
+            list(statuses)
+        ).fetchall()
+        return [{"path": row[0], "status": row[1], "error": row[2]} for row in rows]
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+
+def duplicate_file_ids(psd_files: List[str]) -> Dict[str, List[str]]:
+    """
+    文件名（不含扩展名）相同的PSD
+
+    每个PSD的输出文件夹以文件名命名，不同子文件夹中的同名PSD会互相覆盖、
+    互相清理对方的输出。
+    """
+    by_id: Dict[str, List[str]] = {}
+    for p in psd_files:
+        by_id.setdefault(os.path.splitext(os.path.basename(p))[0], []).append(p)
+    return {file_id: paths for file_id, paths in by_id.items() if len(paths) > 1}
+
+
+def clear_partial_output(file_output_folder: str):
+    """删除上次未完成的输出文件夹，避免残留的旧图层文件混入"""
+    if os.path.isdir(file_output_folder):
+        shutil.rmtree(file_output_folder, ignore_errors=True)
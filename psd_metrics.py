@@ -0,0 +1,254 @@
+import os
+import time
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+import psutil
+from image_encoder import WRITE_LATENCY_BUCKETS
+
+# 指标名前缀
+PREFIX = "psd_extract"
+
+
+class RunMetrics:
+    """
+    提取运行的指标（在主进程中汇总）
+
+    完成/失败的文件数、图层数、写出字节数由工作进程回传的结果累加；
+    各工作进程的RSS和当前文件在读取时由pool.worker_info()和psutil实时获取。
+    ETA按已完成的PSD字节数估算（调度器大文件优先，按文件数估算前期会偏悲观），
+    没有文件大小时按文件数估算。
+    """
+
+    def __init__(self, total_files: int, total_bytes: int = 0, pool=None):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.pool = pool
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self.counters = Counter()
+        self.failures = Counter()  # 原因 -> 次数
+        self.encode_queue_peak = {}  # 工作进程pid -> 最近一个文件的编码队列峰值
+        self.write_latency_buckets = [0] * (len(WRITE_LATENCY_BUCKETS) + 1)
+        self.write_seconds = 0.0
+
+    def file_done(self, result: Dict, size: int = 0):
+        with self._lock:
+            self.counters["completed"] += 1
+            self.counters["completed_bytes"] += size
+            if result.get("skipped"):
+                self.counters["skipped"] += 1
+            if result.get("success"):
+                self.counters["succeeded"] += 1
+            else:
+                self.failures["failed"] += 1
+            for key in ("layers", "bytes_written", "encode_errors", "render_raw", "render_composite"):
+                self.counters[key] += result.get(key, 0)
+            for i, count in enumerate(result.get("write_latency_buckets", [])):
+                self.write_latency_buckets[i] += count
+            self.write_seconds += result.get("write_seconds", 0.0)
+            if "pid" in result:
+                self.encode_queue_peak[result["pid"]] = result.get("encode_queue_peak", 0)
+
+    def file_skipped(self, size: int = 0):
+        """调度时跳过的文件（多节点模式下其他节点已完成），计入完成数和ETA"""
+        with self._lock:
+            self.counters["completed"] += 1
+            self.counters["completed_bytes"] += size
+            self.counters["skipped"] += 1
+
+    def file_failed(self, reason: str, size: int = 0):
+        """超时或进程崩溃"""
+        with self._lock:
+            self.counters["completed"] += 1
+            self.counters["completed_bytes"] += size
+            self.failures[reason] += 1
+
+    def eta_seconds(self, elapsed: float) -> Optional[float]:
+        with self._lock:
+            completed = self.counters["completed"]
+            done_bytes = self.counters["completed_bytes"]
+        if completed == 0:
+            return None
+        if self.total_bytes and done_bytes:
+            return elapsed * (self.total_bytes - done_bytes) / done_bytes
+        return elapsed * (self.total_files - completed) / completed
+
+    def workers(self) -> List[Dict]:
+        """当前各工作进程的pid、RSS、正在处理的文件"""
+        if self.pool is None:
+            return []
+        workers = []
+        for info in self.pool.worker_info():
+            try:
+                info["rss_bytes"] = psutil.Process(info["pid"]).memory_info().rss
+            except (psutil.Error, TypeError):
+                info["rss_bytes"] = 0
+            workers.append(info)
+        return workers
+
+    def snapshot(self) -> Dict:
+        elapsed = time.time() - self.started_at
+        workers = self.workers()
+        with self._lock:
+            snapshot = {
+                "total_files": self.total_files,
+                "total_bytes": self.total_bytes,
+                "elapsed_seconds": elapsed,
+                "counters": dict(self.counters),
+                "failures": dict(self.failures),
+                "encode_queue_peak": dict(self.encode_queue_peak),
+                "write_latency_buckets": list(self.write_latency_buckets),
+                "write_seconds": self.write_seconds,
+            }
+        snapshot["eta_seconds"] = self.eta_seconds(elapsed)
+        snapshot["workers"] = workers
+        return snapshot
+
+    def render(self) -> str:
+        """Prometheus文本格式"""
+        s = self.snapshot()
+        counters = s["counters"]
+        elapsed = s["elapsed_seconds"]
+        samples: List[Tuple[str, str, str, List[Tuple[Dict, float]]]] = [
+            ("files", "gauge", "PSD files scheduled in this run", [({}, s["total_files"])]),
+            ("input_bytes", "gauge", "Total size of the scheduled PSD files", [({}, s["total_bytes"])]),
+            ("files_completed_total", "counter", "PSD files finished (success or failure)",
+             [({}, counters.get("completed", 0))]),
+            ("files_succeeded_total", "counter", "PSD files extracted successfully",
+             [({}, counters.get("succeeded", 0))]),
+            ("files_skipped_total", "counter", "PSD files skipped as already complete (manifest or another node)",
+             [({}, counters.get("skipped", 0))]),
+            ("files_failed_total", "counter", "PSD files that failed, by reason",
+             [({"reason": r}, n) for r, n in sorted(s["failures"].items())] or [({"reason": "failed"}, 0)]),
+            ("layers_completed_total", "counter", "Layers exported",
+             [({}, counters.get("layers", 0))]),
+            ("bytes_written_total", "counter", "Encoded image bytes written",
+             [({}, counters.get("bytes_written", 0))]),
+            ("encode_errors_total", "counter", "Image encode/write errors",
+             [({}, counters.get("encode_errors", 0))]),
+            ("layer_render_total", "counter", "Layers rendered, by render path",
+             [({"path": "raw"}, counters.get("render_raw", 0)),
+              ({"path": "composite"}, counters.get("render_composite", 0))]),
+            ("encode_queue_peak", "gauge", "Peak encode queue depth during the worker's last file",
+             [({"worker": str(pid)}, depth) for pid, depth in sorted(s["encode_queue_peak"].items())]),
+            ("workers", "gauge", "Live worker processes", [({}, len(s["workers"]))]),
+            ("worker_busy", "gauge", "Whether the worker is processing a file",
+             [({"worker": str(w["pid"])}, int(w["busy"])) for w in s["workers"]]),
+            ("worker_rss_bytes", "gauge", "Resident memory of each worker process",
+             [({"worker": str(w["pid"])}, w["rss_bytes"]) for w in s["workers"]]),
+            ("worker_task_seconds", "gauge", "Seconds the worker has spent on its current file",
+             [({"worker": str(w["pid"])}, w["elapsed"]) for w in s["workers"] if w["busy"]]),
+            ("parent_rss_bytes", "gauge", "Resident memory of the coordinating process",
+             [({}, psutil.Process().memory_info().rss)]),
+            ("elapsed_seconds", "gauge", "Seconds since the run started", [({}, elapsed)]),
+            ("files_per_second", "gauge", "Average file throughput",
+             [({}, counters.get("completed", 0) / max(elapsed, 1e-9))]),
+            ("eta_seconds", "gauge", "Estimated seconds until the run completes",
+             [({}, s["eta_seconds"])] if s["eta_seconds"] is not None else []),
+        ]
+
+        lines = []
+        for name, kind, help_text, values in samples:
+            metric = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {kind}")
+            for labels, value in values:
+                label_text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{metric}{{{label_text}}} {value}" if label_text else f"{metric} {value}")
+
+        # 写入延迟直方图（提交写入到落盘，异步写出时包含排队）
+        metric = f"{PREFIX}_write_latency_seconds"
+        lines.append(f"# HELP {metric} Latency of layer/preview file writes")
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for upper, count in zip(WRITE_LATENCY_BUCKETS + (float("inf"),), s["write_latency_buckets"]):
+            cumulative += count
+            le = "+Inf" if upper == float("inf") else f"{upper:g}"
+            lines.append(f'{metric}_bucket{{le="{le}"}} {cumulative}')
+        lines.append(f"{metric}_sum {s['write_seconds']}")
+        lines.append(f"{metric}_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str, text: str):
+    """原子写入（node_exporter textfile collector不会读到半截文件）"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class MetricsExporter:
+    """
+    在主进程中定期把指标写成Prometheus文本文件，并提供本地HTTP端点（/metrics）
+
+    textfile或port为None时不启用对应的输出。
+    """
+
+    def __init__(self, metrics: RunMetrics, textfile: Optional[str] = None,
+                 port: Optional[int] = None, host: str = "127.0.0.1", interval: float = 15.0):
+        self.metrics = metrics
+        self.textfile = textfile
+        self.port = port
+        self.host = host
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def start(self):
+        if self.port is not None:
+            metrics = self.metrics
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    body = metrics.render().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            try:
+                self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+                self._server.daemon_threads = True
+                threading.Thread(target=self._server.serve_forever, name="metrics-http", daemon=True).start()
+                print(f"Metrics: http://{self.host}:{self._server.server_address[1]}/metrics")
+            except OSError as e:
+                print(f"Metrics endpoint disabled ({self.host}:{self.port}): {e}")
+                self._server = None
+
+        if self.textfile is not None:
+            self._thread = threading.Thread(target=self._write_loop, name="metrics-textfile", daemon=True)
+            self._thread.start()
+        return self
+
+    def _write_loop(self):
+        while not self._stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        if self.textfile is None:
+            return
+        try:
+            write_textfile(self.textfile, self.metrics.render())
+        except OSError as e:
+            print(f"Metrics textfile write failed: {e}")
+
+    def stop(self):
+        """停止输出（最后写一次文本文件，保留运行结束时的状态）"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.write()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
@@ -0,0 +1,101 @@
+import io
+import os
+import mmap
+from typing import Optional, Tuple
+from psd_tools import PSDImage
+
+# 不小于该大小的读取直接返回内存映射的切片（零拷贝），更小的读取返回bytes
+# （头部、描述符、名称等小字段的解析代码需要真正的bytes）
+ZERO_COPY_MIN_BYTES = 64 * 1024
+
+
+class MappedFile(io.RawIOBase):
+    """
+    把内存映射的文件包装成psd_tools可读的文件对象
+
+    大块读取（图层通道数据、合并图像）返回memoryview，不复制、也不触碰对应的
+    页面；只有在图层真正解码（get_data）时才按需从磁盘读入。未渲染的图层
+    （隐藏、被过滤）既不会被解压，也不会占用常驻内存。
+    """
+
+    def __init__(self, path: str, zero_copy_min: int = ZERO_COPY_MIN_BYTES):
+        self.path = path
+        self.zero_copy_min = zero_copy_min
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        self._mmap = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ) if size else None
+        self._view = memoryview(self._mmap) if self._mmap is not None else memoryview(b"")
+        self._size = size
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError("negative seek position")
+        self._pos = pos
+        return pos
+
+    def read(self, size: int = -1):
+        start = min(self._pos, self._size)
+        end = self._size if size is None or size < 0 else min(start + size, self._size)
+        self._pos = end
+        if end - start >= self.zero_copy_min:
+            return self._view[start:end]
+        return bytes(self._view[start:end])
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        """
+        释放映射
+
+        PSDImage仍持有切片时映射无法立即关闭，此时交给垃圾回收
+        （最后一个切片释放后映射自动解除）。
+        """
+        if self.closed:
+            return
+        try:
+            self._view.release()
+            if self._mmap is not None:
+                self._mmap.close()
+        except BufferError:
+            pass
+        self._file.close()
+        super().close()
+
+
+def open_psd(path: str, mapped: bool = True) -> Tuple[PSDImage, Optional[MappedFile]]:
+    """
+    打开PSD，返回 (PSDImage, 映射句柄)
+
+    mapped=True 时通过内存映射解析，图层通道数据保持为映射切片，按需解码；
+    映射解析失败（个别附加信息块解析器需要bytes）时回退到普通读取，
+    此时句柄为None。使用完PSDImage后调用句柄的close()。
+    """
+    if not mapped:
+        return PSDImage.open(path), None
+    handle = MappedFile(path)
+    try:
+        return PSDImage.open(handle), handle
+    except Exception:
+        handle.close()
+        return PSDImage.open(path), None
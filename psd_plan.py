@@ -0,0 +1,292 @@
+import os
+import json
+import math
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import psutil
+import processing_folder_v3 as v3
+from psd_index import INDEX_FILENAME, load_headers
+from psd_trace import TRACE_DIRNAME
+from psd_scheduler import MemoryBudgetScheduler, estimate_peak_mb
+from psd_worker_pool import PSDWorkerPool
+
+# 样本使用输出文件夹内的临时清单（不写入本机的断点续跑清单，也不受已有记录影响跳过样本）
+PLAN_MANIFEST_FILENAME = "_plan_manifest.sqlite"
+
+
+def stratified_sample(sizes: np.ndarray, sample_size: int, strata: int = 8,
+                      seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    按文件大小分层抽样，返回 (样本下标, 每个样本代表的文件数)
+
+    按大小分位数分成strata层，每层抽取相同数量；最大的文件总是被抽中
+    （决定单进程峰值内存和尾部耗时）。
+    """
+    rng = np.random.default_rng(seed)
+    order = np.argsort(sizes, kind='stable')
+    strata = max(1, min(strata, len(sizes), sample_size))
+    per_stratum = max(1, sample_size // strata)
+
+    picks, weights = [], []
+    largest = order[-1]
+    for stratum in np.array_split(order, strata):
+        candidates = stratum[stratum != largest]
+        k = min(per_stratum, len(candidates))
+        if k:
+            chosen = rng.choice(candidates, size=k, replace=False)
+            picks.extend(chosen.tolist())
+            weights.extend([len(candidates) / k] * k)
+    picks.append(int(largest))
+    weights.append(1.0)
+    return np.array(picks, dtype=np.int64), np.array(weights, dtype=np.float64)
+
+
+def _peak_rss_mb() -> float:
+    """本进程的峰值常驻内存（每个样本在新进程中处理，即该文件的峰值）"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+def _output_bytes(output_folder: str) -> int:
+    """输出文件夹中的数据量（图层文件、JSON、数据集日志/分片、tar分片），不含追踪记录和临时清单"""
+    total = 0
+    for root, dirs, files in os.walk(output_folder):
+        if root == output_folder and TRACE_DIRNAME in dirs:
+            dirs.remove(TRACE_DIRNAME)
+        for f in files:
+            if f.startswith(PLAN_MANIFEST_FILENAME):
+                continue
+            try:
+                total += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return total
+
+
+def _plan_init(output_folder: str) -> Dict:
+    t0 = time.perf_counter()
+    v3.MANIFEST_PATH = os.path.join(output_folder, PLAN_MANIFEST_FILENAME)
+    state = v3.init_worker(output_folder)
+    state["init_seconds"] = time.perf_counter() - t0
+    return state
+
+
+def _plan_handle(state: Dict, psd_file: str) -> Dict:
+    """用真实的提取流程处理一个样本，并附加耗时、CPU时间、输出量和峰值内存"""
+    bytes0 = _output_bytes(state["output_folder"])
+    wall0 = time.perf_counter()
+    cpu0 = time.process_time()
+    result = v3.handle_worker_file(state, psd_file)
+    result["wall_seconds"] = time.perf_counter() - wall0
+    result["cpu_seconds"] = time.process_time() - cpu0  # 包含图层导出和编码线程
+    # 按输出文件夹的增量计算（编码统计不含tar分片、数据集日志和JSON）
+    result["output_bytes"] = _output_bytes(state["output_folder"]) - bytes0
+    result["peak_rss_mb"] = _peak_rss_mb()
+    result["init_seconds"] = state["init_seconds"]
+    return result
+
+
+def run_samples(psd_files: List[str], output_folder: str, headers: Dict) -> Dict[str, Dict]:
+    """逐个在新的工作进程中处理样本（串行，测得的耗时和内存不受其他样本干扰）"""
+    estimates = [estimate_peak_mb(p, v3.THREAD_WORKERS, headers.get(p)) for p in psd_files]
+    scheduler = MemoryBudgetScheduler(v3.MEMORY_BUDGET_MB)
+    scheduler.add_tasks(psd_files, estimates)
+
+    results = {}
+    last_callback = [time.monotonic()]
+
+    def on_result(psd_file, result):
+        last_callback[0] = time.monotonic()
+        results[psd_file] = result
+        print(f"  {result.get('wall_seconds', 0):7.1f}s  cpu {result.get('cpu_seconds', 0):7.1f}s  "
+              f"peak {result.get('peak_rss_mb', 0):6.0f} MB  layers {result.get('layers', 0):4d}  "
+              f"{os.path.basename(psd_file)}")
+
+    def on_failure(psd_file, reason, message):
+        # 样本串行处理：失败样本的耗时为上一个样本结束到现在（含工作进程启动）
+        now = time.monotonic()
+        wall, last_callback[0] = now - last_callback[0], now
+        results[psd_file] = {"success": False, "failure": reason, "error": message, "wall_seconds": wall}
+        print(f"  [{reason}] {wall:7.1f}s  {os.path.basename(psd_file)}: {message}")
+
+    pool = PSDWorkerPool(partial(_plan_init, output_folder), _plan_handle, v3.close_worker,
+                         num_workers=1, timeout=v3.PSD_TIMEOUT_SECONDS, max_files_per_worker=1)
+    pool.run(scheduler, on_result, on_failure)
+    return results
+
+
+def extrapolate(sizes: np.ndarray, picks: np.ndarray, weights: np.ndarray, sample_files: List[str],
+                results: Dict[str, Dict], estimates: np.ndarray, cores: int, memory_mb: float,
+                workers: Optional[int] = None) -> Dict:
+    """
+    由样本测量值按分层权重外推整批的耗时、内存和输出量，并给出建议配置
+
+    失败样本（超时、崩溃、提取出错）保留自己的权重：它们代表的文件在整批中
+    同样会失败，耗时计入总耗时（超时和崩溃的进程一直占满，CPU时间按墙钟时间计），
+    不产生输出，也不参与内存校准。
+    """
+    ok = [i for i, p in enumerate(sample_files) if results.get(p, {}).get("success")]
+    fail = sorted(set(range(len(sample_files))) - set(ok))
+    if not ok:
+        raise RuntimeError("所有样本都处理失败，无法估算")
+
+    def column(key, rows=ok):
+        return np.array([results.get(sample_files[i], {}).get(key, 0) for i in rows], dtype=np.float64)
+
+    w = weights[ok]
+    wall = column("wall_seconds")
+    cpu = column("cpu_seconds")
+    peak = column("peak_rss_mb")
+    written = column("output_bytes")
+    layers = column("layers")
+    init = column("init_seconds")
+    fail_w = weights[fail]
+    fail_wall = column("wall_seconds", fail)
+
+    failure_wall = float((fail_w * fail_wall).sum())
+    total_wall = float((w * wall).sum()) + failure_wall
+    total_cpu = float((w * cpu).sum()) + failure_wall
+    cores_per_file = total_cpu / max(total_wall, 1e-9)
+    slowest = float(max(wall.max(), fail_wall.max() if fail else 0.0))
+
+    # 预估内存的校准系数（实测/预估），用于推算未抽中文件的峰值
+    sample_estimates = estimates[picks[ok]]
+    calibration = float(np.percentile(peak / np.maximum(sample_estimates, 1), 90))
+    predicted_peak = estimates * calibration
+    worker_peak_mb = float(max(peak.max(), np.percentile(predicted_peak, 99)))
+    typical_peak_mb = float(np.percentile(predicted_peak, 90))
+
+    # 建议进程数：CPU（每个文件平均占用cores_per_file个核）和内存（按P90峰值）取小
+    cpu_workers = max(1, int(round(cores / max(cores_per_file, 1e-3))))
+    memory_workers = max(1, int(memory_mb * 0.8 // max(typical_peak_mb, 1)))
+    recommended = min(cpu_workers, memory_workers, len(sizes))
+    workers = workers or recommended
+
+    def wall_at(n):
+        # 受进程数和CPU核数共同限制，且不短于最慢的单个文件
+        return max(total_wall / n, total_cpu / cores, slowest)
+
+    # 进程重启开销控制在处理时间的1%以内；超时按成功样本留3倍余量
+    mean_wall = total_wall / len(sizes)
+    files_per_worker = int(min(1000, max(20, math.ceil(100 * float(init.mean()) / max(mean_wall, 1e-3)))))
+    timeout = int(max(60, math.ceil(float(wall.max()) * 3 / 60) * 60))
+
+    return {
+        "files": int(len(sizes)),
+        "input_bytes": int(sizes.sum()),
+        "samples": len(sample_files),
+        "sample_failures": len(fail),
+        "failure_rate": float(fail_w.sum() / weights.sum()),
+        "failure_hours": failure_wall / 3600,
+        "cpu_hours": total_cpu / 3600,
+        "serial_wall_hours": total_wall / 3600,
+        "cores_per_file": cores_per_file,
+        "wall_hours": {str(n): wall_at(n) / 3600 for n in sorted({1, workers, recommended, cores})},
+        "output_bytes": float((w * written).sum()),
+        "layers": float((w * layers).sum()),
+        "peak_rss_mb": {
+            "sampled_max": float(peak.max()),
+            "predicted_p90": typical_peak_mb,
+            "predicted_max": worker_peak_mb,
+            "estimator_calibration": calibration,
+        },
+        "machine": {"cores": cores, "memory_mb": memory_mb},
+        "recommend": {
+            "MAX_WORKERS": recommended,
+            "limited_by": "memory" if memory_workers < cpu_workers else "cpu",
+            "MEMORY_BUDGET_MB": int(memory_mb * 0.8),
+            "MAX_FILES_PER_WORKER": files_per_worker,
+            "PSD_TIMEOUT_SECONDS": timeout,
+        },
+    }
+
+
+def _format_hours(hours: float) -> str:
+    if hours >= 1:
+        return f"{hours:.1f} h"
+    if hours * 60 >= 1:
+        return f"{hours * 60:.1f} min"
+    return f"{hours * 3600:.0f} s"
+
+
+def print_plan(plan: Dict):
+    gb = 1024 ** 3
+    print(f"\n{plan['files']} files, {plan['input_bytes'] / gb:.1f} GB input, "
+          f"{plan['samples']} samples ({plan['sample_failures']} failed)")
+    if plan["sample_failures"]:
+        print(f"Failures:      ~{plan['failure_rate']:.1%} of files, "
+              f"{_format_hours(plan['failure_hours'])} spent on files that fail")
+    print(f"CPU time:      {_format_hours(plan['cpu_hours'])}  (avg {plan['cores_per_file']:.2f} cores busy per file)")
+    for n, hours in plan["wall_hours"].items():
+        print(f"Wall time @{n:>3s} workers: {_format_hours(hours)}")
+    print(f"Output:        {plan['output_bytes'] / gb:.1f} GB, ~{plan['layers']:.0f} layers")
+    peak = plan["peak_rss_mb"]
+    print(f"Worker memory: sampled max {peak['sampled_max']:.0f} MB, predicted p90 {peak['predicted_p90']:.0f} MB, "
+          f"max {peak['predicted_max']:.0f} MB (estimator x{peak['estimator_calibration']:.2f})")
+    rec = plan["recommend"]
+    print(f"\nRecommended for this machine ({plan['machine']['cores']} cores, "
+          f"{plan['machine']['memory_mb'] / 1024:.0f} GB, limited by {rec['limited_by']}):")
+    for key in ("MAX_WORKERS", "MEMORY_BUDGET_MB", "MAX_FILES_PER_WORKER", "PSD_TIMEOUT_SECONDS"):
+        print(f"  {key} = {rec[key]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='抽样试跑提取流程，估算整批的耗时、内存和输出量')
+    parser.add_argument('psd_folder', help='PSD文件夹')
+    parser.add_argument('-n', '--samples', type=int, default=32, help='样本数量')
+    parser.add_argument('--strata', type=int, default=8, help='按文件大小分层的层数')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='额外估算该进程数下的墙钟时间')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    parser.add_argument('-o', '--output', default=None, help='估算结果JSON路径')
+    parser.add_argument('--keep', default=None, help='保留样本输出到该文件夹（默认临时文件夹，结束后删除）')
+    args = parser.parse_args()
+
+    psd_files = v3.get_all_psd_files(args.psd_folder)
+    if not psd_files:
+        print(f"No PSD files found in {args.psd_folder}")
+        return
+    sizes = np.array([os.path.getsize(p) for p in psd_files], dtype=np.int64)
+
+    index_path = v3.PSD_INDEX_PATH or os.path.join(args.psd_folder, INDEX_FILENAME)
+    headers = load_headers(index_path) if os.path.exists(index_path) else {}
+    estimates = np.array([estimate_peak_mb(p, v3.THREAD_WORKERS, headers.get(p)) for p in psd_files])
+
+    picks, weights = stratified_sample(sizes, args.samples, args.strata, args.seed)
+    sample_files = [psd_files[i] for i in picks]
+    print(f"Sampling {len(sample_files)} of {len(psd_files)} PSD files "
+          f"({sizes[picks].sum() / 1024 ** 3:.2f} GB) with the current processing_folder_v3 settings")
+
+    output_folder = args.keep or tempfile.mkdtemp(prefix="psd_plan_")
+    os.makedirs(output_folder, exist_ok=True)
+    try:
+        results = run_samples(sample_files, output_folder, headers)
+    finally:
+        if not args.keep:
+            shutil.rmtree(output_folder, ignore_errors=True)
+
+    plan = extrapolate(sizes, picks, weights, sample_files, results, estimates,
+                       multiprocessing.cpu_count(), psutil.virtual_memory().total / 1024 / 1024,
+                       args.workers)
+    print_plan(plan)
+
+    if args.output:
+        plan["sample_results"] = {p: {k: v for k, v in r.items() if k != "error"} for p, r in results.items()}
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, ensure_ascii=False, indent=2)
+        print(f"\n结果已保存: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
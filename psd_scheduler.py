@@ -0,0 +1,96 @@
+import os
+from typing import Dict, Optional, Sequence
+from psd_header import read_psd_header
+
+# 峰值内存估算系数（按实际运行结果调整）
+BASE_MB = 150  # 进程基础占用
+FILE_FACTOR = 1.5  # psd_tools把整个文件读入内存并构建对象
+FLOAT_CANVAS_BUFFERS = 3  # psd.composite() 的float32 RGBA中间缓冲数量
+MIN_ESTIMATE_MB = 200
+# 队首任务因预算不足被后面的小任务越过的次数上限
+DEFAULT_MAX_BYPASS = 8
+
+
+def estimate_peak_mb(psd_path: str, parallel_layers: int = 8,
+                     header: Optional[Dict] = None) -> float:
+    """
+    根据文件大小和文件头估算处理一个PSD的峰值内存（MB）
+
+    宽 × 高 × 通道 × 位深 决定合并图像解码大小，画布的float32合成缓冲
+    与同时合成的图层数（线程数和图层数的较小值）成正比。
+    """
+    file_size = os.path.getsize(psd_path)
+    if header is None:
+        header = read_psd_header(psd_path)
+    if header is None:
+        # 无法解析文件头时只按文件大小粗估
+        return max(MIN_ESTIMATE_MB, BASE_MB + file_size * 3 / 1024 / 1024)
+
+    pixels = header["width"] * header["height"]
+    merged_bytes = pixels * header["channels"] * max(header["depth"] // 8, 1)
+    float_canvas = pixels * 4 * 4
+    concurrent_layers = min(max(header["layer_count"], 1), parallel_layers)
+
+    total = (file_size * FILE_FACTOR
+             + merged_bytes
+             + float_canvas * (FLOAT_CANVAS_BUFFERS + concurrent_layers))
+    return max(MIN_ESTIMATE_MB, BASE_MB + total / 1024 / 1024)
+
+
+class MemoryBudgetScheduler:
+    """
+    按内存预算准入的任务调度器
+
+    任务按预估峰值内存从大到小排序（大文件先跑，缩短总耗时）。只有当
+    已运行任务的预估总和加上新任务不超过全局预算时才放行；没有任务在运行时
+    总是放行队首，避免单个超预算文件永远得不到执行。
+
+    队首放不下时用后面放得下的小任务填补空闲预算，但队首被越过max_bypass次后
+    停止填补（为队首预留预算），等运行中的任务结束、预算足够后先放行队首，
+    小任务源源不断时最大的文件也不会一直等待。
+    """
+
+    def __init__(self, budget_mb: float, max_bypass: int = DEFAULT_MAX_BYPASS):
+        self.budget_mb = budget_mb
+        self.max_bypass = max_bypass
+        self.pending = []  # [(estimate_mb, task)]，按估算值降序
+        self.running_mb = 0.0
+        self._head = None  # 当前被阻塞的队首任务
+        self._bypassed = 0  # 队首被越过的次数
+
+    def add_tasks(self, tasks: Sequence, estimates: Sequence[float]):
+        self.pending.extend(zip(estimates, tasks))
+        self.pending.sort(key=lambda item: item[0], reverse=True)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def pop_admissible(self, running_count: int):
+        """取出一个可以放行的任务，返回 (task, estimate_mb)，无可放行任务时返回None"""
+        if not self.pending:
+            return None
+        available = self.budget_mb - self.running_mb
+        head_estimate, head = self.pending[0]
+        if running_count == 0 or head_estimate <= available:
+            return self._admit(0)
+        if head is not self._head:
+            self._head, self._bypassed = head, 0
+        if self._bypassed >= self.max_bypass:
+            return None
+        for i, (estimate, task) in enumerate(self.pending):
+            if estimate <= available:
+                self._bypassed += 1
+                return self._admit(i)
+        return None
+
+    def _admit(self, index: int):
+        estimate, task = self.pending.pop(index)
+        if index == 0:
+            self._head, self._bypassed = None, 0
+        self.running_mb += estimate
+        return task, estimate
+
+    def finish(self, estimate_mb: float):
+        """任务结束，归还预算"""
+        self.running_mb = max(0.0, self.running_mb - estimate_mb)
+
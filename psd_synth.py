@@ -0,0 +1,197 @@
+import os
+import argparse
+from dataclasses import dataclass, field, asdict
+from typing import Dict, List
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+from psd_tools.api.layers import PixelLayer
+from psd_tools.constants import Tag
+from psd_tools.psd.descriptor import Descriptor, DescriptorBlock, String, Double
+from psd_tools.psd.vector import Path, ClosedPath, ClosedKnotLinked, InitialFillRule
+try:
+    from psd_tools.api.layers import Group
+except ImportError:
+    from psd_tools.api.layers import GroupLayer as Group
+
+
+@dataclass
+class CorpusSpec:
+    """合成PSD语料的参数"""
+    name: str
+    count: int = 20
+    width: int = 1200
+    height: int = 900
+    layers: int = 12
+    group_depth: int = 1  # 组最大嵌套深度（0表示不分组）
+    # 图层种类权重：pixel / type / shape / adjustment
+    kinds: Dict[str, float] = field(default_factory=lambda: {"pixel": 1.0})
+    mask_ratio: float = 0.0  # 带像素蒙版的图层比例
+    hidden_ratio: float = 0.0  # 隐藏图层比例
+    depth: int = 8  # 位深（8 / 16）
+    background: bool = True  # 底部铺满画布的背景图层
+
+
+# 预设语料
+CORPUS_PRESETS = {
+    "small": CorpusSpec("small", count=40, width=800, height=600, layers=8),
+    "large_canvas": CorpusSpec("large_canvas", count=6, width=5000, height=3500, layers=10),
+    "many_layers": CorpusSpec("many_layers", count=10, width=1200, height=900, layers=120, group_depth=2),
+    "nested": CorpusSpec("nested", count=20, width=1000, height=800, layers=30, group_depth=5),
+    "mixed_kinds": CorpusSpec("mixed_kinds", count=20, width=1200, height=900, layers=20,
+                              kinds={"pixel": 0.5, "type": 0.2, "shape": 0.2, "adjustment": 0.1}),
+    "masked": CorpusSpec("masked", count=20, width=1200, height=900, layers=16, mask_ratio=0.5,
+                         hidden_ratio=0.25),
+    "deep16": CorpusSpec("deep16", count=10, width=1200, height=900, layers=12, depth=16),
+}
+
+
+def _random_rgba(rng, width: int, height: int) -> Image.Image:
+    """带平滑渐变和噪声的RGBA图像（压缩率接近真实素材，而不是纯噪声或纯色）"""
+    yy, xx = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = rng.uniform(0, 255, 3)
+    gx, gy = rng.uniform(-0.5, 0.5, 2)
+    arr = np.empty((height, width, 4), dtype=np.uint8)
+    for c in range(3):
+        channel = base[c] + gx * xx + gy * yy + rng.normal(0, 6, (height, width))
+        arr[..., c] = np.clip(channel, 0, 255)
+    # 椭圆形alpha，模拟抠好的素材
+    cx, cy = width / 2, height / 2
+    inside = ((xx - cx) / max(cx, 1)) ** 2 + ((yy - cy) / max(cy, 1)) ** 2 <= 1.0
+    arr[..., 3] = np.where(inside, 255, 0)
+    return Image.fromarray(arr, 'RGBA')
+
+
+def _pixel_layer(psd, img, name, left=0, top=0):
+    """frompil对RGBA图像会额外生成一个用户蒙版，去掉它（只保留透明通道，与真实素材一致）"""
+    layer = PixelLayer.frompil(img, psd, name, top=top, left=left)
+    if layer.has_mask():
+        layer.remove_mask()
+    return layer
+
+
+def _make_type_layer(psd, img, name, left, top):
+    layer = _pixel_layer(psd, img, name, left, top)
+    text_data = DescriptorBlock(classID=b'TxLr')
+    text_data[b'Txt '] = String(name)
+    layer._record.tagged_blocks.set_data(
+        Tag.TYPE_TOOL_OBJECT_SETTING, version=1,
+        transform=(1.0, 0.0, 0.0, 1.0, float(left), float(top)),
+        text_version=50, text_data=text_data, warp_version=1,
+        warp=DescriptorBlock(classID=b'warp'),
+        left=0, top=0, right=img.width, bottom=img.height,
+    )
+    return layer
+
+
+def _make_shape_layer(psd, img, name, left, top, color):
+    layer = _pixel_layer(psd, img, name, left, top)
+
+    def knot(x, y):
+        # 路径坐标为相对画布的 (y, x) 比例
+        point = (y / psd.height, x / psd.width)
+        return ClosedKnotLinked(preceding=point, anchor=point, leaving=point)
+
+    right, bottom = left + img.width, top + img.height
+    path = Path([InitialFillRule(0), ClosedPath(items=[
+        knot(left, top), knot(right, top), knot(right, bottom), knot(left, bottom)])])
+    layer._record.tagged_blocks.set_data(Tag.VECTOR_MASK_SETTING1, version=3, flags=0, path=path)
+
+    fill = DescriptorBlock(classID=b'null')
+    rgb = Descriptor(classID=b'RGBC')
+    rgb[b'Rd  '], rgb[b'Grn '], rgb[b'Bl  '] = (Double(float(c)) for c in color)
+    fill[b'Clr '] = rgb
+    layer._record.tagged_blocks.set_data(Tag.SOLID_COLOR_SHEET_SETTING, fill)
+    layer._record.flags.pixel_data_irrelevant = True
+    return layer
+
+
+def _make_adjustment_layer(psd, name):
+    layer = _pixel_layer(psd, Image.new('RGBA', (psd.width, psd.height), (0, 0, 0, 0)), name)
+    layer._record.tagged_blocks.set_data(Tag.INVERT)
+    return layer
+
+
+def make_psd(path: str, spec: CorpusSpec, seed: int = 0):
+    """按spec生成一个PSD"""
+    rng = np.random.default_rng(seed)
+    psd = PSDImage.new('RGB', (spec.width, spec.height), depth=spec.depth)
+
+    kinds = list(spec.kinds)
+    weights = np.array([spec.kinds[k] for k in kinds], dtype=np.float64)
+    weights /= weights.sum()
+
+    # 组链：containers[d] 为第d层嵌套的组
+    containers = [psd]
+    for d in range(spec.group_depth):
+        containers.append(Group.new(psd, name=f"group_{d}"))
+
+    if spec.background:
+        bg = Image.new('RGBA', (spec.width, spec.height), tuple(int(c) for c in rng.integers(0, 255, 3)) + (255,))
+        psd.append(_pixel_layer(psd, bg, 'background'))
+
+    for i in range(spec.layers):
+        kind = kinds[rng.choice(len(kinds), p=weights)]
+        w = int(rng.integers(max(8, spec.width // 20), max(9, spec.width // 2)))
+        h = int(rng.integers(max(8, spec.height // 20), max(9, spec.height // 2)))
+        left = int(rng.integers(-w // 4, spec.width - w // 2))
+        top = int(rng.integers(-h // 4, spec.height - h // 2))
+        name = f"{kind}_{i}"
+
+        if kind == "type":
+            layer = _make_type_layer(psd, _random_rgba(rng, w, h // 3 + 1), name, left, top)
+        elif kind == "shape":
+            color = rng.integers(0, 255, 3)
+            img = Image.new('RGBA', (w, h), tuple(int(c) for c in color) + (255,))
+            layer = _make_shape_layer(psd, img, name, left, top, color)
+        elif kind == "adjustment":
+            layer = _make_adjustment_layer(psd, name)
+        else:
+            layer = _pixel_layer(psd, _random_rgba(rng, w, h), name, left, top)
+
+        if kind != "adjustment" and rng.random() < spec.mask_ratio:
+            mask = np.zeros((layer.height, layer.width), dtype=np.uint8)
+            mask[:, :max(1, layer.width * 2 // 3)] = 255
+            layer.create_mask(Image.fromarray(mask, 'L'))
+        if rng.random() < spec.hidden_ratio:
+            layer.visible = False
+
+        containers[int(rng.integers(0, len(containers)))].append(layer)
+
+    # 从最内层开始把组挂到上一层（空组也保留，用于测试嵌套深度）
+    for d in range(len(containers) - 1, 0, -1):
+        containers[d - 1].append(containers[d])
+
+    psd.save(path)
+
+
+def generate_corpus(folder: str, spec: CorpusSpec, seed: int = 0) -> List[str]:
+    """生成一组PSD，返回文件路径（已存在的文件直接复用）"""
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for i in range(spec.count):
+        path = os.path.join(folder, f"{spec.name}_{i:04d}.psd")
+        if not os.path.exists(path):
+            make_psd(path, spec, seed=seed * 100003 + i)
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成合成PSD语料')
+    parser.add_argument('-o', '--output', required=True, help='输出文件夹（每个预设一个子文件夹）')
+    parser.add_argument('-p', '--presets', nargs='+', default=list(CORPUS_PRESETS), help='语料预设')
+    parser.add_argument('-n', '--count', type=int, default=None, help='覆盖每个预设的文件数')
+    parser.add_argument('--seed', type=int, default=0, help='随机种子')
+    args = parser.parse_args()
+
+    for name in args.presets:
+        spec = CORPUS_PRESETS[name]
+        if args.count is not None:
+            spec = CorpusSpec(**{**asdict(spec), "count": args.count})
+        paths = generate_corpus(os.path.join(args.output, name), spec, args.seed)
+        print(f"{name}: {len(paths)} 个文件")
+
+
+if __name__ == "__main__":
+    main()
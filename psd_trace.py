@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+
+# 追踪文件目录（放在输出文件夹根目录），每个工作进程一个 trace-{pid}-{ns}.jsonl
+TRACE_DIRNAME = "_trace"
+
+
+class PSDTrace:
+    """
+    单个PSD的分阶段耗时（墙钟时间和CPU时间）
+
+    阶段在哪个线程执行就在哪个线程计时：CPU时间用 time.thread_time，
+    图层导出线程和编码线程里的阶段各自计入，因此各阶段墙钟时间之和
+    可能大于整个PSD的墙钟时间。传入z时同时记入该图层的明细。
+    """
+
+    def __init__(self, psd_path: str):
+        self.psd_path = psd_path
+        self.started_at = time.time()
+        self._wall0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        self._lock = threading.Lock()
+        self.stages = defaultdict(lambda: [0.0, 0.0, 0])  # 阶段 -> [墙钟, CPU, 次数]
+        self.layers = defaultdict(dict)  # z -> {阶段: [墙钟, CPU]}
+
+    def add(self, stage: str, wall: float, cpu: float, z: Optional[int] = None):
+        with self._lock:
+            total = self.stages[stage]
+            total[0] += wall
+            total[1] += cpu
+            total[2] += 1
+            if z is not None:
+                layer = self.layers[z].setdefault(stage, [0.0, 0.0])
+                layer[0] += wall
+                layer[1] += cpu
+
+    @contextmanager
+    def stage(self, stage: str, z: Optional[int] = None):
+        wall0 = time.perf_counter()
+        cpu0 = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - wall0, time.thread_time() - cpu0, z)
+
+    def record(self, **fields) -> Dict:
+        """生成一行追踪记录（整个PSD的CPU时间为进程CPU时间，包含所有线程）"""
+        with self._lock:
+            record = {
+                "path": self.psd_path,
+                "pid": os.getpid(),
+                "started_at": self.started_at,
+                "wall": time.perf_counter() - self._wall0,
+                "cpu": time.process_time() - self._cpu0,
+                "stages": {name: {"wall": v[0], "cpu": v[1], "count": v[2]}
+                           for name, v in self.stages.items()},
+                "layers": [{"z": z, "stages": {name: {"wall": v[0], "cpu": v[1]} for name, v in stages.items()}}
+                           for z, stages in sorted(self.layers.items())],
+            }
+        record.update(fields)
+        return record
+
+
+class TraceWriter:
+    """把追踪记录逐行追加到本进程的JSONL文件（每行写完即flush，进程被kill也不丢已完成的记录）"""
+
+    def __init__(self, output_folder: str):
+        self.folder = os.path.join(output_folder, TRACE_DIRNAME)
+        os.makedirs(self.folder, exist_ok=True)
+        self.path = os.path.join(self.folder, f"trace-{os.getpid()}-{time.time_ns()}.jsonl")
+        self._file = None
+        self._lock = threading.Lock()
+
+    def write(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(line + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def iter_records(output_folder: str) -> Iterator[Dict]:
+    """读取输出文件夹下所有追踪记录（跳过被截断的最后一行）"""
+    folder = output_folder
+    if os.path.basename(os.path.normpath(folder)) != TRACE_DIRNAME:
+        folder = os.path.join(output_folder, TRACE_DIRNAME)
+    if not os.path.isdir(folder):
+        return
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.jsonl'):
+            continue
+        with open(os.path.join(folder, name), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+
+
+def stage_breakdown(records: List[Dict]) -> Dict[str, Dict]:
+    """汇总所有记录的各阶段耗时"""
+    totals = defaultdict(lambda: {"wall": 0.0, "cpu": 0.0, "count": 0, "files": 0})
+    for record in records:
+        for name, stage in record.get("stages", {}).items():
+            total = totals[name]
+            total["wall"] += stage["wall"]
+            total["cpu"] += stage["cpu"]
+            total["count"] += stage["count"]
+            total["files"] += 1
+    return dict(totals)
+
+
+def slowest_layers(records: List[Dict], top: int = 10) -> List[Dict]:
+    """按各阶段墙钟时间之和排序的最慢图层"""
+    layers = []
+    for record in records:
+        for layer in record.get("layers", []):
+            wall = sum(s["wall"] for s in layer["stages"].values())
+            layers.append({"path": record["path"], "z": layer["z"], "wall": wall, "stages": layer["stages"]})
+    layers.sort(key=lambda l: l["wall"], reverse=True)
+    return layers[:top]
+
+
+def summarize(output_folder: str, top: int = 10):
+    """打印阶段耗时分布、最慢的文件和图层"""
+    records = [r for r in iter_records(output_folder) if not r.get("skipped")]
+    if not records:
+        print(f"No trace records in {output_folder}")
+        return
+
+    total_wall = sum(r["wall"] for r in records)
+    total_cpu = sum(r["cpu"] for r in records)
+    failed = sum(1 for r in records if not r.get("success"))
+    print(f"{len(records)} files ({failed} failed), wall {total_wall:.1f}s, cpu {total_cpu:.1f}s")
+
+    breakdown = stage_breakdown(records)
+    stage_wall = sum(s["wall"] for s in breakdown.values()) or 1e-9
+    print(f"\n{'stage':14s} {'wall(s)':>10s} {'share':>7s} {'cpu(s)':>10s} {'cpu/wall':>9s} {'calls':>8s} {'ms/call':>9s}")
+    for name, stage in sorted(breakdown.items(), key=lambda kv: kv[1]["wall"], reverse=True):
+        print(f"{name:14s} {stage['wall']:10.2f} {stage['wall'] / stage_wall:7.1%} {stage['cpu']:10.2f} "
+              f"{stage['cpu'] / max(stage['wall'], 1e-9):9.2f} {stage['count']:8d} "
+              f"{stage['wall'] / max(stage['count'], 1) * 1000:9.1f}")
+
+    print(f"\nSlowest {top} files:")
+    for record in sorted(records, key=lambda r: r["wall"], reverse=True)[:top]:
+        stages = record.get("stages", {})
+        main = max(stages.items(), key=lambda kv: kv[1]["wall"])[0] if stages else "-"
+        print(f"  {record['wall']:8.2f}s cpu {record['cpu']:8.2f}s layers {record.get('layer_count', 0):4d} "
+              f"[{main}] {record['path']}")
+
+    print(f"\nSlowest {top} layers:")
+    for layer in slowest_layers(records, top):
+        stages = ", ".join(f"{name} {s['wall'] * 1000:.0f}ms" for name, s in
+                           sorted(layer["stages"].items(), key=lambda kv: kv[1]["wall"], reverse=True))
+        print(f"  {layer['wall']:8.2f}s z={layer['z']:<4d} {layer['path']} ({stages})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='汇总PSD处理的分阶段耗时追踪')
+    parser.add_argument('output_folder', help='处理输出文件夹（或其中的 _trace 文件夹）')
+    parser.add_argument('-n', '--top', type=int, default=10, help='显示最慢的N个文件/图层')
+    args = parser.parse_args()
+    summarize(args.output_folder, args.top)
+
+
+if __name__ == "__main__":
+    main()
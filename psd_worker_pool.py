@@ -0,0 +1,279 @@
+import time
+import threading
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait as wait_connections
+from typing import Callable, Dict, List, Optional
+import psutil
+
+# 工作进程退出原因
+EXIT_RETIRED = "retired"  # 达到文件数或内存增长上限，主动退出
+EXIT_TIMEOUT = "timeout"
+EXIT_CRASHED = "crashed"
+EXIT_CANCELLED = "cancelled"  # 调用方通过cancel()取消（如多节点模式下租约丢失）
+CANCEL_POLL_SECONDS = 1.0  # 有文件在处理时，检查取消请求的最长间隔
+MAX_INIT_FAILURES = 3  # 连续这么多个工作进程初始化失败时放弃整个运行（配置或环境问题，不是文件的问题）
+
+
+def _rss_mb() -> float:
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+def _worker_main(conn, init: Callable, handle: Callable, close: Optional[Callable],
+                 max_files: int, max_rss_growth_mb: float):
+    """
+    工作进程主循环
+
+    init() 创建进程级状态（编码池、清单连接等），完成后先回传None（初始化
+    失败时回传错误信息并退出），之后逐个接收文件路径，调用 handle(state, path)
+    并回传结果。处理满 max_files 个文件或RSS比第一个文件处理完时增长超过
+    max_rss_growth_mb 后通知主进程并退出，由主进程补充新进程，释放psd_tools
+    残留的内存。
+    """
+    try:
+        state = init()
+    except Exception:
+        conn.send(traceback.format_exc(limit=5))
+        conn.close()
+        return
+    conn.send(None)
+    baseline_rss = None
+    files_done = 0
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                break
+            try:
+                result = handle(state, task)
+            except Exception:
+                result = {"success": False, "error": traceback.format_exc(limit=5)}
+            files_done += 1
+
+            rss = _rss_mb()
+            if baseline_rss is None:
+                baseline_rss = rss
+            retire = ((max_files and files_done >= max_files)
+                      or (max_rss_growth_mb and rss - baseline_rss > max_rss_growth_mb))
+            conn.send((task, result, bool(retire)))
+            if retire:
+                break
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        if close is not None:
+            close(state)
+        conn.close()
+
+
+class _Worker:
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.ready = False  # 初始化完成后才派发文件
+        self.task = None
+        self.estimate = 0.0
+        self.started_at = 0.0
+
+    @property
+    def busy(self) -> bool:
+        return self.task is not None
+
+
+class PSDWorkerPool:
+    """
+    按文件分发的进程池
+
+    主进程持有待处理队列，哪个工作进程空闲就把下一个文件发给它（每个进程
+    同一时间只处理一个文件），慢文件不会拖住其他文件。每个文件有墙钟时限，
+    超时的进程被直接kill并补充新进程；进程崩溃同样补充。进程处理满一定数量
+    的文件或内存增长过多后主动退出重启。
+
+    配合 MemoryBudgetScheduler 使用时，只有预估内存在预算内的文件才会被派发。
+    其他线程可以用 cancel(path) 取消正在处理的文件，处理它的进程同样被kill。
+    文件只派发给初始化成功的进程；初始化失败不归咎于任何文件，连续
+    MAX_INIT_FAILURES 次失败时 run() 抛出 RuntimeError。
+    """
+
+    def __init__(self, init: Callable, handle: Callable, close: Optional[Callable] = None,
+                 num_workers: int = 4, timeout: Optional[float] = None,
+                 max_files_per_worker: int = 0, max_rss_growth_mb: float = 0):
+        self.init = init
+        self.handle = handle
+        self.close = close
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.max_files_per_worker = max_files_per_worker
+        self.max_rss_growth_mb = max_rss_growth_mb
+        self.ctx = multiprocessing.get_context()
+        self.workers = []
+        self.counters = {"spawned": 0, "retired": 0, "timeout": 0, "crashed": 0, "cancelled": 0,
+                         "init_failed": 0}
+        self._init_failures = 0  # 连续初始化失败次数
+        self._cancel_lock = threading.Lock()
+        self._cancelled = {}  # 待取消的文件 -> 原因说明
+
+    def _spawn(self) -> _Worker:
+        parent_conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(
+            target=_worker_main,
+            args=(child_conn, self.init, self.handle, self.close,
+                  self.max_files_per_worker, self.max_rss_growth_mb),
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+        self.counters["spawned"] += 1
+        return _Worker(process, parent_conn)
+
+    def _replace(self, worker: _Worker, kill: bool = False):
+        if kill and worker.process.is_alive():
+            worker.process.kill()
+        worker.process.join(timeout=10)
+        worker.conn.close()
+        index = self.workers.index(worker)
+        self.workers[index] = self._spawn()
+
+    def run(self, scheduler, on_result: Callable, on_failure: Callable):
+        """
+        处理scheduler中的全部文件
+
+        on_result(path, result) 在文件正常处理完（成功或失败）时调用；
+        on_failure(path, reason, message) 在超时、进程崩溃或被取消时调用，reason为
+        EXIT_TIMEOUT / EXIT_CRASHED / EXIT_CANCELLED。
+        """
+        self.workers = [self._spawn() for _ in range(self.num_workers)]
+        try:
+            while len(scheduler) or any(w.busy for w in self.workers):
+                self._dispatch(scheduler)
+                self._collect(scheduler, on_result, on_failure)
+        finally:
+            self.shutdown()
+
+    def _dispatch(self, scheduler):
+        """把可放行的文件派发给空闲进程"""
+        for i in range(len(self.workers)):
+            if self.workers[i].busy:
+                continue
+            if not self.workers[i].ready:
+                continue
+            if not self.workers[i].process.is_alive():
+                # 空闲时退出，先补充（新进程初始化完成后再派发）
+                self._replace(self.workers[i])
+                continue
+            worker = self.workers[i]
+            running = sum(w.busy for w in self.workers)
+            admitted = scheduler.pop_admissible(running)
+            if admitted is None:
+                return
+            worker.task, worker.estimate = admitted
+            worker.started_at = time.monotonic()
+            self._take_cancel(worker.task)  # 丢弃该文件上次处理结束后才到达的取消请求
+            worker.conn.send(worker.task)
+
+    def cancel(self, task, message: str = "cancelled"):
+        """取消正在处理的文件（线程安全，最迟CANCEL_POLL_SECONDS后kill处理它的进程）"""
+        with self._cancel_lock:
+            self._cancelled[task] = message
+
+    def _take_cancel(self, task) -> Optional[str]:
+        with self._cancel_lock:
+            return self._cancelled.pop(task, None)
+
+    def _wait_timeout(self) -> float:
+        now = time.monotonic()
+        deadlines = [w.started_at + self.timeout - now for w in self.workers if w.busy] if self.timeout else []
+        return max(0.0, min(deadlines + [CANCEL_POLL_SECONDS]))
+
+    def _collect(self, scheduler, on_result: Callable, on_failure: Callable):
+        """等待结果、进程退出、初始化完成或超时，并处理"""
+        busy = [w for w in self.workers if w.busy]
+        starting = [w for w in self.workers if not w.ready]
+        if not busy and not starting:
+            return
+        handles = [w.conn for w in busy + starting] + [w.process.sentinel for w in busy + starting]
+        ready = set(wait_connections(handles, timeout=self._wait_timeout()))
+
+        for worker in starting:
+            if worker.conn in ready or worker.process.sentinel in ready:
+                self._started(worker)
+
+        for worker in busy:
+            # 结果已经回传的文件不再取消，由on_result的调用方处理
+            cancelled = self._take_cancel(worker.task)
+            if worker.conn in ready:
+                try:
+                    task, result, retire = worker.conn.recv()
+                except (EOFError, OSError):
+                    # 发送结果前进程就退出了
+                    self._fail(worker, scheduler, on_failure, EXIT_CRASHED,
+                               f"worker exited with code {worker.process.exitcode}")
+                    continue
+                scheduler.finish(worker.estimate)
+                worker.task = None
+                on_result(task, result)
+                if retire:
+                    self.counters["retired"] += 1
+                    self._replace(worker)
+            elif worker.process.sentinel in ready:
+                worker.process.join(timeout=1)
+                self._fail(worker, scheduler, on_failure, EXIT_CRASHED,
+                           f"worker exited with code {worker.process.exitcode}")
+            elif cancelled is not None:
+                self._fail(worker, scheduler, on_failure, EXIT_CANCELLED, cancelled)
+            elif self.timeout and time.monotonic() - worker.started_at >= self.timeout:
+                self._fail(worker, scheduler, on_failure, EXIT_TIMEOUT,
+                           f"exceeded {self.timeout:.0f}s wall-clock limit")
+
+    def _started(self, worker: _Worker):
+        """处理新进程的初始化结果；失败时补充新进程，连续失败过多时放弃"""
+        try:
+            error = worker.conn.recv()
+        except (EOFError, OSError):
+            error = f"worker exited with code {worker.process.exitcode} during initialization"
+        if error is None:
+            worker.ready = True
+            self._init_failures = 0
+            return
+        self.counters["init_failed"] += 1
+        self._init_failures += 1
+        if self._init_failures >= MAX_INIT_FAILURES:
+            raise RuntimeError(f"{self._init_failures} workers in a row failed to initialize:\n{error}")
+        print(f"\nWorker initialization failed, respawning:\n{error}")
+        self._replace(worker, kill=True)
+
+    def _fail(self, worker: _Worker, scheduler, on_failure: Callable, reason: str, message: str):
+        task = worker.task
+        scheduler.finish(worker.estimate)
+        worker.task = None
+        self.counters[reason] += 1
+        self._replace(worker, kill=True)
+        on_failure(task, reason, message)
+
+    def shutdown(self):
+        """通知空闲进程退出，仍在运行的进程直接终止"""
+        for worker in self.workers:
+            try:
+                if worker.busy:
+                    worker.process.kill()
+                else:
+                    worker.conn.send(None)
+            except (OSError, ValueError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout=30)
+            if worker.process.is_alive():
+                worker.process.kill()
+                worker.process.join()
+            worker.conn.close()
+        self.workers = []
+
+    def stats(self) -> Dict:
+        return dict(self.counters)
+
+    def worker_info(self) -> List[Dict]:
+        """各工作进程的pid、是否忙碌、当前文件和已用时间（供指标线程读取）"""
+        now = time.monotonic()
+        return [{"pid": w.process.pid, "busy": w.busy, "task": w.task,
+                 "elapsed": now - w.started_at if w.busy else 0.0}
+                for w in list(self.workers)]
@@ -0,0 +1,293 @@
+import io
+import os
+import json
+import time
+import socket
+import tarfile
+import threading
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+import psutil
+from PIL import Image
+from image_codecs import decode_raw
+
+# tar分片目录（放在输出文件夹根目录）
+SHARDS_DIRNAME = "_shards"
+DEFAULT_SHARD_BYTES = 1024 * 1024 * 1024
+INDEX_SUFFIX = ".idx.npz"
+# 未完成分片的提交点（最后一个完整文档结束处的偏移），与 .tar.tmp 同名
+COMMIT_SUFFIX = ".commit"
+
+
+def member_key(name: str) -> str:
+    """成员名对应的索引键：去掉目录和扩展名，如 f0/f0_2_3.png -> f0_2_3"""
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+class TarShardWriter:
+    """
+    把输出文件流式写入滚动的tar分片（WebDataset风格）
+
+    成员名为相对输出文件夹的路径（{id}/{id}_{type}_{z}.png、
+    {id}/{id}_preview.png、{id}/{id}_layers.json），一个PSD的所有成员写在同一
+    分片中。分片先写为 .tar.tmp，超过 max_shard_bytes 后在文档边界处关闭：
+    先写索引（成员名、数据偏移、大小），再改名为 .tar，因此存在的 .tar 总是
+    完整且有索引。每个进程一个写入器，编码线程并发调用 write_file。
+
+    每个文档结束（end_document）时fsync分片并记录提交点；处理失败的文档用
+    abort_document 截断回上一个提交点，不留下半个文档的成员。进程被终止后
+    遗留的 .tar.tmp 由本机后续的写入器（recover_orphan_shards）截断到提交点、
+    补上结束块和索引后改名为 .tar，已报告完成的文档不会丢失。
+    """
+
+    def __init__(self, output_folder: str, max_shard_bytes: int = DEFAULT_SHARD_BYTES):
+        self.output_folder = output_folder
+        self.folder = os.path.join(output_folder, SHARDS_DIRNAME)
+        self.max_shard_bytes = max_shard_bytes
+        self._prefix = f"shard-{time.time_ns()}-{socket.gethostname()}-{os.getpid()}"
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._tar = None
+        self._fileobj = None
+        self._name = None
+        self._entries = []
+        self._committed = (0, 0)  # (分片偏移, 成员数)
+        os.makedirs(self.folder, exist_ok=True)
+        recover_orphan_shards(self.folder)
+
+    def _open_locked(self):
+        self._name = f"{self._prefix}-{self._seq:05d}.tar"
+        self._seq += 1
+        self._fileobj = open(os.path.join(self.folder, self._name + ".tmp"), 'wb')
+        self._tar = tarfile.open(fileobj=self._fileobj, mode='w', format=tarfile.PAX_FORMAT)
+        self._entries = []
+        self._committed = (0, 0)
+
+    def write_file(self, filepath: str, data: bytes) -> int:
+        """写入一个成员（与 write_file_atomic 同签名，可直接作为编码池的写入函数）"""
+        name = os.path.relpath(filepath, self.output_folder).replace(os.sep, '/')
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        with self._lock:
+            if self._tar is None:
+                self._open_locked()
+            self._tar.addfile(info, io.BytesIO(data))
+            # addfile之后offset指向下一个头部，数据按512字节块对齐
+            padded = -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self._entries.append((name, self._tar.offset - padded, len(data)))
+        return len(data)
+
+    def end_document(self) -> Optional[str]:
+        """
+        一个PSD的所有输出已写入，返回其所在分片相对输出文件夹的路径
+
+        当前分片达到大小上限时在此关闭并滚动到新分片。
+        """
+        with self._lock:
+            if self._tar is None:
+                return None
+            shard_path = os.path.join(SHARDS_DIRNAME, self._name)
+            if self._tar.offset >= self.max_shard_bytes:
+                self._finish_locked()
+            else:
+                self._commit_locked()
+            return shard_path
+
+    def _commit_locked(self):
+        """把当前文档落盘并记录提交点"""
+        self._fileobj.flush()
+        os.fsync(self._fileobj.fileno())
+        self._committed = (self._tar.offset, len(self._entries))
+        commit_path = os.path.join(self.folder, self._name + ".tmp" + COMMIT_SUFFIX)
+        tmp_path = commit_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid(),
+                       "offset": self._committed[0], "members": self._committed[1]}, f)
+        os.replace(tmp_path, commit_path)
+
+    def abort_document(self):
+        """丢弃当前文档已写入的成员（截断回上一个提交点），调用前需等待该文档的写入全部结束"""
+        with self._lock:
+            if self._tar is None:
+                return
+            offset, members = self._committed
+            self._fileobj.flush()
+            self._fileobj.seek(offset)
+            self._fileobj.truncate()
+            self._tar.offset = offset
+            del self._tar.members[members:]
+            del self._entries[members:]
+
+    def _finish_locked(self):
+        self._tar.close()
+        self._fileobj.close()
+        final_path = os.path.join(self.folder, self._name)
+
+        names, offsets, sizes = zip(*self._entries) if self._entries else ((), (), ())
+        index_path = final_path + INDEX_SUFFIX
+        tmp_index = index_path + ".tmp.npz"
+        np.savez(tmp_index,
+                 name=np.array(names, dtype=str),
+                 offset=np.array(offsets, dtype=np.int64),
+                 size=np.array(sizes, dtype=np.int64))
+        os.replace(tmp_index, index_path)
+        os.replace(final_path + ".tmp", final_path)
+        _remove(final_path + ".tmp" + COMMIT_SUFFIX)
+
+        self._tar = None
+        self._fileobj = None
+        self._name = None
+        self._entries = []
+
+    def close(self):
+        with self._lock:
+            if self._tar is not None:
+                self._finish_locked()
+
+
+def _remove(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _write_index(tar_path: str):
+    """扫描tar生成成员索引（恢复遗留分片时使用）"""
+    names, offsets, sizes = [], [], []
+    with tarfile.open(tar_path, mode='r') as tar:
+        for member in tar:
+            if member.isfile():
+                names.append(member.name)
+                offsets.append(member.offset_data)
+                sizes.append(member.size)
+    index_path = tar_path + INDEX_SUFFIX
+    tmp_index = index_path + ".tmp.npz"
+    np.savez(tmp_index, name=np.array(names, dtype=str), offset=np.array(offsets, dtype=np.int64),
+             size=np.array(sizes, dtype=np.int64))
+    os.replace(tmp_index, index_path)
+
+
+def recover_orphan_shards(shards_folder: str) -> List[str]:
+    """
+    完成本机已退出进程遗留的 .tar.tmp，返回恢复出的分片路径
+
+    分片截断到最后一个提交点（之后是未完成文档的成员），补上tar结束块，
+    重新扫描生成索引后改名为 .tar；没有提交点的分片直接删除。其他主机的
+    遗留分片由其所在主机处理。多个进程同时恢复时，通过改名认领。
+    """
+    host = socket.gethostname()
+    recovered = []
+    for f in sorted(os.listdir(shards_folder)):
+        if not f.endswith('.tar.tmp'):
+            continue
+        tmp_path = os.path.join(shards_folder, f)
+        commit_path = tmp_path + COMMIT_SUFFIX
+        try:
+            with open(commit_path, 'r', encoding='utf-8') as cf:
+                commit = json.load(cf)
+        except (OSError, ValueError):
+            commit = None
+        if commit is not None:
+            owner_host, pid = commit.get("host"), commit.get("pid", 0)
+        else:
+            # 还没有提交过：从分片名 shard-{时间}-{主机}-{进程号}-{序号}.tar 解析
+            parts = f[:-len('.tar.tmp')].split('-')
+            owner_host, pid = '-'.join(parts[2:-2]), int(parts[-2]) if parts[-2].isdigit() else 0
+        if owner_host != host or pid == os.getpid() or psutil.pid_exists(pid):
+            continue
+
+        claimed = f"{tmp_path}.recover.{os.getpid()}"
+        try:
+            os.rename(tmp_path, claimed)
+        except OSError:
+            continue  # 其他进程已认领
+        if commit is None or not commit.get("offset"):
+            _remove(claimed)
+            _remove(commit_path)
+            continue
+        with open(claimed, 'r+b') as tf:
+            tf.truncate(commit["offset"])
+            tf.seek(commit["offset"])
+            tf.write(b"\0" * tarfile.BLOCKSIZE * 2)
+            tf.flush()
+            os.fsync(tf.fileno())
+        final_path = tmp_path[:-len('.tmp')]
+        _write_index(claimed)
+        os.replace(claimed + INDEX_SUFFIX, final_path + INDEX_SUFFIX)
+        os.replace(claimed, final_path)
+        _remove(commit_path)
+        recovered.append(final_path)
+    return recovered
+
+
+def list_shards(shards_folder: str) -> List[str]:
+    """按写入顺序列出已完成的分片"""
+    if not os.path.isdir(shards_folder):
+        return []
+    return [os.path.join(shards_folder, f) for f in sorted(os.listdir(shards_folder))
+            if f.endswith('.tar')]
+
+
+class ShardIndex:
+    """
+    所有分片的成员索引，按成员名或键（{id}_{type}_{z}）直接读取数据
+
+    读取时按偏移seek到分片中的数据位置，不解包。同一成员出现在多个分片中
+    （PSD被重新处理过）时以最后写入的为准。
+    """
+
+    def __init__(self, output_folder: str):
+        folder = output_folder
+        if os.path.basename(os.path.normpath(folder)) != SHARDS_DIRNAME:
+            folder = os.path.join(output_folder, SHARDS_DIRNAME)
+        self.shards = list_shards(folder)
+        self._by_name: Dict[str, Tuple[int, int, int]] = {}
+        self._by_key: Dict[str, str] = {}
+        for shard_id, shard in enumerate(self.shards):
+            with np.load(shard + INDEX_SUFFIX) as index:
+                names, offsets, sizes = index["name"], index["offset"], index["size"]
+            for name, offset, size in zip(names.tolist(), offsets.tolist(), sizes.tolist()):
+                self._by_name[name] = (shard_id, offset, size)
+                self._by_key[member_key(name)] = name
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def __contains__(self, name_or_key: str) -> bool:
+        return name_or_key in self._by_name or name_or_key in self._by_key
+
+    def names(self) -> List[str]:
+        return list(self._by_name)
+
+    def locate(self, name_or_key: str) -> Tuple[str, int, int]:
+        """返回 (分片路径, 数据偏移, 大小)"""
+        name = name_or_key if name_or_key in self._by_name else self._by_key[name_or_key]
+        shard_id, offset, size = self._by_name[name]
+        return self.shards[shard_id], offset, size
+
+    def read(self, name_or_key: str) -> bytes:
+        shard, offset, size = self.locate(name_or_key)
+        with self._lock:
+            f = self._files.get(shard)
+            if f is None:
+                f = self._files[shard] = open(shard, 'rb')
+            f.seek(offset)
+            return f.read(size)
+
+    def open_image(self, name_or_key: str):
+        """以PIL图像打开成员（支持原始像素格式）"""
+        data = self.read(name_or_key)
+        name = name_or_key if name_or_key in self._by_name else self._by_key[name_or_key]
+        if name.endswith('.raw'):
+            return decode_raw(data)
+        return Image.open(io.BytesIO(data))
+
+    def close(self):
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
@@ -0,0 +1,26 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psd_synth import CorpusSpec, generate_corpus  # noqa: E402
+
+# 小尺寸语料：覆盖像素/文字/形状/调整图层、蒙版、隐藏图层、嵌套组和16位文档
+TEST_SPECS = [
+    CorpusSpec("plain", count=2, width=160, height=120, layers=6),
+    CorpusSpec("mixed", count=2, width=160, height=120, layers=10, group_depth=2,
+               kinds={"pixel": 0.5, "type": 0.2, "shape": 0.2, "adjustment": 0.1},
+               mask_ratio=0.3, hidden_ratio=0.2),
+    CorpusSpec("deep16", count=1, width=96, height=64, layers=4, depth=16),
+]
+
+
+@pytest.fixture(scope="session")
+def psd_files(tmp_path_factory):
+    """测试用的合成PSD（整个会话生成一次）"""
+    folder = str(tmp_path_factory.mktemp("psd"))
+    paths = []
+    for spec in TEST_SPECS:
+        paths.extend(generate_corpus(os.path.join(folder, spec.name), spec, seed=1))
+    return paths
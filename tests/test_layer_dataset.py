@@ -0,0 +1,71 @@
+import os
+import numpy as np
+
+from layer_dataset import (DATASET_DIRNAME, LayerDatasetWriter, compact_journals, iter_documents,
+                           list_shards, read_dataset)
+
+
+def _document(doc_id, layers, canvas=(100, 80)):
+    return {
+        "id": doc_id,
+        "canvas_width": canvas[0],
+        "canvas_height": canvas[1],
+        "preview_path": f"{doc_id}_preview.png",
+        "preview_thumbs": {"256": f"{doc_id}_preview_256.jpg"},
+        "z": list(range(layers)),
+        "type": [2] * layers,
+        "left": [i * 3 for i in range(layers)],
+        "top": [-i for i in range(layers)],
+        "width": [10 + i for i in range(layers)],
+        "height": [5 + i for i in range(layers)],
+        "image_path": [f"{doc_id}_2_{i}.png" for i in range(layers)],
+        "layer_names": [f"图层 {i}" for i in range(layers)],
+        "dhash": [np.uint64(2 ** 63 + i) for i in range(layers)],
+        "phash": [i for i in range(layers)],
+    }
+
+
+def _normalize(document):
+    document = dict(document)
+    document["dhash"] = [int(v) for v in document["dhash"]]
+    return document
+
+
+def _read_all(output_folder):
+    docs, layers = read_dataset(os.path.join(output_folder, DATASET_DIRNAME))
+    return {d["id"]: d for d in iter_documents(docs, layers)}
+
+
+def test_round_trip_with_rolled_shards(tmp_path):
+    writer = LayerDatasetWriter(str(tmp_path), docs_per_shard=2)
+    documents = [_document(f"doc{i}", i) for i in range(5)]
+    for document in documents:
+        writer.append(document)
+    writer.close()
+
+    assert _read_all(str(tmp_path)) == {d["id"]: _normalize(d) for d in documents}
+    shards = list_shards(str(tmp_path / DATASET_DIRNAME))
+    assert len(shards) == 3 and all(p.endswith('.npz') for p in shards)
+
+
+def test_appended_documents_survive_a_killed_writer(tmp_path):
+    writer = LayerDatasetWriter(str(tmp_path), docs_per_shard=100)
+    journal = writer.append(_document("a", 2))
+    writer.append(_document("b", 3))
+    # 模拟进程被终止：没有close，分片没有写出，日志最后一行写了一半
+    with open(tmp_path / journal, 'a', encoding='utf-8') as f:
+        f.write('{"id": "c", "canvas')
+    assert os.path.getsize(tmp_path / journal) > 0
+    assert set(_read_all(str(tmp_path))) == {"a", "b"}
+
+    # 重新处理a：后写入的版本覆盖日志中的旧版本
+    rerun = LayerDatasetWriter(str(tmp_path), docs_per_shard=100)
+    rerun.append(_document("a", 4))
+    rerun.close()
+    result = _read_all(str(tmp_path))
+    assert len(result["a"]["z"]) == 4 and len(result["b"]["z"]) == 3
+
+    written = compact_journals(str(tmp_path / DATASET_DIRNAME), min_age_seconds=0)
+    assert len(written) == 1
+    assert os.path.getsize(tmp_path / journal) == 0  # 保留为清单的输出标记
+    assert _read_all(str(tmp_path)) == result
@@ -0,0 +1,33 @@
+import os
+import numpy as np
+from PIL import Image
+
+from layer_phash import INDEX_FILENAME, load_or_build_index, near_duplicates
+
+
+def _save(folder, name, seed, size=64):
+    rng = np.random.default_rng(seed)
+    pixels = rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    Image.fromarray(pixels).resize((size, size), Image.NEAREST).save(os.path.join(folder, name))
+
+
+def test_index_picks_up_new_and_changed_images(tmp_path):
+    folder = str(tmp_path)
+    _save(folder, "a_2_0.png", 1)
+    _save(folder, "a_2_1.png", 1, size=48)  # a_2_0的缩小版，近似重复
+    _save(folder, "b_2_0.png", 2)
+    index = load_or_build_index(folder, "*_2_*.png", 10, num_workers=2)
+    assert sorted(index["name"].tolist()) == ["a_2_0.png", "a_2_1.png", "b_2_0.png"]
+    assert near_duplicates(index) == {"a_2_1.png"}
+    assert os.path.exists(os.path.join(folder, INDEX_FILENAME))
+
+    # 参数和图片集合都没变时直接复用
+    assert load_or_build_index(folder, "*_2_*.png", 10)["fingerprint"] == index["fingerprint"]
+
+    # 新增图片（b_2_0的放大版）和被覆盖的图片都要进入索引
+    _save(folder, "c_2_0.png", 2, size=96)
+    _save(folder, "a_2_1.png", 3)
+    os.utime(os.path.join(folder, "a_2_1.png"), ns=(1, 1))
+    index = load_or_build_index(folder, "*_2_*.png", 10, num_workers=2)
+    assert sorted(index["name"].tolist()) == ["a_2_0.png", "a_2_1.png", "b_2_0.png", "c_2_0.png"]
+    assert near_duplicates(index) == {"b_2_0.png"}
@@ -0,0 +1,30 @@
+import pytest
+
+import processing_folder_v3 as v3
+from layer_store import LayerBlobStore
+
+
+def test_aborted_document_forgets_its_blobs(tmp_path):
+    store = LayerBlobStore(str(tmp_path))
+    write, pending = store.reserve("ab" * 20)
+    assert write
+    pending.set_result(1)
+    store._settle("ab" * 20, None)
+    assert store.reserve("ab" * 20) == (False, None)
+
+    # 文档被回滚（tar分片截断），同样内容的图层需要重新写入
+    store.abort_document()
+    write, _ = store.reserve("ab" * 20)
+    assert write
+
+    # 已提交文档的哈希不受之后的回滚影响
+    store.commit_document()
+    store.abort_document()
+    assert store.reserve("ab" * 20)[0] is False
+
+
+def test_dedup_with_tar_output_is_rejected(monkeypatch):
+    monkeypatch.setattr(v3, "DEDUP_LAYERS", True)
+    monkeypatch.setattr(v3, "OUTPUT_MODE", "tar")
+    with pytest.raises(ValueError):
+        v3.check_config()
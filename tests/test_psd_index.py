@@ -0,0 +1,49 @@
+import os
+from psd_tools import PSDImage
+
+from psd_header import read_psd_header
+from psd_index import INDEX_FILENAME, build_index, load_headers, save_index
+
+
+def _psd_tools_counts(path):
+    psd = PSDImage.open(path)
+    layers = list(psd.descendants())
+    groups = sum(1 for layer in layers if layer.is_group())
+    return len(layers) - groups, groups
+
+
+def test_header_counts_match_psd_tools(psd_files):
+    columns = build_index(psd_files)
+    assert not any(columns["error"])
+    for i, path in enumerate(psd_files):
+        layers, groups = _psd_tools_counts(path)
+        header = read_psd_header(path)
+        assert (header["layer_count"], header["group_count"]) == (layers, groups), path
+        assert (columns["layer_count"][i], columns["group_count"][i]) == (layers, groups), path
+        assert header["depth"] == int(columns["depth"][i])
+    # 16位文件的图层记录在Lr16块中
+    assert any(read_psd_header(p)["depth"] == 16 and read_psd_header(p)["layer_count"] > 0 for p in psd_files)
+
+
+def test_load_headers_matches_read_psd_header(psd_files, tmp_path):
+    index_path = str(tmp_path / INDEX_FILENAME)
+    save_index(index_path, build_index(psd_files))
+    headers = load_headers(index_path)
+    assert headers == {p: read_psd_header(p) for p in psd_files}
+
+
+def test_load_headers_skips_stale_entries(psd_files, tmp_path):
+    copies = []
+    for path in psd_files[:2]:
+        copy = str(tmp_path / os.path.basename(path))
+        with open(path, 'rb') as src, open(copy, 'wb') as dst:
+            dst.write(src.read())
+        copies.append(copy)
+    index_path = str(tmp_path / INDEX_FILENAME)
+    save_index(index_path, build_index(copies))
+
+    stat = os.stat(copies[0])
+    os.utime(copies[0], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    os.remove(copies[1])
+    assert load_headers(index_path) == {}
+    assert set(load_headers(index_path, check_stale=False)) == set(copies)
@@ -0,0 +1,56 @@
+import json
+import os
+import threading
+import time
+
+from psd_lease import LEASE_CLAIMED, LeaseBoard
+from psd_manifest import PSDManifest
+from psd_scheduler import MemoryBudgetScheduler
+from psd_worker_pool import EXIT_CANCELLED, PSDWorkerPool
+
+
+def _init():
+    return {}
+
+
+def _sleep(state, task):
+    time.sleep(30)
+    return {"success": True}
+
+
+def test_lost_lease_is_reported_and_not_marked_done(tmp_path):
+    output = str(tmp_path / "out")
+    os.makedirs(output)
+    manifest = PSDManifest(str(tmp_path / "manifest.sqlite"))
+    lost = []
+    leases = LeaseBoard(output, manifest, "node-a", heartbeat=0.05, on_lost=lost.append).start()
+    try:
+        psd = str(tmp_path / "a.psd")
+        assert leases.claim(psd) == LEASE_CLAIMED
+        # 其他节点回收了租约
+        lease_path, done_path = leases._paths(psd)
+        with open(lease_path, 'w', encoding='utf-8') as f:
+            json.dump({"node": "node-b", "pid": 1}, f)
+        deadline = time.time() + 5
+        while not lost and time.time() < deadline:
+            time.sleep(0.05)
+        assert lost == [psd]
+        assert leases.finish(psd, {"status": "done"}) is False
+        assert not os.path.exists(done_path)
+        assert leases.stats()["lost"] == 1
+    finally:
+        leases.stop()
+        manifest.close()
+
+
+def test_cancel_kills_the_worker():
+    scheduler = MemoryBudgetScheduler(1024)
+    scheduler.add_tasks(["a.psd"], [1])
+    pool = PSDWorkerPool(_init, _sleep, num_workers=1)
+    failures = []
+    threading.Timer(0.5, pool.cancel, args=("a.psd", "lease lost")).start()
+    started = time.monotonic()
+    pool.run(scheduler, lambda task, result: None, lambda *args: failures.append(args))
+    assert failures == [("a.psd", EXIT_CANCELLED, "lease lost")]
+    assert time.monotonic() - started < 10
+    assert pool.stats()["cancelled"] == 1
@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+from psd_manifest import STATUS_CRASHED, STATUS_TIMEOUT, PSDManifest, duplicate_file_ids
+
+
+def test_bad_files_are_retried_after_they_change(tmp_path):
+    psd = tmp_path / "a.psd"
+    psd.write_bytes(b"broken")
+    manifest = PSDManifest(str(tmp_path / "manifest.sqlite"))
+    try:
+        manifest.mark_running(str(psd))
+        manifest.mark_failed(str(psd), "exceeded limit", status=STATUS_TIMEOUT)
+        skip = (STATUS_TIMEOUT, STATUS_CRASHED)
+        assert manifest.pending([str(psd)], str(tmp_path), skip) == []
+
+        # 文件被修复或替换后重新处理
+        psd.write_bytes(b"fixed file")
+        os.utime(psd, ns=(1, 1))
+        assert manifest.pending([str(psd)], str(tmp_path), skip) == [str(psd)]
+    finally:
+        manifest.close()
+
+
+def test_same_named_psds_never_clear_each_other(tmp_path):
+    (tmp_path / "x").mkdir()
+    (tmp_path / "y").mkdir()
+    first, second = tmp_path / "x" / "a.psd", tmp_path / "y" / "a.psd"
+    first.write_bytes(b"first")
+    second.write_bytes(b"second")
+    assert duplicate_file_ids([str(first), str(second)]) == {"a": [str(first), str(second)]}
+
+    output = tmp_path / "out"
+    (output / "a").mkdir(parents=True)
+    (output / "a" / "a_2_0.png").write_bytes(b"layer")
+    manifest = PSDManifest(str(tmp_path / "manifest.sqlite"))
+    try:
+        manifest.mark_done(str(first), 1, ["a/a_2_0.png"])
+        with pytest.raises(ValueError):
+            manifest.clear_output_folder(str(second), str(output), "a")
+        assert (output / "a" / "a_2_0.png").exists()
+
+        # 自己的半成品照常清理
+        manifest.mark_failed(str(first), "extraction failed")
+        manifest.clear_output_folder(str(first), str(output), "a")
+        assert not (output / "a").exists()
+    finally:
+        manifest.close()
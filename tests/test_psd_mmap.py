@@ -0,0 +1,40 @@
+import numpy as np
+from PIL import Image
+from psd_tools import PSDImage
+
+from psd_mmap import ZERO_COPY_MIN_BYTES, open_psd
+from psd_synth import _pixel_layer
+
+
+def _assert_same_render(path):
+    mapped, handle = open_psd(path, mapped=True)
+    plain = PSDImage.open(path)
+    try:
+        assert handle is not None, "mmap open fell back to a plain read"
+        assert mapped.topil().tobytes() == plain.topil().tobytes()
+        assert mapped.composite().tobytes() == plain.composite().tobytes()
+        for a, b in zip(mapped.descendants(), plain.descendants()):
+            assert a.name == b.name
+            if a.is_group() or not a.is_visible() or not a.bbox:
+                continue
+            assert a.topil().tobytes() == b.topil().tobytes(), a.name
+            assert a.composite().tobytes() == b.composite().tobytes(), a.name
+    finally:
+        handle.close()
+
+
+def test_mmap_matches_plain_open(psd_files):
+    for path in psd_files:
+        _assert_same_render(path)
+
+
+def test_mmap_zero_copy_channels(tmp_path):
+    # 噪声图层的通道数据压缩后仍超过零拷贝阈值，走memoryview切片
+    rng = np.random.default_rng(3)
+    psd = PSDImage.new('RGB', (400, 300))
+    psd.append(_pixel_layer(psd, Image.fromarray(rng.integers(0, 256, (300, 400, 4), dtype=np.uint8), 'RGBA'),
+                            'noise', left=-20, top=10))
+    path = str(tmp_path / "noise.psd")
+    psd.save(path)
+    assert max(len(channel.data) for channel in PSDImage.open(path)[0]._channels) >= ZERO_COPY_MIN_BYTES
+    _assert_same_render(path)
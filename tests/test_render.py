@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+from PIL import Image
+from psd_tools import PSDImage
+
+import processing_folder_v3 as v3
+from layer_compositor import RegionCompositor, alpha_composite_arrays
+from layer_render_cache import LayerRenderCache
+from psd_synth import _pixel_layer
+
+
+def _plain_layers(extractor):
+    """提取时会走通道直读的图层（隐藏图层不导出，psd_tools对其合成结果为全透明）"""
+    return [layer for layer in extractor.psd.descendants()
+            if layer.is_visible() and extractor.is_plain_pixel_layer(layer)]
+
+
+def test_raw_channels_match_composite(psd_files, tmp_path):
+    checked = 0
+    for psd_path in psd_files:
+        extractor = v3.UltraOptimizedPSDExtractor(psd_path, str(tmp_path), saver=None)
+        for layer in _plain_layers(extractor):
+            raw = extractor.render_raw_channels(layer)
+            expected = layer.composite()
+            if expected.mode != 'RGBA':
+                expected = expected.convert('RGBA')
+            assert raw.tobytes() == expected.tobytes(), layer.name
+            checked += 1
+        extractor.release_psd()
+    assert checked > 0
+
+
+def test_raw_channels_partial_alpha(tmp_path):
+    psd = PSDImage.new('RGB', (64, 48))
+    rng = np.random.default_rng(0)
+    arr = rng.integers(0, 256, (32, 40, 4), dtype=np.uint8)
+    psd.append(_pixel_layer(psd, Image.fromarray(arr, 'RGBA'), 'partial', left=5, top=7))
+    path = str(tmp_path / "partial.psd")
+    psd.save(path)
+
+    extractor = v3.UltraOptimizedPSDExtractor(path, str(tmp_path), saver=None)
+    (layer,) = _plain_layers(extractor)
+    assert extractor.render_raw_channels(layer).tobytes() == layer.composite().convert('RGBA').tobytes()
+    extractor.release_psd()
+
+
+@pytest.mark.parametrize("opaque", [False, True])
+def test_alpha_composite_matches_pillow(opaque):
+    rng = np.random.default_rng(1)
+    dst = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+    src = rng.integers(0, 256, (37, 53, 4), dtype=np.uint8)
+    src[:5, :, 3] = 0
+    dst[-5:, :, 3] = 0
+    if opaque:
+        src[..., 3] = 255
+    expected = Image.alpha_composite(Image.fromarray(dst, 'RGBA'), Image.fromarray(src, 'RGBA'))
+    assert alpha_composite_arrays(dst, src).tobytes() == expected.tobytes()
+
+
+def test_region_compositor_matches_pillow():
+    rng = np.random.default_rng(2)
+    width, height = 80, 60
+    expected = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+    compositor = RegionCompositor(width, height, (255, 255, 255, 0))
+    # 含超出画布、完全在画布外的图层
+    for left, top, w, h in [(0, 0, 80, 60), (-10, -5, 30, 25), (50, 40, 45, 35), (100, 10, 5, 5), (20, 15, 30, 20)]:
+        layer = Image.fromarray(rng.integers(0, 256, (h, w, 4), dtype=np.uint8), 'RGBA')
+        compositor.blend(layer, left, top)
+        full = Image.new('RGBA', (width, height), (0, 0, 0, 0))
+        full.paste(layer, (left, top))
+        expected = Image.alpha_composite(expected, full)
+    assert compositor.to_rgba().tobytes() == expected.tobytes()
+
+    rgb = Image.new('RGB', (width, height), (255, 255, 255))
+    rgb.paste(expected, mask=expected.getchannel('A'))
+    assert compositor.to_rgb((255, 255, 255)).tobytes() == rgb.tobytes()
+
+
+def test_render_cache_keeps_oversized_layer_until_released():
+    renders = []
+
+    def render(layer):
+        renders.append(layer)
+        return Image.new('RGBA', layer)
+
+    cache = LayerRenderCache(max_bytes=64 * 64 * 4, render=render)
+    small, big = (8, 8), (128, 128)
+    cache.get(small)
+    # 超过上限的图层：分类和导出共用一次合成结果，其他图像被淘汰
+    cache.get(big)
+    cache.get(big)
+    assert renders == [small, big]
+    assert cache.cached_bytes == 128 * 128 * 4
+    cache.release(big)
+    assert cache.cached_bytes == 0
@@ -0,0 +1,35 @@
+from psd_scheduler import MemoryBudgetScheduler
+
+
+def test_backfill_within_budget():
+    scheduler = MemoryBudgetScheduler(1000)
+    scheduler.add_tasks(["big", "a", "b"], [800, 300, 100])
+    assert scheduler.pop_admissible(0) == ("big", 800)
+    # 剩余200MB：放不下a，用b填补
+    assert scheduler.pop_admissible(1) == ("b", 100)
+    assert scheduler.pop_admissible(2) is None
+
+
+def test_blocked_head_reserves_budget_after_max_bypass():
+    scheduler = MemoryBudgetScheduler(1000, max_bypass=2)
+    scheduler.add_tasks(["running"], [600])
+    assert scheduler.pop_admissible(0) == ("running", 600)
+    scheduler.add_tasks(["big"] + [f"small{i}" for i in range(5)], [700] + [50] * 5)
+
+    assert scheduler.pop_admissible(1)[0] == "small0"
+    assert scheduler.pop_admissible(2)[0] == "small1"
+    # 队首已被越过2次：预算虽然还够小任务，也不再放行
+    assert scheduler.pop_admissible(3) is None
+
+    for estimate in (600, 50, 50):
+        scheduler.finish(estimate)
+    assert scheduler.pop_admissible(0) == ("big", 700)
+    # 队首放行后重新允许填补
+    assert scheduler.pop_admissible(1)[0] == "small2"
+
+
+def test_oversized_head_runs_alone():
+    scheduler = MemoryBudgetScheduler(500, max_bypass=1)
+    scheduler.add_tasks(["huge", "s1", "s2"], [900, 100, 100])
+    assert scheduler.pop_admissible(0) == ("huge", 900)
+    assert scheduler.pop_admissible(1) is None
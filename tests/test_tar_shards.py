@@ -0,0 +1,84 @@
+import os
+import subprocess
+import sys
+import tarfile
+
+from tar_shards import SHARDS_DIRNAME, ShardIndex, TarShardWriter, list_shards, recover_orphan_shards
+
+
+def _document_files(doc_id, members=3, size=700):
+    return {f"{doc_id}/{doc_id}_2_{i}.png": bytes([(i * 37 + len(doc_id)) % 256]) * (size + i)
+            for i in range(members)}
+
+
+def _write_document(writer, output_folder, doc_id):
+    files = _document_files(doc_id)
+    for name, data in files.items():
+        writer.write_file(os.path.join(output_folder, name), data)
+    return files
+
+
+def _assert_index_matches(output_folder, expected):
+    index = ShardIndex(output_folder)
+    try:
+        assert sorted(index.names()) == sorted(expected)
+        for name, data in expected.items():
+            assert index.read(name) == data
+    finally:
+        index.close()
+    # 索引与tar本身一致（标准tar工具可以读取）
+    for shard in list_shards(os.path.join(output_folder, SHARDS_DIRNAME)):
+        with tarfile.open(shard) as tar:
+            for member in tar:
+                assert tar.extractfile(member).read() == expected[member.name]
+
+
+def test_index_round_trip_across_rolled_shards(tmp_path):
+    output = str(tmp_path)
+    writer = TarShardWriter(output, max_shard_bytes=4096)
+    expected = {}
+    for i in range(5):
+        expected.update(_write_document(writer, output, f"doc{i}"))
+        assert writer.end_document().startswith(SHARDS_DIRNAME)
+    writer.close()
+    assert len(list_shards(os.path.join(output, SHARDS_DIRNAME))) > 1
+    _assert_index_matches(output, expected)
+
+
+def test_aborted_document_is_dropped(tmp_path):
+    output = str(tmp_path)
+    writer = TarShardWriter(output)
+    expected = _write_document(writer, output, "ok1")
+    writer.end_document()
+    _write_document(writer, output, "failed")
+    writer.abort_document()
+    expected.update(_write_document(writer, output, "ok2"))
+    writer.end_document()
+    writer.close()
+    _assert_index_matches(output, expected)
+
+
+def test_orphan_shard_recovered_to_last_commit(tmp_path):
+    output = str(tmp_path)
+    # 子进程写完一个文档、写了下一个文档的一部分后被终止（不关闭分片）
+    script = (
+        "import os, sys\n"
+        f"sys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})\n"
+        f"sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r})\n"
+        "from test_tar_shards import _write_document\n"
+        "from tar_shards import TarShardWriter\n"
+        f"writer = TarShardWriter({output!r})\n"
+        f"_write_document(writer, {output!r}, 'done')\n"
+        "writer.end_document()\n"
+        f"_write_document(writer, {output!r}, 'partial')\n"
+        "writer._fileobj.flush()\n"
+        "os._exit(1)\n"
+    )
+    subprocess.run([sys.executable, "-c", script], check=False)
+    shards_folder = os.path.join(output, SHARDS_DIRNAME)
+    assert list_shards(shards_folder) == []
+
+    recovered = recover_orphan_shards(shards_folder)
+    assert len(recovered) == 1 and list_shards(shards_folder) == recovered
+    assert not any(f.endswith(('.tmp', '.commit')) for f in os.listdir(shards_folder))
+    _assert_index_matches(output, _document_files("done"))
@@ -0,0 +1,49 @@
+import os
+from functools import partial
+
+import pytest
+
+from psd_scheduler import MemoryBudgetScheduler
+from psd_worker_pool import PSDWorkerPool
+
+
+def _broken_init():
+    raise OSError("manifest unavailable")
+
+
+def _flaky_init(marker):
+    # 第一个进程初始化失败，之后的进程正常
+    if not os.path.exists(marker):
+        open(marker, 'w').close()
+        raise OSError("transient")
+    return {}
+
+
+def _handle(state, task):
+    return {"success": True}
+
+
+def _scheduler(tasks):
+    scheduler = MemoryBudgetScheduler(1024)
+    scheduler.add_tasks(tasks, [1] * len(tasks))
+    return scheduler
+
+
+def test_init_failure_is_not_blamed_on_files():
+    pool = PSDWorkerPool(_broken_init, _handle, num_workers=2)
+    failures = []
+    with pytest.raises(RuntimeError, match="manifest unavailable"):
+        pool.run(_scheduler([f"{i}.psd" for i in range(5)]),
+                 lambda task, result: None, lambda *args: failures.append(args))
+    assert failures == []
+    assert pool.stats()["crashed"] == 0
+
+
+def test_transient_init_failure_respawns(tmp_path):
+    pool = PSDWorkerPool(partial(_flaky_init, str(tmp_path / "marker")), _handle, num_workers=1)
+    results, failures = [], []
+    pool.run(_scheduler([f"{i}.psd" for i in range(3)]),
+             lambda task, result: results.append(task), lambda *args: failures.append(args))
+    assert sorted(results) == ["0.psd", "1.psd", "2.psd"]
+    assert failures == []
+    assert pool.stats()["init_failed"] == 1